@@ -0,0 +1,103 @@
+import logging
+import os
+from datetime import datetime
+
+from checkpoints import JOB_SETTLE_MARGIN, Checkpoint, get_checkpoint, save_checkpoint
+from db import db_now, get_pool
+from metrics import job_run
+
+logger = logging.getLogger(__name__)
+
+# Score added to a (user, genre) pair per event on a book of that genre
+FAVORITE_WEIGHT = float(os.getenv('AFFINITY_FAVORITE_WEIGHT', '3'))
+PURCHASE_WEIGHT = float(os.getenv('AFFINITY_PURCHASE_WEIGHT', '5'))
+READING_WEIGHT = float(os.getenv('AFFINITY_READING_WEIGHT', '1'))
+
+CHECKPOINT_NAME = 'affinity'
+
+# Serializes refreshes across bot processes
+REFRESH_LOCK_KEY = "hashtext('affinity_refresh')"
+
+# Users with events in (since, until]; their scores are recomputed
+CHANGED_USERS_QUERY = """
+    SELECT "userId" FROM "Favorite" WHERE "createdAt" > %(since)s AND "createdAt" <= %(until)s
+    UNION
+    SELECT "userId" FROM "Purchase" WHERE "createdAt" > %(since)s AND "createdAt" <= %(until)s
+    UNION
+    SELECT "userId" FROM "ReadingProgress" WHERE "lastReadAt" > %(since)s AND "lastReadAt" <= %(until)s
+"""
+
+# Scores from every event up to `until`, expanded to the book's genres.
+# A ReadingProgress row counts once, however often its lastReadAt moves.
+AFFINITY_SCORES_QUERY = """
+    WITH events AS (
+        SELECT f."userId" AS user_id, f."bookId" AS book_id, %(favorite)s::float8 AS weight
+        FROM "Favorite" f
+        WHERE f."createdAt" <= %(until)s {users_filter}
+        UNION ALL
+        SELECT p."userId", p."bookId", %(purchase)s::float8
+        FROM "Purchase" p
+        WHERE p."createdAt" <= %(until)s {users_filter}
+        UNION ALL
+        SELECT rp."userId", rp."bookId", %(reading)s::float8
+        FROM "ReadingProgress" rp
+        WHERE rp."lastReadAt" <= %(until)s {users_filter}
+    )
+    INSERT INTO "UserGenreAffinity" ("userId", "genreId", "score", "updatedAt")
+    SELECT e.user_id, btg."B", SUM(e.weight), %(until)s
+    FROM events e
+    JOIN "_BookToGenre" btg ON btg."A" = e.book_id
+    GROUP BY e.user_id, btg."B"
+"""
+
+async def _apply_changes(conn, rebuild: bool = False) -> int:
+    await conn.execute(f"SELECT pg_advisory_xact_lock({REFRESH_LOCK_KEY})")
+
+    checkpoint = None if rebuild else await get_checkpoint(conn, CHECKPOINT_NAME)
+    since = checkpoint.position if checkpoint else datetime(1970, 1, 1)
+    # Events committed late by transactions still in flight now are picked up next time
+    until = await db_now(conn) - JOB_SETTLE_MARGIN
+    params = {
+        'favorite': FAVORITE_WEIGHT,
+        'purchase': PURCHASE_WEIGHT,
+        'reading': READING_WEIGHT,
+        'since': since,
+        'until': until
+    }
+
+    # Refreshes recompute the users with new events the same way a rebuild
+    # computes everyone, so both end up with the same scores
+    if checkpoint is None:
+        await conn.execute('DELETE FROM "UserGenreAffinity"')
+        cur = await conn.execute(AFFINITY_SCORES_QUERY.format(users_filter=''), params)
+    else:
+        cur = await conn.execute(CHANGED_USERS_QUERY, params)
+        users = [row[0] for row in await cur.fetchall()]
+        await conn.execute('DELETE FROM "UserGenreAffinity" WHERE "userId" = ANY(%s)', (users,))
+        cur = await conn.execute(
+            AFFINITY_SCORES_QUERY.format(users_filter='AND "userId" = ANY(%(users)s)'),
+            {**params, 'users': users}
+        )
+    await save_checkpoint(conn, CHECKPOINT_NAME, Checkpoint(until))
+
+    logger.info(f"Affinity refreshed: {cur.rowcount} user genres updated since {since}")
+    return cur.rowcount
+
+async def refresh_affinity() -> int:
+    """
+    Fold Favorite, Purchase and ReadingProgress changes made since the last
+    refresh into the affinity scores. The first run builds the whole table.
+    Returns the number of (user, genre) rows touched.
+    """
+    async with job_run('affinity_refresh'), get_pool().connection() as conn:
+        async with conn.transaction():
+            return await _apply_changes(conn)
+
+async def rebuild_affinity() -> int:
+    """
+    Recompute every score from scratch. Refreshes only recompute users with
+    new events, so this is what drops removed favorites of everyone else.
+    """
+    async with job_run('affinity_rebuild'), get_pool().connection() as conn:
+        async with conn.transaction():
+            return await _apply_changes(conn, rebuild=True)
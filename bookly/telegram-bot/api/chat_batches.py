@@ -0,0 +1,169 @@
+# telegram-bot/api/chat_batches.py
+
+import asyncio
+import json
+import logging
+from collections import deque
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from telegram import TelegramObject, Update
+
+from metrics import WEBHOOK_REPLIES
+
+logger = logging.getLogger(__name__)
+
+# (Bot method name, parameters), e.g. ('send_message', {'chat_id': 1, 'text': 'Hi'})
+ApiCall = Tuple[str, dict]
+
+# Replies made by the handlers of the update being processed; unset outside a batch
+_replies: ContextVar[Optional[List[ApiCall]]] = ContextVar('webhook_replies', default=None)
+
+async def reply(update: Update, method: str, **params) -> None:
+    """
+    Reply to the chat of `update` from a handler. Inside a chat batch the
+    call is collected, so it can be coalesced with its neighbours or
+    returned as the webhook response; otherwise it is sent right away.
+    """
+    call = (method, {'chat_id': update.effective_chat.id, **params})
+    replies = _replies.get()
+    if replies is None:
+        await _send(update.get_bot(), call)
+    else:
+        replies.append(call)
+
+def response_body(call: ApiCall) -> dict:
+    """The webhook response that makes Telegram execute `call` itself."""
+    method, params = call
+    body = {'method': _api_method(method)}
+    for name, value in params.items():
+        if value is None:
+            continue
+        if isinstance(value, TelegramObject):
+            value = value.to_dict()
+        elif name == 'reply_markup' and isinstance(value, str):
+            value = json.loads(value)
+        body[name] = value
+    return body
+
+def _api_method(method: str) -> str:
+    head, *rest = method.split('_')
+    return head + ''.join(word.capitalize() for word in rest)
+
+async def _send(bot, call: ApiCall) -> None:
+    method, params = call
+    try:
+        await getattr(bot, method)(**params)
+    except Exception as e:
+        logger.error(f"Error sending {method} to chat {params.get('chat_id')}: {e}")
+
+class ChatBatcher:
+    """
+    Processes webhook updates in per-chat micro-batches. Updates of one
+    chat are handled one after another in arrival order, while different
+    chats are handled concurrently by up to `workers` tasks. Updates that
+    pile up for a chat while it is busy are taken together as the next
+    batch, and identical consecutive replies within a batch are sent once.
+
+    The last reply of a batch may be handed back to the HTTP request that
+    delivered its update, to be returned as the webhook response instead
+    of being sent. Every other reply has gone out by then, so per-chat
+    ordering is kept.
+    """
+
+    def __init__(self, process: Callable[[Update], Awaitable[None]], bot,
+                 workers: int, max_pending: int, batch_size: int):
+        self.process = process
+        self.bot = bot
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.pending = 0
+        self._chats: Dict[int, Deque[Tuple[Update, Optional[asyncio.Future]]]] = {}
+        self._workers = asyncio.Semaphore(workers)
+        self._tasks = set()
+
+    @property
+    def full(self) -> bool:
+        """Whether max_pending updates are waiting; callers should turn new ones away."""
+        return self.pending >= self.max_pending
+
+    def submit(self, update: Update, want_reply: bool = False) -> Optional[asyncio.Future]:
+        """
+        Queue an update. With `want_reply` the returned future resolves to
+        the reply to return as the webhook response, or None once the
+        update has been handled and its replies sent. Admission is up to
+        the caller, see `full`.
+        """
+        future = asyncio.get_running_loop().create_future() if want_reply else None
+        chat = update.effective_chat
+        chat_id = chat.id if chat else 0
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+            task = asyncio.create_task(self._drain(chat_id, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        queue.append((update, future))
+        self.pending += 1
+        return future
+
+    async def join(self) -> None:
+        """Wait until every queued update has been handled."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _drain(self, chat_id: int, queue: Deque) -> None:
+        try:
+            async with self._workers:
+                while queue:
+                    batch = [queue.popleft() for _ in range(min(self.batch_size, len(queue)))]
+                    try:
+                        await self._run_batch(batch)
+                    finally:
+                        self.pending -= len(batch)
+        finally:
+            del self._chats[chat_id]
+
+    async def _run_batch(self, batch: List[Tuple[Update, Optional[asyncio.Future]]]) -> None:
+        calls: List[Tuple[ApiCall, int]] = []
+        for index, (update, _) in enumerate(batch):
+            replies = []
+            token = _replies.set(replies)
+            try:
+                await self.process(update)
+            except Exception as e:
+                logger.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                _replies.reset(token)
+
+            for call in replies:
+                if calls and calls[-1][0] == call:
+                    WEBHOOK_REPLIES.inc(mode='coalesced')
+                    continue
+                calls.append((call, index))
+
+        # The last reply can ride on the response to its own update's request
+        inline = None
+        if calls:
+            call, index = calls[-1]
+            future = batch[index][1]
+            if future is not None and not future.done():
+                inline = calls.pop()
+
+        try:
+            for call, _ in calls:
+                await _send(self.bot, call)
+                WEBHOOK_REPLIES.inc(mode='sent')
+        finally:
+            for index, (_, future) in enumerate(batch):
+                if future is None or future.done():
+                    continue
+                if inline is not None and inline[1] == index:
+                    future.set_result(inline[0])
+                    WEBHOOK_REPLIES.inc(mode='inline')
+                else:
+                    future.set_result(None)
+
+        # A request that gave up waiting cancels its future; send its reply instead
+        if inline is not None and batch[inline[1]][1].cancelled():
+            await _send(self.bot, inline[0])
@@ -3,51 +3,12 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from bot import main
-from flask import Flask, request, jsonify
-import asyncio
+# The webhook module owns the long-lived Application and its event loop;
+# this entry point only exposes the same update route at "/".
+from webhook import app, webhook
 
-app = Flask(__name__)
-
-# Import the application logic
-from bot import setup_handlers
-from telegram.ext import Application
-
-# Global application instance
-bot_application = None
-
-@app.route("/", methods=["POST"])
-def hook():
-    # Receive webhook data from Telegram
-    data = request.get_json()
-    
-    # Process the update asynchronously
-    # Since Flask is synchronous, we need to run the async function differently
-    # This is a simplified version - in practice you'd run the update through your bot
-    
-    # For now, return success to Telegram
-    return jsonify({"status": "ok"})
-
-@app.route("/", methods=["GET"])
-def health():
-    return jsonify({"status": "running"})
-
-def initialize_bot():
-    global bot_application
-    
-    # Create application instance
-    token = os.getenv('BOT_TOKEN')
-    if not token:
-        raise ValueError("BOT_TOKEN environment variable not set")
-    
-    bot_application = Application.builder().token(token).build()
-    
-    # Setup handlers
-    setup_handlers(bot_application)
-
-if __name__ != "__main__":
-    # This runs when deployed to Vercel
-    initialize_bot()
+app.add_url_rule("/", "hook", webhook, methods=["POST"])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    port = int(os.environ.get('PORT', 5000))
+    app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,41 @@
+# telegram-bot/api/startup.py
+
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from metrics import STARTUP_PHASE_DURATION
+
+class StartupReport:
+    """
+    Wall time of each step between the entry point being imported and the
+    bot being ready for its first update, e.g. importing python-telegram-bot,
+    building the Application and connecting to the Bot API.
+    """
+
+    def __init__(self, started_at: Optional[float] = None):
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self.phases: Dict[str, float] = {}
+        self.ready_after = None
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.phases[name] = elapsed
+            STARTUP_PHASE_DURATION.set(elapsed, phase=name)
+
+    def ready(self) -> str:
+        """Mark the bot ready. Returns a one-line summary of where the time went."""
+        self.ready_after = time.perf_counter() - self.started_at
+        breakdown = ', '.join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.phases.items())
+        return f"Webhook ready {self.ready_after * 1000:.0f}ms after import: {breakdown}"
+
+    def as_dict(self) -> dict:
+        return {
+            'ready_after_ms': None if self.ready_after is None else round(self.ready_after * 1000, 1),
+            'phases_ms': {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()}
+        }
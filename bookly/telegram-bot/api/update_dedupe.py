@@ -0,0 +1,73 @@
+# telegram-bot/api/update_dedupe.py
+
+import logging
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+logger = logging.getLogger(__name__)
+
+# How often the shared window deletes update ids that fell out of it
+WINDOW_CLEANUP_INTERVAL = 600
+
+class SeenUpdates:
+    """Bounded LRU of the update ids this process has accepted."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._ids = OrderedDict()
+
+    def add(self, update_id: int) -> bool:
+        """Remember `update_id`. Returns False if it was already seen."""
+        if update_id in self._ids:
+            self._ids.move_to_end(update_id)
+            return False
+
+        self._ids[update_id] = None
+        if len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+        return True
+
+class SharedUpdateWindow:
+    """
+    Update ids accepted by any replica within `window`, kept in Postgres.
+    Database errors let the update through: a rare duplicate reply is
+    better than a lost one.
+    """
+
+    def __init__(self, window: timedelta):
+        self.window = window
+        self._cleaned_at = 0.0
+
+    async def start(self) -> None:
+        # Imported here so deployments without the shared window never load psycopg
+        from db import init_pool
+
+        # "ProcessedUpdate" is created by the polling bot's migrations
+        await init_pool()
+
+    async def stop(self) -> None:
+        from db import close_pool
+
+        await close_pool()
+
+    async def add(self, update_id: int) -> bool:
+        """Claim `update_id` for this replica. Returns False if another request already did."""
+        from db import get_pool
+
+        try:
+            async with get_pool().connection() as conn:
+                cur = await conn.execute(
+                    'INSERT INTO "ProcessedUpdate" ("updateId") VALUES (%s) ON CONFLICT DO NOTHING',
+                    (update_id,)
+                )
+                if time.monotonic() - self._cleaned_at > WINDOW_CLEANUP_INTERVAL:
+                    self._cleaned_at = time.monotonic()
+                    await conn.execute(
+                        'DELETE FROM "ProcessedUpdate" WHERE "receivedAt" < LOCALTIMESTAMP - %s',
+                        (self.window,)
+                    )
+        except Exception as e:
+            logger.error(f"Error checking update {update_id} against the shared window: {e}")
+            return True
+        return cur.rowcount == 1
@@ -1,13 +1,37 @@
 # telegram-bot/api/webhook.py
 
+import time
+
+_IMPORTED_AT = time.perf_counter()
+
 import os
 import asyncio
-from flask import Flask, request, jsonify
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from dotenv import load_dotenv
+import atexit
+import sys
+import threading
+from datetime import timedelta
+
+# Shared bot modules live one directory up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from startup import StartupReport
+
+# python-telegram-bot is imported and the Application built on the first
+# update (or by the prewarm thread below), not when the platform imports
+# this module
+startup = StartupReport(_IMPORTED_AT)
+
+with startup.phase('import flask'):
+    from flask import Flask, Response, request, jsonify
 
-# Load environment variables
-load_dotenv()
+from metrics import CONTENT_TYPE, WEBHOOK_UPDATES, render_metrics
+from update_dedupe import SeenUpdates, SharedUpdateWindow
+
+# Platforms usually inject the environment; .env is only read without it
+if 'BOT_TOKEN' not in os.environ:
+    with startup.phase('load dotenv'):
+        from dotenv import load_dotenv
+        load_dotenv()
 
 app = Flask(__name__)
 
@@ -16,86 +40,233 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable not set")
 
-# Create the Application and pass it your bot's token.
-application = Application.builder().token(BOT_TOKEN).build()
-
-# Command handlers
-async def start(update, context):
-    """Send a message when the command /start is issued."""
-    user = update.effective_user
-    await update.message.reply_html(
-        f'Привет, {user.mention_html()}! 👋\n\n'
-        f'Добро пожаловать в Bookly - телеграмм бот для онлайн-библиотеки. '
-        f'Через этого бота вы можете читать книги, добавлять их в избранное '
-        f'и покупать платные издания.\n\n'
-        f'Чтобы открыть приложение, нажмите кнопку "Открыть библиотеку" ниже.',
-        reply_markup=None  # In webhook mode, we don't send buttons via this route directly
-    )
+# Number of chats processed concurrently and the number of pending updates
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '16'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
 
-async def library(update, context):
-    """Open the library Mini App."""
-    await update.message.reply_text(
-        'Откройте вашу библиотеку в Mini App:',
-        reply_markup=None  # Don't send buttons
-    )
+# Past this many pending updates, replies are no longer waited for, so
+# requests return at once instead of piling up behind a slow spell
+WEBHOOK_INLINE_REPLY_LIMIT = int(os.getenv('WEBHOOK_INLINE_REPLY_LIMIT', str(WEBHOOK_QUEUE_SIZE // 2)))
 
-async def help_command(update, context):
-    """Send a message when the command /help is issued."""
-    await update.message.reply_text(
-        '📖 Справка по боту Bookly:\n\n'
-        '/start - Приветственное сообщение\n'
-        '/library - Открыть вашу библиотеку\n'
-        '/help - Показать это сообщение\n\n'
-        'Для полноценного использования библиотеки '
-        'используйте кнопки под сообщениями, '
-        'которые открывают Mini App.'
-    )
+# Telegram re-delivers an update whose request failed or timed out. Ids of
+# accepted updates are remembered so re-deliveries are acknowledged without
+# running the handlers again: the last WEBHOOK_DEDUPE_SIZE in this process
+# and, with WEBHOOK_SHARED_DEDUPE, everything accepted by any replica within
+# WEBHOOK_DEDUPE_WINDOW_HOURS.
+WEBHOOK_DEDUPE_SIZE = int(os.getenv('WEBHOOK_DEDUPE_SIZE', '10000'))
+WEBHOOK_SHARED_DEDUPE = os.getenv('WEBHOOK_SHARED_DEDUPE', 'false').lower() == 'true'
+WEBHOOK_DEDUPE_WINDOW = timedelta(hours=int(os.getenv('WEBHOOK_DEDUPE_WINDOW_HOURS', '24')))
 
-async def open_mini_app(update, context):
-    """Open the main Mini App."""
-    await update.message.reply_text(
-        'Откройте Bookly:',
-        reply_markup=None  # Don't send buttons in webhook mode
-    )
+# Updates of one chat handled together when they pile up
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', '10'))
+
+# Updates for these commands, and plain text, are answered in the webhook
+# response itself when the handler replies within WEBHOOK_REPLY_TIMEOUT
+INLINE_REPLY_COMMANDS = {'start', 'library', 'help'}
+WEBHOOK_REPLY_TIMEOUT = float(os.getenv('WEBHOOK_REPLY_TIMEOUT', '2'))
+
+# Serverless platforms may freeze the process once the response is sent,
+# so there the route waits for the handlers before replying.
+WEBHOOK_WAIT_FOR_HANDLERS = os.getenv('WEBHOOK_WAIT_FOR_HANDLERS', 'false').lower() == 'true'
+WEBHOOK_HANDLER_TIMEOUT = float(os.getenv('WEBHOOK_HANDLER_TIMEOUT', '25'))
+
+# /library lists the books the user is reading, which needs the database.
+# The pool is opened in the background once the runtime is ready; until
+# then, or without the database, the command only points to the Mini App.
+# Cached lists are not invalidated here and live for LIBRARY_CACHE_TTL.
+WEBHOOK_READING_LIST = os.getenv('WEBHOOK_READING_LIST', 'false').lower() == 'true'
+
+# Start the bot runtime in the background as soon as the module is imported,
+# so it overlaps the rest of the platform's cold start
+WEBHOOK_PREWARM = os.getenv('WEBHOOK_PREWARM', 'true').lower() == 'true'
+
+_application = None
+
+def get_application():
+    """Build the Application and register the handlers. Runs once per process."""
+    global _application
+    if _application is None:
+        with startup.phase('import telegram'):
+            from telegram.ext import Application
+        # Updates are pushed by the webhook route and scheduled by the ChatBatcher,
+        # so neither an Updater nor the application's update queue is used.
+        with startup.phase('build application'):
+            application = (
+                Application.builder()
+                .token(BOT_TOKEN)
+                .base_url(os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot'))
+                .updater(None)
+                .connection_pool_size(WEBHOOK_WORKERS + 4)
+                .build()
+            )
+        with startup.phase('register handlers'):
+            from webhook_handlers import register_handlers
+            register_handlers(application)
+        _application = application
+    return _application
+
+# The application runs on one long-lived event loop in a background thread.
+# Flask request threads hand updates over to it instead of building a loop
+# and an HTTP client per request.
+_loop = None
+_batcher = None
+_seen = SeenUpdates(WEBHOOK_DEDUPE_SIZE)
+_window = SharedUpdateWindow(WEBHOOK_DEDUPE_WINDOW) if WEBHOOK_SHARED_DEDUPE else None
+_runtime_lock = threading.Lock()
+
+async def _start_reading_list(application) -> None:
+    # Imported here so deployments without the database never load psycopg
+    from db import init_pool
+
+    # The schema is the polling bot's to migrate; nothing here changes it
+    try:
+        await init_pool()
+    except Exception as e:
+        print(f"Error opening the database for /library, falling back to the Mini App link: {e}")
+        return
+    application.bot_data['reading_list'] = True
+
+def _run_loop(loop, ready):
+    global _batcher
+    asyncio.set_event_loop(loop)
+    try:
+        application = get_application()
+        with startup.phase('initialize'):
+            loop.run_until_complete(application.initialize())
+            loop.run_until_complete(application.start())
+        if _window is not None:
+            with startup.phase('shared update window'):
+                loop.run_until_complete(_window.start())
+        if WEBHOOK_READING_LIST:
+            # Runs once the loop does, without holding up the first update
+            loop.create_task(_start_reading_list(application))
+
+        from chat_batches import ChatBatcher
+        _batcher = ChatBatcher(
+            application.process_update, application.bot,
+            workers=WEBHOOK_WORKERS, max_pending=WEBHOOK_QUEUE_SIZE, batch_size=WEBHOOK_BATCH_SIZE
+        )
+        print(startup.ready())
+    except Exception as e:
+        print(f"Error starting bot runtime: {e}")
+        loop.close()
+        return
+    finally:
+        ready.set()
+    loop.run_forever()
+
+def get_event_loop():
+    """Start the bot runtime on first use and return its event loop."""
+    global _loop
+    with _runtime_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            threading.Thread(target=_run_loop, args=(loop, ready), name='bot-runtime', daemon=True).start()
+            ready.wait()
+            if loop.is_closed():
+                raise RuntimeError("Bot runtime failed to start")
+            _loop = loop
+    return _loop
+
+@atexit.register
+def _stop_runtime():
+    if _loop is None or not _loop.is_running():
+        return
+
+    async def shutdown():
+        await _batcher.join()
+        await _application.stop()
+        await _application.shutdown()
+        if WEBHOOK_READING_LIST:
+            from db import close_pool
+
+            await close_pool()
+        if _window is not None:
+            await _window.stop()
+
+    asyncio.run_coroutine_threadsafe(shutdown(), _loop).result(timeout=10)
+    _loop.call_soon_threadsafe(_loop.stop)
+
+def _prewarm():
+    try:
+        get_event_loop()
+    except Exception as e:
+        print(f"Error prewarming bot runtime: {e}")
 
-# Add handlers to the application
-application.add_handler(CommandHandler("start", start))
-application.add_handler(CommandHandler("library", library))
-application.add_handler(CommandHandler("help", help_command))
+if WEBHOOK_PREWARM:
+    threading.Thread(target=_prewarm, name='bot-prewarm', daemon=True).start()
 
-# Handle messages with "библиотека", "книги", "читать" keywords
-application.add_handler(MessageHandler(
-    filters.TEXT & ~filters.COMMAND, open_mini_app
-))
+def wants_inline_reply(update) -> bool:
+    """Whether the route should wait for the reply to `update` and return it as the response."""
+    if WEBHOOK_WAIT_FOR_HANDLERS:
+        return True
+    message = update.message
+    if message is None or not message.text:
+        return False
+    if not message.text.startswith('/'):
+        return True
+    words = message.text[1:].split(maxsplit=1)
+    return bool(words) and words[0].split('@', 1)[0] in INLINE_REPLY_COMMANDS
+
+async def is_new_update(update_id: int) -> bool:
+    """Record `update_id` as accepted. Returns False for a re-delivery."""
+    if not _seen.add(update_id):
+        return False
+    if _window is not None:
+        return await _window.add(update_id)
+    return True
+
+async def handle_update(update, timeout: float):
+    """
+    Queue an update. Returns False when the queue is full, the reply to
+    return as the webhook response if one was produced within `timeout`,
+    or None.
+    """
+    # Shed before recording the id, so the re-delivery is not taken for a duplicate
+    if _batcher.full:
+        WEBHOOK_UPDATES.inc(result='shed')
+        return False
+    if not await is_new_update(update.update_id):
+        WEBHOOK_UPDATES.inc(result='duplicate')
+        return None
+
+    WEBHOOK_UPDATES.inc(result='accepted')
+    want_reply = wants_inline_reply(update) and (
+        WEBHOOK_WAIT_FOR_HANDLERS or _batcher.pending < WEBHOOK_INLINE_REPLY_LIMIT
+    )
+    future = _batcher.submit(update, want_reply=want_reply)
+    if future is None:
+        return None
+
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+        # Past the deadline the reply, if any, is sent as a normal API call
+        future.cancel()
+        return None
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """Handle incoming webhook updates from Telegram"""
     try:
-        # Get the update data from the request
-        update_data = request.get_json()
-        
-        # Create an Update object from the data
-        # For simplicity, we'll just process it directly
-        # In a real implementation, you'd properly deserialize and update
-        
-        # Schedule the update to be processed by the application
-        async def process_update():
-            update = Update.de_json(update_data)
-            await application.process_update(update)
-        
-        # In a real Flask app with async support, you'd use something like asyncio.run
-        # But for Vercel, we need to handle it differently
-        # This is a simplified approach
-        
-        # Since we can't directly await async in Flask sync context,
-        # we'll handle it with asyncio.run in a thread-safe way
-        # For Vercel deployment, this approach should work
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(process_update())
-        loop.close()
-        
+        loop = get_event_loop()
+        # Already loaded by the runtime
+        from telegram import Update
+        from chat_batches import response_body
+        update = Update.de_json(request.get_json(force=True), _application.bot)
+
+        # Serverless platforms may freeze the process once the response is
+        # sent, so there every update is waited for, however long it takes
+        timeout = WEBHOOK_HANDLER_TIMEOUT if WEBHOOK_WAIT_FOR_HANDLERS else WEBHOOK_REPLY_TIMEOUT
+        result = asyncio.run_coroutine_threadsafe(handle_update(update, timeout), loop).result(timeout=timeout + 5)
+        if result is False:
+            # Telegram re-delivers updates that were not acknowledged with 200
+            return jsonify({'status': 'busy'}), 503
+        if result:
+            # Telegram performs the call itself, saving an outbound request
+            return jsonify(response_body(result))
+
         return jsonify({'status': 'ok'})
     except Exception as e:
         print(f"Error processing webhook: {e}")
@@ -106,6 +277,16 @@ def health():
     """Health check endpoint"""
     return jsonify({'status': 'healthy', 'bot': 'Bookly Telegram Bot'})
 
+@app.route('/startup', methods=['GET'])
+def startup_report():
+    """Cold start breakdown of this process"""
+    return jsonify(startup.as_dict())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics endpoint"""
+    return Response(render_metrics(), mimetype=CONTENT_TYPE)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
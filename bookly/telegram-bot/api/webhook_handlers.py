@@ -0,0 +1,81 @@
+# telegram-bot/api/webhook_handlers.py
+# Imported by the webhook on first use, together with python-telegram-bot.
+
+import logging
+
+from telegram.ext import Application, CommandHandler, MessageHandler, filters
+
+from chat_batches import reply
+from metrics import timed_handler
+
+logger = logging.getLogger(__name__)
+
+@timed_handler('start')
+async def start(update, context):
+    """Send a message when the command /start is issued."""
+    user = update.effective_user
+    # In webhook mode, we don't send buttons via this route directly
+    await reply(
+        update, 'send_message',
+        text=(
+            f'Привет, {user.mention_html()}! 👋\n\n'
+            f'Добро пожаловать в Bookly - телеграмм бот для онлайн-библиотеки. '
+            f'Через этого бота вы можете читать книги, добавлять их в избранное '
+            f'и покупать платные издания.\n\n'
+            f'Чтобы открыть приложение, нажмите кнопку "Открыть библиотеку" ниже.'
+        ),
+        parse_mode='HTML'
+    )
+
+@timed_handler('library')
+async def library(update, context):
+    """List the books the user is reading, or just point to the library Mini App."""
+    cached = None
+    # Set once the runtime has a database pool
+    if context.bot_data.get('reading_list'):
+        from library_cache import library_reply
+
+        try:
+            cached = await library_reply(str(update.effective_chat.id))
+        except Exception as e:
+            logger.error(f"Error loading reading list of chat {update.effective_chat.id}: {e}")
+
+    if cached:
+        text, keyboard = cached
+        await reply(update, 'send_message', text=text, reply_markup=keyboard)
+        return
+
+    await reply(update, 'send_message', text='Откройте вашу библиотеку в Mini App:')
+
+@timed_handler('help')
+async def help_command(update, context):
+    """Send a message when the command /help is issued."""
+    await reply(
+        update, 'send_message',
+        text=(
+            '📖 Справка по боту Bookly:\n\n'
+            '/start - Приветственное сообщение\n'
+            '/library - Открыть вашу библиотеку\n'
+            '/help - Показать это сообщение\n\n'
+            'Для полноценного использования библиотеки '
+            'используйте кнопки под сообщениями, '
+            'которые открывают Mini App.'
+        )
+    )
+
+@timed_handler('text')
+async def open_mini_app(update, context):
+    """Open the main Mini App."""
+    # Don't send buttons in webhook mode
+    await reply(update, 'send_message', text='Откройте Bookly:')
+
+def register_handlers(application: Application) -> None:
+    """Add the webhook's command and message handlers to `application`."""
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("library", library))
+    application.add_handler(CommandHandler("help", help_command))
+
+    # Handle messages with "библиотека", "книги", "читать" keywords
+    application.add_handler(MessageHandler(
+        filters.TEXT & ~filters.COMMAND, open_mini_app
+    ))
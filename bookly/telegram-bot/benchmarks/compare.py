@@ -0,0 +1,45 @@
+"""
+Compare two result files written by run.py.
+
+    python benchmarks/compare.py results/before.json results/after.json
+"""
+import argparse
+import json
+from pathlib import Path
+
+METRICS = [
+    ('wall_time_s', 's'),
+    ('queries', ''),
+    ('messages', ''),
+    ('messages_per_s', 'msg/s'),
+    ('peak_rss_mb', 'MB'),
+]
+
+def _load(path: str) -> dict:
+    return json.loads(Path(path).read_text())
+
+def _change(before, after) -> str:
+    if not before:
+        return 'n/a'
+    return f"{(after - before) / before * 100:+.1f}%"
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+
+    before, after = _load(args.before), _load(args.after)
+    print(f"before: {before['revision']} ({before['timestamp']})")
+    print(f" after: {after['revision']} ({after['timestamp']})")
+    if before['settings'] != after['settings']:
+        print(f"warning: settings differ: {before['settings']} vs {after['settings']}")
+
+    for scenario in before['scenarios'].keys() & after['scenarios'].keys():
+        print(f"\n{scenario}")
+        old, new = before['scenarios'][scenario], after['scenarios'][scenario]
+        for metric, unit in METRICS:
+            print(f"  {metric:>16}: {old[metric]:>12} -> {new[metric]:>12} {unit:<6} {_change(old[metric], new[metric])}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Local stand-in for the Telegram Bot API used by the benchmarks.
+
+Answers sendMessage, sendPhoto, sendMediaGroup and getMe the way Telegram
+does, after a configurable latency, and can answer every Nth call with a
+429 carrying retry_after to exercise the dispatcher's flood handling.
+"""
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+class FakeBotApi:
+    def __init__(self, latency_ms: float = 0, rate_limit_every: int = 0, retry_after: int = 1):
+        self.latency = latency_ms / 1000
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        """Value for Bot(base_url=...) / TELEGRAM_API_URL."""
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/bot"
+
+    @property
+    def messages_sent(self) -> int:
+        return sum(count for method, count in self.calls.items() if method.startswith('send'))
+
+    def start(self) -> 'FakeBotApi':
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                api._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-bot-api', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.rate_limited = 0
+
+    def _next_message_id(self) -> int:
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def _handle(self, request: BaseHTTPRequestHandler) -> None:
+        method = request.path.rsplit('/', 1)[-1]
+        length = int(request.headers.get('Content-Length', 0))
+        body = request.rfile.read(length)
+        params = _parse_params(request.headers.get('Content-Type', ''), body)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            total = sum(self.calls.values()) + 1
+            limited = (
+                self.rate_limit_every
+                and method.startswith('send')
+                and total % self.rate_limit_every == 0
+            )
+            if limited:
+                self.rate_limited += 1
+            else:
+                self.calls[method] += 1
+
+        if limited:
+            _reply(request, 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after}
+            })
+            return
+
+        _reply(request, 200, {'ok': True, 'result': self._result(method, params)})
+
+    def _result(self, method: str, params: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bookly', 'username': 'bookly_bench_bot'}
+
+        chat_id = int(params.get('chat_id', 0) or 0)
+        if method == 'sendMediaGroup':
+            media = params.get('media') or []
+            return [self._photo_message(chat_id) for _ in media]
+        if method == 'sendPhoto':
+            return self._photo_message(chat_id)
+        return self._message(chat_id, text=params.get('text', ''))
+
+    def _message(self, chat_id: int, **fields) -> dict:
+        return {
+            'message_id': self._next_message_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            **fields
+        }
+
+    def _photo_message(self, chat_id: int) -> dict:
+        message_id = self._next_message_id()
+        file_id = f"bench-photo-{message_id}"
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'photo': [{'file_id': file_id, 'file_unique_id': file_id, 'width': 600, 'height': 900}]
+        }
+
+def _parse_params(content_type: str, body: bytes) -> dict:
+    if content_type.startswith('application/json'):
+        return json.loads(body or b'{}')
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        for key in ('media', 'reply_markup'):
+            if key in params:
+                params[key] = json.loads(params[key])
+        return params
+    # Multipart uploads only matter for their count, not their content
+    return {}
+
+def _reply(request: BaseHTTPRequestHandler, status: int, payload: dict) -> None:
+    body = json.dumps(payload).encode()
+    request.send_response(status)
+    request.send_header('Content-Type', 'application/json')
+    request.send_header('Content-Length', str(len(body)))
+    request.end_headers()
+    request.wfile.write(body)
@@ -0,0 +1,166 @@
+"""
+Check that the notification jobs' queries are served by indexes.
+
+Runs every job against a database seeded by seed.py, records the
+statements they execute and EXPLAINs each of them. Every job runs twice:
+once from empty bot tables, as on a first deployment, and once more
+incrementally, from checkpoints rewound by --incremental-minutes, as in
+steady state. Exits with status 1 if a plan scans a table of more than
+--min-rows rows sequentially, so a new query or a missing index shows up
+here instead of in production.
+
+    python benchmarks/plan_check.py --scale 5000
+"""
+import argparse
+import asyncio
+import hashlib
+import sys
+import time
+from datetime import timedelta
+from typing import Dict, Iterator, Tuple
+
+import psycopg
+
+# First: puts the bot on sys.path and sets up the benchmark environment
+from run import JOB_SCENARIOS, QueryCounter, reset_state
+from affinity import refresh_affinity
+from db import _conninfo, close_pool, get_pool, init_pool
+from metrics import statement_label
+from migrations import migrate
+from seed import seed
+
+# Statements whose plans depend on the data rather than on the query
+CHECKED_STATEMENTS = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+def query_fingerprint(query: str) -> str:
+    """Short hash of `query` with its whitespace normalized."""
+    return hashlib.sha1(' '.join(query.split()).encode()).hexdigest()[:12]
+
+# (query fingerprint, table) -> why a sequential scan is the right plan there.
+# Entries name one exact query: once it is edited, its plan is checked again.
+# The shard condition, mod(hashtext(telegram_id), JOB_SHARDS), cannot use an
+# index since the shard count is configurable.
+ALLOWED_SEQ_SCANS: Dict[Tuple[str, str], str] = {
+    ('aa838d44b365', 'User'): (
+        'check_inactive_users page: "User"."lastActiveAt" gets its index once the backend '
+        'defines the column (see migration 2)'
+    ),
+    ('4b6bbb107975', 'User'): (
+        "check_unfinished_books page: the page's stalled books are hash joined with the users of the shard"
+    ),
+    ('b3e3bb0700f4', 'User'): (
+        "queue_new_book_targets: most users of the shard like one of the new books' genres"
+    ),
+}
+
+class StatementRecorder(QueryCounter):
+    """Keeps the first parameters each statement ran with, per job."""
+
+    def __init__(self):
+        super().__init__()
+        self.job = None
+        self.statements: Dict[Tuple[str, str], object] = {}
+
+    def _add(self, per_call, query, params):
+        params = super()._add(per_call, query, params)
+        query = str(query)
+        words = query.split(None, 1)
+        if self.job and words and words[0].upper() in CHECKED_STATEMENTS:
+            # executemany() gets a list of parameter sets; one is enough to plan
+            first = params[0] if per_call is None and params else params
+            self.statements.setdefault((self.job, query), first)
+        return params
+
+async def rewind_checkpoints(window: timedelta) -> None:
+    """Move every checkpoint back by `window`, as if the jobs last ran that long ago."""
+    async with get_pool().connection() as conn:
+        await conn.execute('UPDATE "BotCheckpoint" SET "position" = "position" - %s', (window,))
+
+async def record_statements(recorder: StatementRecorder, incremental_window: timedelta) -> None:
+    await init_pool()
+    await migrate()
+    try:
+        for name, job in JOB_SCENARIOS.items():
+            await reset_state()
+            # The first refresh reads every event, which rightly scans whole
+            # tables; the jobs' own refreshes are then incremental as in production
+            await refresh_affinity()
+            recorder.job = name
+            await job(None)
+
+            await rewind_checkpoints(incremental_window)
+            recorder.job = f"{name} (incremental)"
+            await job(None)
+            recorder.job = None
+    finally:
+        await close_pool()
+
+def seq_scans(plan: dict) -> Iterator[str]:
+    """Tables scanned sequentially anywhere in `plan`."""
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan['Relation Name']
+    for child in plan.get('Plans', ()):
+        yield from seq_scans(child)
+
+def check_plans(statements: dict, min_rows: int) -> int:
+    """EXPLAIN every statement. Returns the number of plans that failed the check."""
+    failures = 0
+    # Client-side binding, so EXPLAIN sees the values the job used
+    with psycopg.connect(_conninfo(), cursor_factory=psycopg.ClientCursor) as conn:
+        conn.execute('ANALYZE')
+        conn.commit()
+        rows = dict(conn.execute(
+            "SELECT relname, reltuples::bigint FROM pg_class WHERE relkind IN ('r', 'p')"
+        ).fetchall())
+
+        for (job, query), params in statements.items():
+            label = statement_label(query)
+            fingerprint = query_fingerprint(query)
+            try:
+                plan = conn.execute('EXPLAIN (FORMAT JSON) ' + query, params).fetchone()[0][0]['Plan']
+            except psycopg.Error as e:
+                print(f"{job:>30}  {label:<40}  EXPLAIN failed: {e}")
+                failures += 1
+                continue
+            finally:
+                # Nothing ran, but a failed EXPLAIN aborts the transaction
+                conn.rollback()
+
+            offending = [
+                table for table in seq_scans(plan)
+                if rows.get(table, 0) > min_rows and (fingerprint, table) not in ALLOWED_SEQ_SCANS
+            ]
+            if offending:
+                failures += 1
+                tables = ', '.join(f'"{table}" ({rows[table]} rows)' for table in dict.fromkeys(offending))
+                print(f"{job:>30}  {label:<40}  SEQ SCAN on {tables}, query {fingerprint}")
+                print('\n'.join('    ' + line for line in query.strip().splitlines()))
+            else:
+                print(f"{job:>30}  {label:<40}  ok")
+    return failures
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', type=int, default=5000, help="users to seed (books are a tenth of that)")
+    parser.add_argument('--min-rows', type=int, default=2000,
+                        help="tables up to this many rows may be scanned sequentially; keep it under --scale")
+    parser.add_argument('--incremental-minutes', type=int, default=60,
+                        help="how far checkpoints are rewound for the incremental runs")
+    parser.add_argument('--skip-seed', action='store_true', help="reuse the database seeded by a previous run")
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        started = time.perf_counter()
+        counts = seed(args.scale)
+        print(f"Seeded {counts['User']} users and {counts['Book']} books in {time.perf_counter() - started:.1f}s")
+
+    recorder = StatementRecorder()
+    recorder.install()
+    asyncio.run(record_statements(recorder, timedelta(minutes=args.incremental_minutes)))
+
+    failures = check_plans(recorder.statements, args.min_rows)
+    print(f"{len(recorder.statements)} statements checked, {failures} failed")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
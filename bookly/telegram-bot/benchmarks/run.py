@@ -0,0 +1,253 @@
+"""
+Run the notification jobs and the webhook against a seeded database and a
+local fake Bot API, and record wall time, query count, messages sent and
+peak memory per scenario.
+
+    python benchmarks/run.py --scale 10000 --output results/before.json
+    python benchmarks/compare.py results/before.json results/after.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BOT_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+# Settings read at import time by the bot modules
+os.environ.setdefault('DB_NAME', 'bookly_bench')
+os.environ.setdefault('BOT_TOKEN', '123456:bench')
+os.environ['DIGEST_WINDOW_MINUTES'] = '0'
+os.environ['DELIVERY_WINDOW_MINUTES'] = '1440'
+
+import psycopg
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+import media_cache
+from db import close_pool, get_pool, init_pool
+from digest import flush_digests
+from dispatcher import DISPATCH_WORKERS, close_dispatcher, init_dispatcher
+from fake_bot_api import FakeBotApi
+from migrations import migrate
+from notifications import check_inactive_users, check_new_books, check_unfinished_books
+from outbox import send_outbox
+from seed import BOT_TABLES, seed
+
+JOB_SCENARIOS = {
+    'inactive_users': check_inactive_users,
+    'unfinished_books': check_unfinished_books,
+    'new_books': check_new_books,
+}
+SCENARIOS = list(JOB_SCENARIOS) + ['webhook']
+
+# Time allowed for the webhook handlers to reply to every posted update
+WEBHOOK_SETTLE_TIMEOUT = 120
+
+class QueryCounter:
+    """Counts statements sent through psycopg cursors, server-side ones included."""
+
+    def __init__(self):
+        self.count = 0
+
+    def install(self) -> None:
+        for cls in (psycopg.AsyncCursor, psycopg.AsyncServerCursor, psycopg.Cursor):
+            self._wrap(cls, 'execute', 1)
+            self._wrap(cls, 'executemany', None)
+
+    def _wrap(self, cls, name: str, per_call):
+        original = getattr(cls, name)
+        counter = self
+
+        if asyncio.iscoroutinefunction(original):
+            async def wrapper(self, query, params=None, *args, **kwargs):
+                params = counter._add(per_call, query, params)
+                return await original(self, query, params, *args, **kwargs)
+        else:
+            def wrapper(self, query, params=None, *args, **kwargs):
+                params = counter._add(per_call, query, params)
+                return original(self, query, params, *args, **kwargs)
+
+        setattr(cls, name, wrapper)
+
+    def _add(self, per_call, query, params):
+        # executemany() runs the statement once per parameter set
+        if per_call is None:
+            params = list(params)
+            self.count += len(params)
+        else:
+            self.count += per_call
+        return params
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BOT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+async def reset_state() -> None:
+    """Empty the tables the bot writes, so every scenario starts from the same state."""
+    async with get_pool().connection() as conn:
+        await conn.execute('TRUNCATE ' + ', '.join(f'"{table}"' for table in BOT_TABLES))
+    media_cache._file_ids.clear()
+    media_cache._uploads.clear()
+
+async def run_job(job) -> None:
+    await job(None)
+    await flush_digests()
+    await send_outbox()
+
+def run_webhook(api: FakeBotApi, updates: int) -> None:
+    os.environ['TELEGRAM_API_URL'] = api.base_url
+    sys.path.insert(0, str(BOT_DIR / 'api'))
+    import webhook
+
+    client = webhook.app.test_client()
+    inline_replies = 0
+    for i in range(updates):
+        chat_id = 100000000 + i
+        response = client.post('/webhook', json={
+            'update_id': i + 1,
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': f'User {i}'},
+                'text': '/start',
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+            }
+        })
+        body = response.get_json(silent=True) or {}
+        if response.status_code != 200 or body.get('status') == 'error':
+            # Waiting for replies that will never come would only hide the failure
+            raise SystemExit(f"Webhook failed on update {i + 1}: HTTP {response.status_code} {body}")
+
+        # Replies returned in the webhook response never reach the fake API
+        if 'method' in body:
+            inline_replies += 1
+
+    # Replies that missed the response deadline are sent later, so wait for them
+    deadline = time.monotonic() + WEBHOOK_SETTLE_TIMEOUT
+    while api.messages_sent + inline_replies < updates and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+async def run_jobs(scenarios, api: FakeBotApi, queries: QueryCounter) -> dict:
+    await init_pool()
+    await migrate()
+
+    bot = Bot(
+        os.environ['BOT_TOKEN'],
+        base_url=api.base_url,
+        request=HTTPXRequest(connection_pool_size=DISPATCH_WORKERS + 4)
+    )
+    await bot.initialize()
+    await init_dispatcher(bot)
+
+    results = {}
+    try:
+        for name in scenarios:
+            await reset_state()
+            api.reset()
+            queries.count = 0
+            started = time.perf_counter()
+            await run_job(JOB_SCENARIOS[name])
+            results[name] = report_scenario(name, time.perf_counter() - started, api, queries)
+    finally:
+        await close_dispatcher()
+        await bot.shutdown()
+        await close_pool()
+    return results
+
+def report_scenario(name: str, elapsed: float, api: FakeBotApi, queries: QueryCounter) -> dict:
+    messages = api.messages_sent
+    result = {
+        'wall_time_s': round(elapsed, 3),
+        'queries': queries.count,
+        'messages': messages,
+        'messages_per_s': round(messages / elapsed, 1) if elapsed > 0 else 0.0,
+        'rate_limited': api.rate_limited,
+        'api_calls': dict(api.calls),
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+    print(f"{name:>18}: {elapsed:8.2f}s  {queries.count:7d} queries  "
+          f"{messages:7d} messages  {result['messages_per_s']:8.1f} msg/s  "
+          f"{result['peak_rss_mb']:7.1f} MB")
+    return result
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the bot's notification jobs and webhook.")
+    parser.add_argument('--scale', type=int, default=10000, help="users to seed (books are a tenth of that)")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument('--webhook-updates', type=int, default=1000, help="updates posted in the webhook scenario")
+    parser.add_argument('--latency-ms', type=float, default=0, help="fake Bot API response latency")
+    parser.add_argument('--rate-limit-every', type=int, default=0, help="answer every Nth send with a 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after of the simulated 429s")
+    parser.add_argument('--skip-seed', action='store_true', help="reuse the database seeded by a previous run")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    if not args.skip_seed:
+        started = time.perf_counter()
+        counts = seed(args.scale)
+        print(f"Seeded {counts['User']} users and {counts['Book']} books in {time.perf_counter() - started:.1f}s")
+
+    queries = QueryCounter()
+    queries.install()
+    api = FakeBotApi(args.latency_ms, args.rate_limit_every, args.retry_after).start()
+
+    results = {}
+    try:
+        jobs = [name for name in scenarios if name in JOB_SCENARIOS]
+        if jobs:
+            results.update(asyncio.run(run_jobs(jobs, api, queries)))
+        if 'webhook' in scenarios:
+            api.reset()
+            queries.count = 0
+            started = time.perf_counter()
+            run_webhook(api, args.webhook_updates)
+            results['webhook'] = report_scenario('webhook', time.perf_counter() - started, api, queries)
+    finally:
+        api.stop()
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'settings': {
+            'scale': args.scale,
+            'webhook_updates': args.webhook_updates,
+            'latency_ms': args.latency_ms,
+            'rate_limit_every': args.rate_limit_every,
+            'retry_after': args.retry_after
+        },
+        'scenarios': results
+    }
+
+    if args.output:
+        output = Path(args.output)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+        print(f"Results written to {output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Create and fill a throwaway database for the notification benchmarks.
+
+The tables come from the backend's Prisma migration so the bot's quoted
+identifiers match production. "User"."lastActiveAt" is not part of that
+migration yet and is added here.
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+import psycopg
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from db import _conninfo
+
+MIGRATIONS_DIR = Path(__file__).resolve().parents[2] / 'backend' / 'prisma' / 'migrations'
+
+APP_TABLES = [
+    '_BookToGenre', 'NotificationSettings', 'ReadingProgress', 'Purchase',
+    'Favorite', 'Genre', 'Book', 'User'
+]
+
+BOT_TABLES = [
+    'TelegramMediaCache', 'BotCheckpoint', 'UserGenreAffinity', 'NotificationLedger',
+    'NotificationDigestItem', 'NotificationDigestState', 'UserDeliverySlot', 'NotificationOutbox',
+    'UnreachableChat'
+]
+
+# Applied migrations; dropped with the tables so their indexes are built again
+MIGRATION_TABLE = 'BotSchemaMigration'
+
+GENRES = [
+    'Детектив', 'Фантастика', 'Фэнтези', 'Роман', 'Триллер', 'Ужасы', 'Приключения',
+    'Классика', 'Поэзия', 'Биография', 'История', 'Психология', 'Бизнес', 'Наука',
+    'Философия', 'Юмор', 'Драма', 'Мистика', 'Комиксы', 'Детская литература'
+]
+
+# Rows generated per user at scale 1
+BOOKS_PER_USER = 0.1
+FAVORITES_PER_USER = 3
+READING_PER_USER = 2
+PURCHASES_PER_USER = 1
+
+SEED_STATEMENTS = [
+    """
+    INSERT INTO "Genre" (id, name)
+    SELECT 'genre-' || i, name
+    FROM unnest(%(genres)s::text[]) WITH ORDINALITY AS g(name, i)
+    """,
+    # A third of the books were added within the last day, the rest up to a month ago
+    """
+    INSERT INTO "Book" (id, title, author, description, "coverUrl", "pdfUrl", price, "isFree", "pageCount", "createdAt")
+    SELECT 'book-' || i, 'Книга ' || i, 'Автор ' || (i %% 500), '',
+           'https://covers.example/' || i || '.jpg', 'https://pdf.example/' || i || '.pdf',
+           CASE WHEN i %% 5 = 0 THEN 0 ELSE 299 + i %% 700 END, i %% 5 = 0, 100 + i %% 400,
+           CASE WHEN i %% 3 = 0
+                THEN LOCALTIMESTAMP - interval '1 minute' * (2 + i %% 1400)
+                ELSE LOCALTIMESTAMP - interval '1 day' * (1 + i %% 30) END
+    FROM generate_series(1, %(books)s) AS i
+    """,
+    """
+    INSERT INTO "_BookToGenre" ("A", "B")
+    SELECT DISTINCT 'book-' || i, 'genre-' || (1 + (i * k) %% %(genre_count)s)
+    FROM generate_series(1, %(books)s) AS i, generate_series(1, 2) AS k
+    """,
+    # Everyone is linked to Telegram and has been away for three to four days
+    """
+    INSERT INTO "User" (id, email, name, telegram_id, "lastActiveAt")
+    SELECT 'user-' || i, 'user' || i || '@bench.example', 'User ' || i, (100000000 + i)::text,
+           LOCALTIMESTAMP - interval '3 days' - interval '1 minute' * (1 + i %% 1200)
+    FROM generate_series(1, %(users)s) AS i
+    """,
+    """
+    INSERT INTO "NotificationSettings" (id, "userId", frequency)
+    SELECT 'settings-' || i, 'user-' || i, (ARRAY['daily', '3days', 'weekly'])[1 + i %% 3]
+    FROM generate_series(1, %(users)s) AS i
+    """,
+    # Favorites and purchases were made over the last month, a few every minute
+    """
+    INSERT INTO "Favorite" (id, "userId", "bookId", "createdAt")
+    SELECT DISTINCT ON (u, b) 'fav-' || u || '-' || k, 'user-' || u, 'book-' || b,
+           LOCALTIMESTAMP - interval '1 minute' * (1 + (u * 7 + k) %% 43200)
+    FROM generate_series(1, %(users)s) AS u,
+         generate_series(1, %(favorites)s) AS k,
+         LATERAL (SELECT 1 + (u * 7 + k * 13) %% %(books)s AS b) pick
+    """,
+    # Stalled a week ago, somewhere in the middle of the book
+    """
+    INSERT INTO "ReadingProgress" (id, "userId", "bookId", "currentPage", progress, "lastReadAt")
+    SELECT DISTINCT ON (u, b) 'rp-' || u || '-' || k, 'user-' || u, 'book-' || b,
+           10 + (u + k) %% 80, 11 + (u * k) %% 88,
+           LOCALTIMESTAMP - interval '7 days' - interval '1 minute' * (1 + (u + k) %% 1200)
+    FROM generate_series(1, %(users)s) AS u,
+         generate_series(1, %(reading)s) AS k,
+         LATERAL (SELECT 1 + (u * 11 + k * 17) %% %(books)s AS b) pick
+    """,
+    """
+    INSERT INTO "Purchase" (id, "userId", "bookId", amount, "paymentMethod", status, "createdAt")
+    SELECT 'purchase-' || u || '-' || k, 'user-' || u, 'book-' || (1 + (u * 19 + k) %% %(books)s),
+           299, 'card', 'completed', LOCALTIMESTAMP - interval '1 minute' * (1 + (u * 19 + k) %% 43200)
+    FROM generate_series(1, %(users)s) AS u, generate_series(1, %(purchases)s) AS k
+    """,
+]
+
+def _migration_sql() -> str:
+    return '\n'.join(path.read_text() for path in sorted(MIGRATIONS_DIR.glob('*/migration.sql')))
+
+def _check_database(conn, force: bool) -> None:
+    dbname = conn.info.dbname
+    if 'bench' not in dbname and not force:
+        raise SystemExit(
+            f"Refusing to reset database {dbname!r}: its name does not contain 'bench'. "
+            f"Point DB_NAME at a throwaway database or pass --force."
+        )
+
+def seed(users: int, force: bool = False) -> dict:
+    """Recreate the app tables and fill them for `users` users. Returns the row counts."""
+    books = max(1, int(users * BOOKS_PER_USER))
+    params = {
+        'users': users,
+        'books': books,
+        'genres': GENRES,
+        'genre_count': len(GENRES),
+        'favorites': FAVORITES_PER_USER,
+        'reading': READING_PER_USER,
+        'purchases': PURCHASES_PER_USER
+    }
+
+    with psycopg.connect(_conninfo()) as conn:
+        _check_database(conn, force)
+
+        for table in APP_TABLES + BOT_TABLES + [MIGRATION_TABLE]:
+            conn.execute(f'DROP TABLE IF EXISTS "{table}" CASCADE')
+        conn.execute(_migration_sql())
+        conn.execute('ALTER TABLE "User" ADD COLUMN "lastActiveAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP')
+
+        for statement in SEED_STATEMENTS:
+            conn.execute(statement, params)
+
+        counts = {}
+        for table in APP_TABLES:
+            counts[table] = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+        conn.execute('ANALYZE')
+
+    return counts
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000, help="number of Telegram users to create")
+    parser.add_argument('--force', action='store_true', help="allow a database whose name lacks 'bench'")
+    args = parser.parse_args()
+
+    counts = seed(args.users, force=args.force)
+    for table, count in counts.items():
+        print(f"{table:>22}: {count}")
+
+if __name__ == '__main__':
+    os.environ.setdefault('DB_NAME', 'bookly_bench')
+    main()
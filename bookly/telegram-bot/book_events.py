@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+from typing import Iterable, Optional, Set
+
+from catalog_index import get_catalog
+from db import connect, get_pool
+from metrics import NEW_BOOK_EVENTS, job_run
+from notifications import check_new_books, queue_new_book_targets
+from migrations import FEATURE_NEW_BOOK_EVENTS, migrate
+from schema import NEW_BOOK_CHANNEL
+from sharding import Shard
+
+logger = logging.getLogger(__name__)
+
+# Event-driven new-book notifications; the 6-hourly check_new_books stays as a fallback
+NEW_BOOK_EVENTS_ENABLED = os.getenv('NEW_BOOK_EVENTS', 'false').lower() == 'true'
+
+# A batch is processed once no new book arrived for NEW_BOOK_DEBOUNCE seconds,
+# or NEW_BOOK_MAX_DELAY seconds after its first book during a long import
+NEW_BOOK_DEBOUNCE = float(os.getenv('NEW_BOOK_DEBOUNCE_SECONDS', '5'))
+NEW_BOOK_MAX_DELAY = float(os.getenv('NEW_BOOK_MAX_DELAY_SECONDS', '60'))
+
+# Books resolved to targets per query
+NEW_BOOK_BATCH_SIZE = 500
+
+# One replica listens at a time; the others stand by on this lock
+LISTENER_LOCK_KEY = "hashtext('new_book_listener')"
+LISTENER_RETRY_DELAY = 30
+RECONNECT_DELAY = 5
+
+# Every user, for the single process holding the listener lock
+ALL_USERS = Shard(0, 1)
+
+class NewBookListener:
+    """
+    Holds one LISTEN connection for new-book events and turns them into
+    debounced batches of targets queued for the next digests.
+    """
+
+    def __init__(self, debounce: float = NEW_BOOK_DEBOUNCE, max_delay: float = NEW_BOOK_MAX_DELAY):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._pending: Set[str] = set()
+        self._catch_up = False
+        self._wake = asyncio.Event()
+        self._tasks = []
+
+    async def start(self) -> None:
+        await migrate(features=[FEATURE_NEW_BOOK_EVENTS])
+        self._tasks = [
+            asyncio.create_task(self._listen(), name='new-book-listener'),
+            asyncio.create_task(self._batches(), name='new-book-batches')
+        ]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def add(self, book_ids: Iterable[str]) -> None:
+        book_ids = [book_id for book_id in book_ids if book_id]
+        NEW_BOOK_EVENTS.inc(len(book_ids))
+        self._pending.update(book_ids)
+        self._wake.set()
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                if not await self._listen_once():
+                    # Another replica is listening; wait without holding a connection
+                    await asyncio.sleep(LISTENER_RETRY_DELAY)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"New book listener lost its connection: {e}")
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _listen_once(self) -> bool:
+        """Listen until the connection drops. Returns False if another replica holds the listener lock."""
+        # Outside the pool: the connection stays in LISTEN for the life of the process
+        async with await connect(autocommit=True) as conn:
+            cur = await conn.execute(f"SELECT pg_try_advisory_lock({LISTENER_LOCK_KEY})")
+            if not (await cur.fetchone())[0]:
+                return False
+
+            await conn.execute(f"LISTEN {NEW_BOOK_CHANNEL}")
+            logger.info(f"Listening for new books on {NEW_BOOK_CHANNEL}")
+
+            # Books added while nobody was listening are found by a regular scan
+            self._catch_up = True
+            self._wake.set()
+
+            async for notify in conn.notifies():
+                self.add(notify.payload.split(','))
+        return True
+
+    async def _batches(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wake.wait()
+
+            # Let a burst of imports settle into one batch
+            first_event = loop.time()
+            while True:
+                self._wake.clear()
+                remaining = first_event + self.max_delay - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._wake.wait(), min(self.debounce, remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            book_ids, self._pending = self._pending, set()
+            catch_up, self._catch_up = self._catch_up, False
+            try:
+                if catch_up:
+                    await check_new_books(None)
+                if book_ids:
+                    await process_new_books(book_ids)
+                    # Searchable right away instead of at the next catalog refresh
+                    catalog = get_catalog()
+                    if catalog:
+                        await catalog.add_books(book_ids)
+            except Exception as e:
+                logger.error(f"Error processing {len(book_ids)} new books: {e}")
+
+async def process_new_books(book_ids: Iterable[str]) -> None:
+    """
+    Queue notifications about `book_ids` for every interested user. Books
+    already announced, e.g. by the fallback scan, are skipped by the ledger.
+    """
+    book_ids = sorted(book_ids)
+    async with job_run('new_book_events'):
+        for i in range(0, len(book_ids), NEW_BOOK_BATCH_SIZE):
+            async with get_pool().connection() as conn:
+                await queue_new_book_targets(conn, book_ids[i:i + NEW_BOOK_BATCH_SIZE], ALL_USERS)
+    logger.info(f"Queued notifications for {len(book_ids)} new books")
+
+_listener: Optional[NewBookListener] = None
+
+async def start_new_book_listener() -> Optional[NewBookListener]:
+    """Start listening for new books if NEW_BOOK_EVENTS is enabled. Called once at startup."""
+    global _listener
+    if NEW_BOOK_EVENTS_ENABLED and _listener is None:
+        _listener = NewBookListener()
+        await _listener.start()
+    return _listener
+
+async def stop_new_book_listener() -> None:
+    global _listener
+    if _listener is None:
+        return
+
+    await _listener.stop()
+    _listener = None
@@ -1,9 +1,13 @@
 import logging
-from telegram import Update, WebAppInfo, KeyboardButton, ReplyKeyboardMarkup
+from telegram import (
+    Update, WebAppInfo, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup,
+    InlineQueryResultCachedPhoto, InlineQueryResultPhoto, InlineQueryResultsButton
+)
 from telegram.ext import (
     Application,
     CommandHandler,
     ContextTypes,
+    InlineQueryHandler,
     MessageHandler,
     filters
 )
@@ -13,6 +17,19 @@ import asyncio
 
 # Import scheduler
 from scheduler import setup_scheduler
+from db import init_pool, close_pool
+from dispatcher import (
+    INTERACTIVE_POOL_SIZE, InteractiveLaneLimiter, bulk_bot, close_dispatcher, init_dispatcher
+)
+from migrations import migrate
+from media_cache import cached_file_id, cover_key, load_media_cache
+from catalog_index import get_catalog, start_catalog, stop_catalog
+from book_events import start_new_book_listener, stop_new_book_listener
+from outbox import start_outbox_sender, stop_outbox_sender
+from library_cache import library_reply, start_library_cache_listener, stop_library_cache_listener
+from reachability import mark_reachable
+from metrics import start_metrics_server, stop_metrics_server, timed_handler
+from templates import MINI_APP_URL, book_card, book_keyboard, mini_app_url
 
 # Load environment variables
 load_dotenv()
@@ -24,36 +41,73 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+
+# Reply keyboards are built once and shared by every reply
+LIBRARY_KEYBOARD = ReplyKeyboardMarkup.from_button(
+    KeyboardButton(text="📚 Открыть библиотеку", web_app=WebAppInfo(url=MINI_APP_URL))
+)
+MY_BOOKS_KEYBOARD = ReplyKeyboardMarkup.from_button(
+    KeyboardButton(text="📚 Мои книги", web_app=WebAppInfo(url=mini_app_url('/my-books')))
+)
+OPEN_BOOKLY_KEYBOARD = ReplyKeyboardMarkup.from_button(
+    KeyboardButton(text="📚 Открыть Bookly", web_app=WebAppInfo(url=MINI_APP_URL))
+)
+OPEN_LIBRARY_BUTTON = InlineQueryResultsButton(text="📚 Открыть библиотеку", web_app=WebAppInfo(url=MINI_APP_URL))
+
+# Inline search results per answer; Telegram accepts up to 50
+INLINE_RESULTS_LIMIT = 20
+
+# /start payload of the deep links in inline search results, followed by the book id
+BOOK_START_PREFIX = 'book_'
+
 # Command handlers
+@timed_handler('start')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Send a message when the command /start is issued."""
-    user = update.effective_user
-    await update.message.reply_html(
-        f'Привет, {user.mention_html()}! 👋\n\n'
-        f'Добро пожаловать в Bookly - телеграмм бот для онлайн-библиотеки. '
-        f'Через этого бота вы можете читать книги, добавлять их в избранное '
-        f'и покупать платные издания.\n\n'
-        f'Чтобы открыть приложение, нажмите кнопку "Открыть библиотеку" ниже.',
-        reply_markup=ReplyKeyboardMarkup.from_button(
-            KeyboardButton(
-                text="📚 Открыть библиотеку",
-                web_app=WebAppInfo(url=os.getenv('MINI_APP_URL', 'https://your-mini-app-url.com'))
-            )
+    """Greet the user, or open the book a deep link from inline search points to."""
+    payload = context.args[0] if context.args else ''
+    if payload.startswith(BOOK_START_PREFIX):
+        await update.message.reply_text(
+            'Откройте книгу в Bookly:',
+            reply_markup=book_keyboard(payload[len(BOOK_START_PREFIX):])
         )
-    )
+    else:
+        user = update.effective_user
+        await update.message.reply_html(
+            f'Привет, {user.mention_html()}! 👋\n\n'
+            f'Добро пожаловать в Bookly - телеграмм бот для онлайн-библиотеки. '
+            f'Через этого бота вы можете читать книги, добавлять их в избранное '
+            f'и покупать платные издания.\n\n'
+            f'Чтобы открыть приложение, нажмите кнопку "Открыть библиотеку" ниже.',
+            reply_markup=LIBRARY_KEYBOARD
+        )
+
+    # A user who unblocked the bot usually comes back through /start
+    try:
+        await mark_reachable(str(update.effective_chat.id))
+    except Exception as e:
+        logger.error(f"Error clearing unreachable state of chat {update.effective_chat.id}: {e}")
 
+@timed_handler('library')
 async def library(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Open the library Mini App."""
+    """List the books the user is reading, or just open the library Mini App."""
+    try:
+        cached = await library_reply(str(update.effective_chat.id))
+    except Exception as e:
+        logger.error(f"Error loading reading list of chat {update.effective_chat.id}: {e}")
+        cached = None
+
+    if cached:
+        text, keyboard = cached
+        await update.message.reply_text(text, reply_markup=keyboard)
+        return
+
     await update.message.reply_text(
         'Откройте вашу библиотеку в Mini App:',
-        reply_markup=ReplyKeyboardMarkup.from_button(
-            KeyboardButton(
-                text="📚 Мои книги",
-                web_app=WebAppInfo(url=f"{os.getenv('MINI_APP_URL', 'https://your-mini-app-url.com')}/my-books")
-            )
-        )
+        reply_markup=MY_BOOKS_KEYBOARD
     )
 
+@timed_handler('help')
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
     await update.message.reply_text(
@@ -66,42 +120,113 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         'которые открывают Mini App.'
     )
 
+@timed_handler('text')
 async def open_mini_app(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Open the main Mini App."""
     await update.message.reply_text(
         'Откройте Bookly:',
-        reply_markup=ReplyKeyboardMarkup.from_button(
-            KeyboardButton(
-                text="📚 Открыть Bookly",
-                web_app=WebAppInfo(url=os.getenv('MINI_APP_URL', 'https://your-mini-app-url.com'))
-            )
+        reply_markup=OPEN_BOOKLY_KEYBOARD
+    )
+
+def inline_result(book, bot_username: str):
+    """A search result showing the cover, as a cached file_id once it has been uploaded."""
+    caption = book_card(book.title, book.author, book.price)
+    keyboard = InlineKeyboardMarkup.from_button(
+        InlineKeyboardButton("📚 Открыть в Bookly", url=f"https://t.me/{bot_username}?start={BOOK_START_PREFIX}{book.id}")
+    )
+    description = ', '.join((book.author, *book.genres))
+    file_id = cached_file_id(cover_key(book.id), book.cover_url)
+    if file_id:
+        return InlineQueryResultCachedPhoto(
+            id=book.id, photo_file_id=file_id, title=book.title, description=description,
+            caption=caption, reply_markup=keyboard
         )
+    return InlineQueryResultPhoto(
+        id=book.id, photo_url=book.cover_url, thumbnail_url=book.cover_url, title=book.title,
+        description=description, caption=caption, reply_markup=keyboard
+    )
+
+@timed_handler('inline')
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Search the catalog from any chat with @bot <query>, without touching the database."""
+    query = update.inline_query
+    catalog = get_catalog()
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    books = catalog.index.search(query.query, INLINE_RESULTS_LIMIT, offset) if catalog else []
+    await query.answer(
+        [inline_result(book, context.bot.username) for book in books],
+        cache_time=60,
+        next_offset=str(offset + len(books)) if len(books) == INLINE_RESULTS_LIMIT else '',
+        button=OPEN_LIBRARY_BUTTON
     )
 
+async def post_init(application: Application) -> None:
+    """Open shared resources once the bot's event loop is running."""
+    await init_pool()
+    await migrate()
+    await load_media_cache()
+    await start_catalog()
+
+    # Notifications go out through a Bot of their own, in the bulk lane
+    bot = bulk_bot(application.bot.token, TELEGRAM_API_URL)
+    await bot.initialize()
+    application.bot_data['bulk_bot'] = bot
+    await init_dispatcher(bot)
+    start_metrics_server()
+    await start_outbox_sender()
+    await start_new_book_listener()
+    await start_library_cache_listener()
+
+    # Set up the scheduler for notifications
+    application.bot_data['scheduler'] = setup_scheduler(application)
+
+async def post_shutdown(application: Application) -> None:
+    """Release shared resources when the bot stops."""
+    scheduler = application.bot_data.get('scheduler')
+    if scheduler:
+        # Shut down the scheduler when the bot stops
+        scheduler.shutdown(wait=False)
+
+    await stop_catalog()
+    await stop_library_cache_listener()
+    await stop_new_book_listener()
+    await stop_outbox_sender()
+    await close_dispatcher()
+    bot = application.bot_data.get('bulk_bot')
+    if bot:
+        await bot.shutdown()
+    await close_pool()
+    stop_metrics_server()
+
 def main() -> None:
     """Start the bot."""
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(os.getenv('BOT_TOKEN')).build()
+    application = (
+        Application.builder()
+        .token(os.getenv('BOT_TOKEN'))
+        .base_url(TELEGRAM_API_URL)
+        # The Application's Bot only carries replies to users, in the
+        # interactive lane; notifications use the dispatcher's own Bot
+        .connection_pool_size(INTERACTIVE_POOL_SIZE)
+        .rate_limiter(InteractiveLaneLimiter())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # on different commands - answer in Telegram
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("library", library))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(InlineQueryHandler(inline_search))
 
     # Handle messages with "библиотека", "книги", "читать" keywords
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND, open_mini_app
     ))
 
-    # Set up the scheduler for notifications
-    scheduler = setup_scheduler(application)
-
     # Run the bot until the user presses Ctrl-C
-    try:
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
-    finally:
-        # Shut down the scheduler when the bot stops
-        scheduler.shutdown()
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,292 @@
+import asyncio
+import heapq
+import logging
+import os
+import re
+import sys
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from checkpoints import Checkpoint
+from db import db_now, get_pool
+from metrics import CATALOG_INDEX_BOOKS
+
+logger = logging.getLogger(__name__)
+
+# How often books added since the last load are indexed
+CATALOG_REFRESH_INTERVAL = int(os.getenv('CATALOG_REFRESH_SECONDS', '60'))
+
+# Books whose transaction may still be in flight are left for the next refresh
+CATALOG_SETTLE_MARGIN = timedelta(minutes=1)
+
+# Rows fetched per query while loading
+CATALOG_LOAD_BATCH_SIZE = 5000
+
+# Words matched by trigrams need at least this share of trigrams in common
+FUZZY_MIN_SIMILARITY = 0.4
+
+# Query words shorter than this are only matched as prefixes
+FUZZY_MIN_LENGTH = 3
+
+# Close spellings are only looked for when prefixes match fewer books
+FUZZY_MAX_PREFIX_MATCHES = 50
+
+# Prefix matches in the title rank above those in the author and genres
+FIELD_TITLE, FIELD_AUTHOR, FIELD_GENRE = range(3)
+FIELD_WEIGHTS = (3.0, 2.0, 1.0)
+
+_WORD_RE = re.compile(r'\w+')
+
+class CatalogBook(NamedTuple):
+    id: str
+    title: str
+    author: str
+    cover_url: str
+    price: Decimal
+    genres: Tuple[str, ...]
+
+def normalize(text: str) -> str:
+    return text.casefold().replace('ё', 'е')
+
+def words(text: str) -> List[str]:
+    return _WORD_RE.findall(normalize(text))
+
+def trigrams(word: str) -> set:
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class CatalogIndex:
+    """
+    Search index over the title, author and genres of every book.
+
+    Books live in slots of parallel lists. Each distinct word has an id
+    and a posting array of `slot << 2 | field` entries. Prefixes are
+    looked up in the sorted word list. Misspelled words are matched
+    through a trigram index over the vocabulary, which is much smaller
+    than the catalog. A re-indexed book takes a new slot and its old one
+    is marked dead.
+    """
+
+    def __init__(self):
+        self.books: List[CatalogBook] = []
+        self._alive = bytearray()
+        self._slots: Dict[str, int] = {}
+        self._word_ids: Dict[str, int] = {}
+        self._postings: List[array] = []
+        self._trigram_counts = array('B')
+        self._sorted_words: List[str] = []
+        self._trigrams: Dict[str, array] = defaultdict(lambda: array('I'))
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, book_id: str) -> bool:
+        return book_id in self._slots
+
+    def add(self, book: CatalogBook) -> None:
+        old = self._slots.get(book.id)
+        if old is not None:
+            self._alive[old] = 0
+
+        slot = len(self.books)
+        # Many books share authors and genres; keep one copy of each string
+        book = book._replace(author=sys.intern(book.author), genres=tuple(sys.intern(g) for g in book.genres))
+        self.books.append(book)
+        self._alive.append(1)
+        self._slots[book.id] = slot
+
+        fields = [(FIELD_TITLE, book.title), (FIELD_AUTHOR, book.author)]
+        fields.extend((FIELD_GENRE, genre) for genre in book.genres)
+        entries = set()
+        for field, text in fields:
+            for word in words(text):
+                entries.add((self._word_id(word), slot << 2 | field))
+        for word_id, entry in entries:
+            self._postings[word_id].append(entry)
+
+    def _word_id(self, word: str) -> int:
+        word_id = self._word_ids.get(word)
+        if word_id is None:
+            word_id = self._word_ids[word] = len(self._postings)
+            self._postings.append(array('I'))
+            insort(self._sorted_words, word)
+            word_trigrams = trigrams(word)
+            self._trigram_counts.append(min(len(word_trigrams), 255))
+            for trigram in word_trigrams:
+                self._trigrams[trigram].append(word_id)
+        return word_id
+
+    def search(self, query: str, limit: int, offset: int = 0) -> List[CatalogBook]:
+        """
+        Books matching every word of `query`, as a prefix of a word of the
+        book or a close spelling of one, best matches first. Newest books
+        first for an empty query.
+        """
+        query_words = words(query)
+        if not query_words:
+            slots = (slot for slot in range(len(self.books) - 1, -1, -1) if self._alive[slot])
+            found = []
+            for slot in slots:
+                if len(found) == offset + limit:
+                    break
+                found.append(self.books[slot])
+            return found[offset:]
+
+        scores = None
+        # Scores add up over the query words; a book must match all of them
+        for word in query_words:
+            word_scores = self._match(word)
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = {slot: score + word_scores[slot] for slot, score in scores.items() if slot in word_scores}
+            if not scores:
+                return []
+
+        ranked = heapq.nlargest(offset + limit, scores, key=lambda slot: (scores[slot], slot))
+        return [self.books[slot] for slot in ranked[offset:]]
+
+    def _match(self, word: str) -> Dict[int, float]:
+        """slot -> best score of `word` within the book."""
+        matches: Dict[int, float] = {}
+
+        def collect(word_id: int, similarity: float) -> None:
+            for entry in self._postings[word_id]:
+                slot = entry >> 2
+                if not self._alive[slot]:
+                    continue
+                score = FIELD_WEIGHTS[entry & 3] * similarity
+                if score > matches.get(slot, 0.0):
+                    matches[slot] = score
+
+        start = bisect_left(self._sorted_words, word)
+        for candidate in self._sorted_words[start:]:
+            if not candidate.startswith(word):
+                break
+            collect(self._word_ids[candidate], 1.0)
+
+        if len(word) >= FUZZY_MIN_LENGTH and len(matches) < FUZZY_MAX_PREFIX_MATCHES:
+            query_trigrams = trigrams(word)
+            shared: Dict[int, int] = defaultdict(int)
+            for trigram in query_trigrams:
+                for word_id in self._trigrams.get(trigram, ()):
+                    shared[word_id] += 1
+            for word_id, count in shared.items():
+                similarity = count / (len(query_trigrams) + self._trigram_counts[word_id] - count)
+                if similarity >= FUZZY_MIN_SIMILARITY:
+                    # Below any exact prefix match of the same field
+                    collect(word_id, similarity * 0.9)
+
+        return matches
+
+# Books with the names of their genres, for a WHERE clause and what follows it
+BOOKS_QUERY = """
+    SELECT b.id, b.title, b.author, b."coverUrl", b.price, b."createdAt",
+        COALESCE(array_agg(g.name ORDER BY g.name) FILTER (WHERE g.name IS NOT NULL), '{{}}')
+    FROM "Book" b
+    LEFT JOIN "_BookToGenre" btg ON btg."A" = b.id
+    LEFT JOIN "Genre" g ON g.id = btg."B"
+    WHERE {where}
+    GROUP BY b.id
+    {tail}
+"""
+
+async def load_books(conn, where: str, params: dict, tail: str = '') -> List[Tuple[CatalogBook, datetime]]:
+    """(book, createdAt) of the books matching `where`."""
+    cur = await conn.execute(BOOKS_QUERY.format(where=where, tail=tail), params)
+    return [
+        (CatalogBook(book_id, title, author, cover_url, price, tuple(genres)), created_at)
+        for book_id, title, author, cover_url, price, created_at, genres in await cur.fetchall()
+    ]
+
+class Catalog:
+    """
+    The index of every process, loaded at startup and kept up to date by
+    indexing books created since the last refresh, or named by new-book
+    events.
+    """
+
+    def __init__(self, refresh_interval: int = CATALOG_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.index = CatalogIndex()
+        self.checkpoint = Checkpoint(datetime.min)
+        self._task = None
+
+    async def start(self) -> None:
+        await self.refresh()
+        logger.info(f"Indexed {len(self.index)} books for inline search")
+        self._task = asyncio.create_task(self._refresh_periodically(), name='catalog-refresh')
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def refresh(self) -> None:
+        """Index the books created since the last refresh."""
+        async with get_pool().connection() as conn:
+            settled = await db_now(conn) - CATALOG_SETTLE_MARGIN
+            while True:
+                books = await load_books(conn, """
+                    b."createdAt" <= %(settled)s
+                    AND (b."createdAt", b.id) > (%(after_ts)s, %(after_id)s)
+                """, {
+                    'settled': settled,
+                    'after_ts': self.checkpoint.position,
+                    'after_id': self.checkpoint.last_id,
+                    'limit': CATALOG_LOAD_BATCH_SIZE
+                }, 'ORDER BY b."createdAt", b.id LIMIT %(limit)s')
+                for book, _ in books:
+                    # Books from new-book events are indexed already
+                    if book.id not in self.index:
+                        self.index.add(book)
+                if books:
+                    last, created_at = books[-1]
+                    self.checkpoint = Checkpoint(created_at, last.id)
+                if len(books) < CATALOG_LOAD_BATCH_SIZE:
+                    break
+        CATALOG_INDEX_BOOKS.set(len(self.index))
+
+    async def add_books(self, book_ids: Iterable[str]) -> None:
+        """(Re)index `book_ids` right away, e.g. when a new-book event names them."""
+        async with get_pool().connection() as conn:
+            books = await load_books(conn, 'b.id = ANY(%(ids)s)', {'ids': list(book_ids)}, 'ORDER BY b."createdAt", b.id')
+        for book, _ in books:
+            self.index.add(book)
+        CATALOG_INDEX_BOOKS.set(len(self.index))
+
+    async def _refresh_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing the catalog index: {e}")
+
+_catalog: Optional[Catalog] = None
+
+def get_catalog() -> Optional[Catalog]:
+    """The catalog started by start_catalog(), None before."""
+    return _catalog
+
+async def start_catalog() -> Catalog:
+    """Load the catalog index. Called once at startup."""
+    global _catalog
+    if _catalog is None:
+        _catalog = Catalog()
+        await _catalog.start()
+    return _catalog
+
+async def stop_catalog() -> None:
+    global _catalog
+    if _catalog is None:
+        return
+
+    await _catalog.stop()
+    _catalog = None
@@ -0,0 +1,32 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+# Rows newer than this may still belong to uncommitted transactions
+JOB_SETTLE_MARGIN = timedelta(minutes=1)
+
+@dataclass
+class Checkpoint:
+    """Position of the last processed row: its timestamp plus id as tiebreaker."""
+    position: datetime
+    last_id: str = ''
+
+async def get_checkpoint(conn, name: str) -> Optional[Checkpoint]:
+    """Return the saved checkpoint for `name`, or None if it never ran."""
+    cur = await conn.execute(
+        'SELECT "position", "lastId" FROM "BotCheckpoint" WHERE "name" = %s',
+        (name,)
+    )
+    row = await cur.fetchone()
+    return Checkpoint(row[0], row[1]) if row else None
+
+async def save_checkpoint(conn, name: str, checkpoint: Checkpoint) -> None:
+    """Persist `checkpoint` for `name` as part of the caller's transaction."""
+    await conn.execute("""
+        INSERT INTO "BotCheckpoint" ("name", "position", "lastId", "updatedAt")
+        VALUES (%s, %s, %s, LOCALTIMESTAMP)
+        ON CONFLICT ("name") DO UPDATE
+        SET "position" = EXCLUDED."position",
+            "lastId" = EXCLUDED."lastId",
+            "updatedAt" = EXCLUDED."updatedAt"
+    """, (name, checkpoint.position, checkpoint.last_id))
@@ -0,0 +1,128 @@
+import logging
+import os
+import time
+from datetime import datetime
+
+from psycopg import AsyncConnection, AsyncCursor, AsyncServerCursor
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+
+from metrics import DB_ROUND_TRIPS, DB_STATEMENT_DURATION, statement_label
+
+logger = logging.getLogger(__name__)
+
+# Pool sizing and per-statement limits
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '30000'))
+
+# Number of executions after which a query is prepared server-side.
+# Set to "off" when running behind a transaction-mode pgbouncer.
+DB_PREPARE_THRESHOLD = os.getenv('DB_PREPARE_THRESHOLD', '5')
+
+_pool = None
+
+class TimedCursor(AsyncCursor):
+    """Cursor recording the duration and round trips of every statement."""
+
+    async def execute(self, query, params=None, **kwargs):
+        label = statement_label(str(query))
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            DB_STATEMENT_DURATION.observe(time.perf_counter() - started, statement=label)
+            DB_ROUND_TRIPS.inc(statement=label)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        label = statement_label(str(query))
+        started = time.perf_counter()
+        try:
+            return await super().executemany(query, params_seq, **kwargs)
+        finally:
+            # Pipelined, so a single round trip however many parameter sets
+            DB_STATEMENT_DURATION.observe(time.perf_counter() - started, statement=label)
+            DB_ROUND_TRIPS.inc(statement=label)
+
+class TimedServerCursor(AsyncServerCursor):
+    """Named cursor that also counts each fetch, since every one goes to the server."""
+
+    async def execute(self, query, params=None, **kwargs):
+        self._label = statement_label(str(query))
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            DB_STATEMENT_DURATION.observe(time.perf_counter() - started, statement=self._label)
+            DB_ROUND_TRIPS.inc(statement=self._label)
+
+    async def fetchmany(self, size: int = 0):
+        started = time.perf_counter()
+        try:
+            return await super().fetchmany(size)
+        finally:
+            label = getattr(self, '_label', 'FETCH')
+            DB_STATEMENT_DURATION.observe(time.perf_counter() - started, statement=label)
+            DB_ROUND_TRIPS.inc(statement=label)
+
+async def _configure(conn) -> None:
+    conn.server_cursor_factory = TimedServerCursor
+
+def _conninfo() -> str:
+    return make_conninfo(
+        host=os.getenv('DB_HOST', 'localhost'),
+        dbname=os.getenv('DB_NAME', 'bookly'),
+        user=os.getenv('DB_USER', 'postgres'),
+        password=os.getenv('DB_PASSWORD', 'postgres'),
+        options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+        application_name='bookly-bot'
+    )
+
+def _prepare_threshold():
+    if DB_PREPARE_THRESHOLD.lower() == 'off':
+        return None
+    return int(DB_PREPARE_THRESHOLD)
+
+async def init_pool() -> AsyncConnectionPool:
+    """Open the shared connection pool. Called once at startup."""
+    global _pool
+    if _pool is not None:
+        return _pool
+
+    _pool = AsyncConnectionPool(
+        _conninfo(),
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        kwargs={'prepare_threshold': _prepare_threshold(), 'cursor_factory': TimedCursor},
+        configure=_configure,
+        name='bookly-bot',
+        open=False
+    )
+    await _pool.open(wait=True)
+    logger.info(f"Database pool opened (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
+    return _pool
+
+async def close_pool() -> None:
+    """Close the shared connection pool. Called once on shutdown."""
+    global _pool
+    if _pool is None:
+        return
+
+    await _pool.close()
+    _pool = None
+    logger.info("Database pool closed")
+
+async def connect(**kwargs) -> AsyncConnection:
+    """Open a connection outside the pool, for sessions that live as long as the process."""
+    return await AsyncConnection.connect(_conninfo(), cursor_factory=TimedCursor, **kwargs)
+
+async def db_now(conn) -> datetime:
+    """Return the database clock, the one Prisma timestamps are written with."""
+    cur = await conn.execute("SELECT LOCALTIMESTAMP")
+    return (await cur.fetchone())[0]
+
+def get_pool() -> AsyncConnectionPool:
+    """Return the shared connection pool opened by init_pool()."""
+    if _pool is None:
+        raise RuntimeError("Database pool is not initialized, call init_pool() first")
+    return _pool
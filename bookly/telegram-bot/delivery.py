@@ -0,0 +1,66 @@
+import logging
+import os
+from datetime import timedelta
+
+from db import get_pool
+from metrics import job_run
+
+logger = logging.getLogger(__name__)
+
+# A digest goes out within this many minutes after the user's delivery slot.
+# Set to 1440 to deliver as soon as a digest is due, at any time of day.
+DELIVERY_WINDOW_MINUTES = int(os.getenv('DELIVERY_WINDOW_MINUTES', '180'))
+
+# Slot hour for users without any recorded activity, in database time
+DEFAULT_DELIVERY_HOUR = int(os.getenv('DEFAULT_DELIVERY_HOUR', '10'))
+
+# Items that waited this long are delivered even outside the user's window
+DELIVERY_MAX_HOLD = timedelta(hours=int(os.getenv('DELIVERY_MAX_HOLD_HOURS', '24')))
+
+MINUTES_PER_DAY = 24 * 60
+
+def slot_lateness(telegram_id: str, slot: str) -> str:
+    """
+    SQL expression for the minutes since the user's delivery slot today,
+    wrapping at midnight. `slot` is the "minuteOfDay" column, which may be
+    NULL for users without activity.
+    """
+    default_slot = f"{DEFAULT_DELIVERY_HOUR * 60} + mod(abs(hashtext({telegram_id})), 60)"
+    now = "(extract(hour FROM LOCALTIMESTAMP) * 60 + extract(minute FROM LOCALTIMESTAMP))::int"
+    return f"mod({now} - COALESCE({slot}, {default_slot}) + {MINUTES_PER_DAY}, {MINUTES_PER_DAY})"
+
+async def refresh_delivery_slots() -> int:
+    """
+    Recompute every user's delivery slot from the hour they are most often
+    active at, judging by lastActiveAt and the lastReadAt of each book they
+    read. Users are spread over the minutes of that hour by telegram_id,
+    so the load of a popular hour is spread evenly too. Timestamps are in
+    database time, so the slot follows the user's local habits without
+    knowing their timezone.
+    """
+    async with job_run('delivery_slots'), get_pool().connection() as conn:
+        cur = await conn.execute("""
+            WITH activity AS (
+                SELECT u.telegram_id, extract(hour FROM u."lastActiveAt")::int AS hour
+                FROM "User" u
+                WHERE u.telegram_id IS NOT NULL
+                UNION ALL
+                SELECT u.telegram_id, extract(hour FROM rp."lastReadAt")::int
+                FROM "ReadingProgress" rp
+                JOIN "User" u ON u.id = rp."userId"
+                WHERE u.telegram_id IS NOT NULL
+            ),
+            typical AS (
+                SELECT telegram_id, mode() WITHIN GROUP (ORDER BY hour) AS hour
+                FROM activity
+                GROUP BY telegram_id
+            )
+            INSERT INTO "UserDeliverySlot" ("telegramId", "minuteOfDay", "updatedAt")
+            SELECT telegram_id, hour * 60 + mod(abs(hashtext(telegram_id)), 60), LOCALTIMESTAMP
+            FROM typical
+            ON CONFLICT ("telegramId") DO UPDATE
+            SET "minuteOfDay" = EXCLUDED."minuteOfDay", "updatedAt" = EXCLUDED."updatedAt"
+            WHERE "UserDeliverySlot"."minuteOfDay" <> EXCLUDED."minuteOfDay"
+        """)
+    logger.info(f"Delivery slots refreshed: {cur.rowcount} users moved")
+    return cur.rowcount
@@ -0,0 +1,342 @@
+import logging
+import os
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import timedelta
+from functools import partial
+from typing import Dict, Iterable, List
+
+from psycopg.types.json import Jsonb
+from telegram import InputMediaPhoto
+
+from db import get_pool
+from delivery import DELIVERY_MAX_HOLD, DELIVERY_WINDOW_MINUTES, slot_lateness
+from dispatcher import OutboundMessage
+from ledger import KIND_INACTIVE, KIND_NEW_BOOK, KIND_UNFINISHED, LedgerBatch
+from media_cache import cover_key, forget_upload, photo_for, remember_photo
+from metrics import JOB_ROWS, NOTIFICATIONS_QUEUED, job_run
+from templates import (
+    SUMMARY_HEADER, SUMMARY_INACTIVE_LINE, SUMMARY_MORE_LINE, SUMMARY_NEW_BOOK_LINE, SUMMARY_UNFINISHED_LINE,
+    book_caption, book_keyboard, inactive_text, inline_keyboard, library_keyboard,
+    reader_keyboard, reader_row, unfinished_text, web_app_row
+)
+
+logger = logging.getLogger(__name__)
+
+# Pending items are held at least this long so notifications produced by
+# different jobs around the same time end up in one digest
+DIGEST_WINDOW = timedelta(minutes=int(os.getenv('DIGEST_WINDOW_MINUTES', '30')))
+
+# Users whose digests are rendered per flush round
+DIGEST_BATCH_SIZE = int(os.getenv('DIGEST_BATCH_SIZE', '500'))
+
+# flush_digests runs every DIGEST_FLUSH_INTERVAL_MINUTES and serves at most
+# DIGEST_MAX_USERS_PER_MINUTE users per minute of that interval (0: no limit).
+# Whoever is left over goes first in the next run.
+DIGEST_FLUSH_INTERVAL_MINUTES = 10
+DIGEST_MAX_USERS_PER_MINUTE = int(os.getenv('DIGEST_MAX_USERS_PER_MINUTE', '0'))
+
+# Minimum time between two digests, by NotificationSettings.frequency
+FREQUENCY_INTERVALS = {
+    'daily': timedelta(days=1),
+    '3days': timedelta(days=3),
+    'weekly': timedelta(days=7),
+}
+DEFAULT_FREQUENCY = '3days'
+
+# Telegram limits for a single media group
+MEDIA_GROUP_SIZE = 10
+
+# Continue-reading buttons shown in a combined digest
+MAX_READING_BUTTONS = 3
+
+# Lines listed in a summary message; the rest are only counted. Telegram
+# rejects texts longer than MESSAGE_MAX_LENGTH characters.
+SUMMARY_MAX_LINES = 20
+MESSAGE_MAX_LENGTH = 4096
+
+@dataclass
+class DigestItem:
+    """One pending notification. (telegram_id, subject, period) is its ledger key."""
+    kind: str
+    telegram_id: str
+    subject: str = ''
+    period: str = ''
+    payload: dict = field(default_factory=dict)
+
+    @property
+    def key(self):
+        return (self.telegram_id, self.subject, self.period)
+
+def render_inactive_reminder(user_id: int, genre: str, new_books_count: int) -> OutboundMessage:
+    """Build inactive user reminder."""
+    return OutboundMessage(
+        method='send_message',
+        chat_id=user_id,
+        kwargs={'text': inactive_text(genre, new_books_count), 'reply_markup': library_keyboard()},
+        description=f"inactive reminder to user {user_id}"
+    )
+
+def render_unfinished_reminder(user_id: int, book_title: str, book_id: str, progress: float) -> OutboundMessage:
+    """Build unfinished book reminder."""
+    return OutboundMessage(
+        method='send_message',
+        chat_id=user_id,
+        kwargs={'text': unfinished_text(book_title, round(progress)), 'reply_markup': reader_keyboard(book_id)},
+        description=f"unfinished reminder to user {user_id} for book {book_id}"
+    )
+
+async def render_new_book_notification(user_id: int, book: dict, genre: str) -> OutboundMessage:
+    """Build new book notification."""
+    # Reuse the file_id of an earlier upload instead of making Telegram
+    # fetch the cover from storage again for every recipient
+    key = cover_key(book['id'])
+    photo = await photo_for(key, book['coverUrl'])
+    uploading = photo == book['coverUrl']
+
+    return OutboundMessage(
+        method='send_photo',
+        chat_id=user_id,
+        kwargs={'photo': photo, 'caption': book_caption(book, genre), 'reply_markup': book_keyboard(book['id'])},
+        description=f"new book notification to user {user_id} for book {book['id']}",
+        on_sent=partial(remember_photo, key, book['coverUrl']) if uploading else None,
+        on_failed=partial(forget_upload, key) if uploading else None
+    )
+
+async def render_cover_group(user_id: int, items: List[DigestItem]) -> OutboundMessage:
+    """Build one media group announcing several new books."""
+    media = []
+    uploads = []
+    for item in items:
+        book = item.payload['book']
+        key = cover_key(book['id'])
+        photo = await photo_for(key, book['coverUrl'])
+        if photo == book['coverUrl']:
+            uploads.append((len(media), key, book['coverUrl']))
+        media.append(InputMediaPhoto(media=photo, caption=book_caption(book, item.payload['genre'])))
+
+    async def on_sent(messages):
+        for index, key, url in uploads:
+            await remember_photo(key, url, messages[index])
+
+    async def on_failed(error):
+        for _, key, _ in uploads:
+            await forget_upload(key, error)
+
+    return OutboundMessage(
+        method='send_media_group',
+        chat_id=user_id,
+        kwargs={'media': media},
+        description=f"{len(media)} new book covers to user {user_id}",
+        on_sent=on_sent if uploads else None,
+        on_failed=on_failed if uploads else None
+    )
+
+def summary_line(item: DigestItem) -> str:
+    payload = item.payload
+    if item.kind == KIND_INACTIVE:
+        return SUMMARY_INACTIVE_LINE.format(count=payload['new_books_count'], genre=payload['genre'])
+    if item.kind == KIND_UNFINISHED:
+        return SUMMARY_UNFINISHED_LINE.format(title=payload['title'], progress=payload['progress'])
+    book = payload['book']
+    return SUMMARY_NEW_BOOK_LINE.format(title=book['title'], author=book['author'], genre=payload['genre'])
+
+def summary_text(lines: List[str]) -> str:
+    """
+    The summary listing `lines` under the header. Past SUMMARY_MAX_LINES,
+    or where the text would outgrow MESSAGE_MAX_LENGTH, the remaining lines
+    are only counted.
+    """
+    shown = [SUMMARY_HEADER]
+    length = len(SUMMARY_HEADER)
+    for index, line in enumerate(lines):
+        remaining = len(lines) - index
+        # Room for the line, and for counting whatever follows it
+        more = len(SUMMARY_MORE_LINE.format(count=remaining)) + 2 if remaining > 1 else 0
+        if index == SUMMARY_MAX_LINES or length + 2 + len(line) + more > MESSAGE_MAX_LENGTH:
+            shown.append(SUMMARY_MORE_LINE.format(count=remaining))
+            break
+        shown.append(line)
+        length += 2 + len(line)
+    return '\n\n'.join(shown)
+
+def render_summary(user_id: int, items: List[DigestItem]) -> OutboundMessage:
+    """Build one text message listing several notifications."""
+    rows = [
+        reader_row(item.payload['title'], item.payload['book_id'])
+        for item in items if item.kind == KIND_UNFINISHED
+    ][:MAX_READING_BUTTONS]
+    rows.append(web_app_row('📖 Открыть библиотеку'))
+
+    return OutboundMessage(
+        method='send_message',
+        chat_id=user_id,
+        kwargs={'text': summary_text([summary_line(item) for item in items]), 'reply_markup': inline_keyboard(rows)},
+        description=f"digest of {len(items)} notifications to user {user_id}"
+    )
+
+def plan_digest(items: List[DigestItem]) -> List[List[DigestItem]]:
+    """
+    Split one user's pending items into the groups sent as one message each:
+    a single item is sent as its usual message, several new books become
+    one media group and everything else is folded into one summary message.
+    New books past the first media group join the summary, unless they are
+    all that is left and fit in a second media group.
+    """
+    new_books = [item for item in items if item.kind == KIND_NEW_BOOK]
+    if len(items) == 1 or len(new_books) < 2:
+        return [items]
+
+    covers = new_books[:MEDIA_GROUP_SIZE]
+    rest = [item for item in items if item not in covers]
+    return [covers, rest] if rest else [covers]
+
+async def render_message(telegram_id: str, items: List[DigestItem]) -> OutboundMessage:
+    """Render one group of items made by plan_digest()."""
+    user_id = int(telegram_id)
+    if len(items) == 1:
+        item = items[0]
+        payload = item.payload
+        if item.kind == KIND_INACTIVE:
+            return render_inactive_reminder(user_id, payload['genre'], payload['new_books_count'])
+        if item.kind == KIND_UNFINISHED:
+            return render_unfinished_reminder(user_id, payload['title'], payload['book_id'], payload['progress'])
+        return await render_new_book_notification(user_id, payload['book'], payload['genre'])
+
+    if len(items) <= MEDIA_GROUP_SIZE and all(item.kind == KIND_NEW_BOOK for item in items):
+        return await render_cover_group(user_id, items)
+    return render_summary(user_id, items)
+
+async def queue_items(items: Iterable[DigestItem], ledger: LedgerBatch) -> int:
+    """Store pending items for the next digest and mark their ledger keys queued."""
+    items = list(items)
+    if not items:
+        return 0
+
+    async with get_pool().connection() as conn:
+        async with conn.transaction():
+            cur = conn.cursor()
+            await cur.executemany("""
+                INSERT INTO "NotificationDigestItem" ("telegramId", "kind", "subject", "period", "payload")
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT ("telegramId", "kind", "subject", "period") DO NOTHING
+            """, [
+                (item.telegram_id, item.kind, item.subject, item.period, Jsonb(item.payload))
+                for item in items
+            ])
+            await ledger.mark_queued(conn, [item.key for item in items])
+
+    NOTIFICATIONS_QUEUED.inc(len(items), kind=ledger.kind)
+    return len(items)
+
+async def _take_due_items(conn, limit: int) -> Dict[str, List[DigestItem]]:
+    """
+    Remove and return the pending items of up to `limit` users whose digest
+    is due and who are inside their delivery window, latest slots first.
+    Runs as part of the caller's transaction.
+    """
+    intervals = ' '.join(
+        f"WHEN '{frequency}' THEN interval '{interval.days} days'"
+        for frequency, interval in FREQUENCY_INTERVALS.items()
+    )
+
+    cur = await conn.execute(f"""
+        WITH pending AS (
+            SELECT "telegramId", MIN("createdAt") AS first_at
+            FROM "NotificationDigestItem"
+            GROUP BY "telegramId"
+        ),
+        due AS (
+            SELECT p."telegramId"
+            FROM pending p
+            JOIN "User" u ON u.telegram_id = p."telegramId"
+            JOIN "NotificationSettings" ns ON ns."userId" = u.id
+            LEFT JOIN "NotificationDigestState" ds ON ds."telegramId" = p."telegramId"
+            LEFT JOIN "UserDeliverySlot" s ON s."telegramId" = p."telegramId"
+            CROSS JOIN LATERAL (
+                SELECT {slot_lateness('p."telegramId"', 's."minuteOfDay"')} AS minutes
+            ) late
+            WHERE p.first_at <= LOCALTIMESTAMP - %(window)s
+            AND (
+                ds."lastSentAt" IS NULL
+                OR ds."lastSentAt" <= LOCALTIMESTAMP - CASE ns.frequency {intervals}
+                    ELSE interval '{FREQUENCY_INTERVALS[DEFAULT_FREQUENCY].days} days' END
+            )
+            AND (late.minutes < %(delivery_window)s OR p.first_at <= LOCALTIMESTAMP - %(max_hold)s)
+            ORDER BY late.minutes DESC
+            LIMIT %(limit)s
+        )
+        DELETE FROM "NotificationDigestItem" i
+        USING due
+        WHERE i."telegramId" = due."telegramId"
+        RETURNING i."telegramId", i."kind", i."subject", i."period", i."payload"
+    """, {
+        'window': DIGEST_WINDOW,
+        'delivery_window': DELIVERY_WINDOW_MINUTES,
+        'max_hold': DELIVERY_MAX_HOLD,
+        'limit': limit
+    })
+
+    due = defaultdict(list)
+    for telegram_id, kind, subject, period, payload in await cur.fetchall():
+        due[telegram_id].append(DigestItem(kind, telegram_id, subject, period, payload))
+
+    if due:
+        await conn.execute("""
+            INSERT INTO "NotificationDigestState" ("telegramId", "lastSentAt")
+            SELECT unnest(%s::text[]), LOCALTIMESTAMP
+            ON CONFLICT ("telegramId") DO UPDATE SET "lastSentAt" = EXCLUDED."lastSentAt"
+        """, (list(due),))
+
+    return due
+
+async def _add_to_outbox(conn, due: Dict[str, List[DigestItem]]) -> int:
+    rows = [
+        (telegram_id, Jsonb([
+            {'kind': item.kind, 'subject': item.subject, 'period': item.period, 'payload': item.payload}
+            for item in group
+        ]))
+        for telegram_id, items in due.items()
+        for group in plan_digest(items)
+    ]
+    if not rows:
+        return 0
+
+    cur = conn.cursor()
+    await cur.executemany(
+        'INSERT INTO "NotificationOutbox" ("telegramId", "items") VALUES (%s, %s)',
+        rows
+    )
+    return len(rows)
+
+async def flush_digests() -> int:
+    """
+    Move every digest that is due into the outbox, from where the outbox
+    sender delivers it. Taking the items and adding the messages happen in
+    one transaction, so a crash loses neither. Returns the number of users served.
+    """
+    budget = DIGEST_MAX_USERS_PER_MINUTE * DIGEST_FLUSH_INTERVAL_MINUTES or None
+    served = 0
+    try:
+        async with job_run('digest'):
+            while budget is None or budget > 0:
+                limit = DIGEST_BATCH_SIZE if budget is None else min(DIGEST_BATCH_SIZE, budget)
+                async with get_pool().connection() as conn:
+                    async with conn.transaction():
+                        due = await _take_due_items(conn, limit)
+                        await _add_to_outbox(conn, due)
+                if not due:
+                    break
+
+                JOB_ROWS.inc(sum(len(items) for items in due.values()), job='digest', stage='items')
+                served += len(due)
+                if len(due) < limit:
+                    break
+                if budget is not None:
+                    budget -= len(due)
+    except Exception as e:
+        logger.error(f"Error flushing notification digests: {e}")
+
+    if served:
+        logger.info(f"Queued notification digests for {served} users")
+    return served
@@ -0,0 +1,450 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional
+
+from telegram import Bot, Message
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+from telegram.request import HTTPXRequest
+
+from metrics import (
+    BOT_API_ERRORS, BOT_API_LATENCY, BOT_API_RETRIES, BOT_API_SENT, BULK_LANE_RATE, DISPATCH_QUEUE_DEPTH
+)
+
+logger = logging.getLogger(__name__)
+
+# Concurrency and Telegram flood limits (messages per second).
+# DISPATCH_GLOBAL_RATE is the most the bulk lane may use of TELEGRAM_GLOBAL_RATE;
+# the rest is reserved for replies to users.
+DISPATCH_WORKERS = int(os.getenv('DISPATCH_WORKERS', '8'))
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+DISPATCH_GLOBAL_RATE = float(os.getenv('DISPATCH_GLOBAL_RATE', '25'))
+DISPATCH_PER_CHAT_RATE = float(os.getenv('DISPATCH_PER_CHAT_RATE', '1'))
+DISPATCH_QUEUE_SIZE = int(os.getenv('DISPATCH_QUEUE_SIZE', '1000'))
+DISPATCH_MAX_RETRIES = int(os.getenv('DISPATCH_MAX_RETRIES', '5'))
+DISPATCH_BACKOFF_BASE = float(os.getenv('DISPATCH_BACKOFF_BASE', '0.5'))
+
+# Idle per-chat buckets are dropped once this many are tracked
+MAX_CHAT_BUCKETS = 10000
+CHAT_BUCKET_TTL = 60
+
+# Lanes of outbound traffic, each with its own Bot and connection pool
+LANE_INTERACTIVE = 'interactive'
+LANE_BULK = 'bulk'
+
+# Bulk sends slow down towards DISPATCH_MIN_RATE while replies to users take
+# longer than INTERACTIVE_LATENCY_TARGET on average, and speed back up to
+# DISPATCH_GLOBAL_RATE once they are fast again
+DISPATCH_MIN_RATE = float(os.getenv('DISPATCH_MIN_RATE', '2'))
+INTERACTIVE_LATENCY_TARGET = float(os.getenv('INTERACTIVE_LATENCY_TARGET_MS', '500')) / 1000
+LANE_ADJUST_INTERVAL = 1.0
+LANE_RATE_STEP = 1.0
+LATENCY_EWMA_ALPHA = 0.2
+
+# How long shutdown waits for queued messages. Outbox rows still undelivered
+# then are sent again once their lease runs out.
+DISPATCH_DRAIN_TIMEOUT = float(os.getenv('DISPATCH_DRAIN_TIMEOUT', '10'))
+
+# Connections of the interactive lane, i.e. the Application's own Bot
+INTERACTIVE_POOL_SIZE = int(os.getenv('INTERACTIVE_POOL_SIZE', '8'))
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second."""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = asyncio.get_running_loop().time()
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    @property
+    def idle_since(self) -> float:
+        return self._updated_at
+
+    def set_rate(self, rate: float) -> None:
+        self._refill(asyncio.get_running_loop().time())
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self._tokens = min(self._tokens, self.capacity)
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it."""
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            self._refill(loop.time())
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill(loop.time())
+            self._tokens -= 1
+
+class Lanes:
+    """
+    Shares the bot's flood-limit budget between replies to users and bulk
+    sends. Interactive calls only take a token from the global bucket, and
+    bulk sends wait while any interactive call is waiting for one. Bulk
+    sends also pass their own bucket, whose rate follows interactive
+    latency: halved while the average is over INTERACTIVE_LATENCY_TARGET,
+    raised by LANE_RATE_STEP per second while it is under.
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE,
+                 bulk_rate: float = DISPATCH_GLOBAL_RATE,
+                 min_bulk_rate: float = DISPATCH_MIN_RATE,
+                 latency_target: float = INTERACTIVE_LATENCY_TARGET):
+        self.max_bulk_rate = min(bulk_rate, global_rate)
+        self.min_bulk_rate = min(min_bulk_rate, self.max_bulk_rate)
+        self.latency_target = latency_target
+        self.interactive_latency = 0.0
+        self._global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self._bulk_bucket = TokenBucket(self.max_bulk_rate, capacity=self.max_bulk_rate)
+        self._interactive_waiting = 0
+        self._interactive_idle = asyncio.Event()
+        self._interactive_idle.set()
+        self._observed_at = 0.0
+        self._adjusted_at = 0.0
+        BULK_LANE_RATE.set(self.max_bulk_rate)
+
+    @property
+    def bulk_rate(self) -> float:
+        return self._bulk_bucket.rate
+
+    async def acquire(self, lane: str) -> None:
+        """Wait until `lane` may make one more call."""
+        if lane == LANE_INTERACTIVE:
+            self._interactive_waiting += 1
+            self._interactive_idle.clear()
+            try:
+                await self._global_bucket.acquire()
+            finally:
+                self._interactive_waiting -= 1
+                if not self._interactive_waiting:
+                    self._interactive_idle.set()
+            return
+
+        await self._bulk_bucket.acquire()
+        while self._interactive_waiting:
+            await self._interactive_idle.wait()
+        await self._global_bucket.acquire()
+        self._adjust()
+
+    def observe(self, lane: str, latency: float) -> None:
+        """Record the latency of a call made in `lane`."""
+        if lane != LANE_INTERACTIVE:
+            return
+        self.interactive_latency += LATENCY_EWMA_ALPHA * (latency - self.interactive_latency)
+        self._observed_at = asyncio.get_running_loop().time()
+        self._adjust()
+
+    def _adjust(self) -> None:
+        now = asyncio.get_running_loop().time()
+        if now - self._adjusted_at < LANE_ADJUST_INTERVAL:
+            return
+        self._adjusted_at = now
+
+        # Without replies to measure, nothing is held back
+        if now - self._observed_at > LANE_ADJUST_INTERVAL * 10:
+            self.interactive_latency = 0.0
+
+        if self.interactive_latency > self.latency_target:
+            rate = max(self.min_bulk_rate, self.bulk_rate / 2)
+        else:
+            rate = min(self.max_bulk_rate, self.bulk_rate + LANE_RATE_STEP)
+        if rate != self.bulk_rate:
+            self._bulk_bucket.set_rate(rate)
+            BULK_LANE_RATE.set(rate)
+
+class InteractiveLaneLimiter(BaseRateLimiter):
+    """
+    Rate limiter for the Application's Bot: puts the messages sent by
+    handlers in the interactive lane and reports their latency to it.
+    """
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        # Only messages count against the flood limit
+        if not endpoint.startswith(('send', 'copy', 'forward')):
+            return await callback(*args, **kwargs)
+
+        lanes = get_lanes()
+        await lanes.acquire(LANE_INTERACTIVE)
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            lanes.observe(LANE_INTERACTIVE, elapsed)
+            BOT_API_LATENCY.observe(elapsed, lane=LANE_INTERACTIVE, method=endpoint)
+
+@dataclass
+class OutboundMessage:
+    """A single Bot API call queued for delivery."""
+    method: str
+    chat_id: int
+    kwargs: dict = field(default_factory=dict)
+    description: str = ''
+    on_sent: Optional[Callable[[Message], Awaitable[None]]] = None
+    on_failed: Optional[Callable[[Exception], Awaitable[None]]] = None
+    # Asked right before every attempt; False drops the message without a callback
+    before_send: Optional[Callable[[], Awaitable[bool]]] = None
+
+@dataclass
+class DispatchStats:
+    sent: int = 0
+    failed: int = 0
+    retries: int = 0
+    started_at: Optional[float] = None
+
+class Dispatcher:
+    """Delivers outbound messages through a pool of rate-limited workers."""
+
+    def __init__(self, bot: Bot, workers: int = DISPATCH_WORKERS,
+                 lanes: Optional[Lanes] = None,
+                 per_chat_rate: float = DISPATCH_PER_CHAT_RATE,
+                 queue_size: int = DISPATCH_QUEUE_SIZE,
+                 max_retries: int = DISPATCH_MAX_RETRIES):
+        self.bot = bot
+        self.workers = workers
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+        self.stats = DispatchStats()
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self.lanes = lanes or get_lanes()
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._paused_until = 0.0
+        self._tasks = []
+
+    async def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"dispatcher-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info(f"Dispatcher started with {self.workers} workers")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("Dispatcher stopped")
+
+    async def submit(self, message: OutboundMessage) -> None:
+        """Queue a message, waiting if the queue is full."""
+        if self.stats.started_at is None:
+            self.stats.started_at = asyncio.get_running_loop().time()
+        await self._queue.put(message)
+        DISPATCH_QUEUE_DEPTH.set(self._queue.qsize())
+
+    @property
+    def backlog(self) -> int:
+        """Messages queued and not yet taken by a worker."""
+        return self._queue.qsize()
+
+    async def drain(self) -> DispatchStats:
+        """Wait for every queued message to be delivered and report throughput."""
+        await self._queue.join()
+
+        stats, self.stats = self.stats, DispatchStats()
+        if stats.started_at is not None:
+            elapsed = asyncio.get_running_loop().time() - stats.started_at
+            rate = stats.sent / elapsed if elapsed > 0 else 0.0
+            logger.info(
+                f"Dispatched {stats.sent} messages in {elapsed:.1f}s ({rate:.1f} msg/s), "
+                f"{stats.failed} failed, {stats.retries} retries"
+            )
+        return stats
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= MAX_CHAT_BUCKETS:
+                self._prune_chat_buckets()
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate)
+        return bucket
+
+    def _prune_chat_buckets(self) -> None:
+        cutoff = asyncio.get_running_loop().time() - CHAT_BUCKET_TTL
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if bucket.idle_since < cutoff:
+                del self._chat_buckets[chat_id]
+
+    async def _wait_if_paused(self) -> None:
+        delay = self._paused_until - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _worker(self) -> None:
+        while True:
+            message = await self._queue.get()
+            DISPATCH_QUEUE_DEPTH.set(self._queue.qsize())
+            try:
+                await self._deliver(message)
+            except Exception as e:
+                logger.error(f"Unexpected error delivering {message.description}: {e}")
+                await self._report_unexpected(message, e)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, message: OutboundMessage) -> None:
+        send = getattr(self.bot, message.method)
+        attempt = 0
+
+        while True:
+            await self._chat_bucket(message.chat_id).acquire()
+            await self._wait_if_paused()
+            await self.lanes.acquire(LANE_BULK)
+            if message.before_send and not await self._still_wanted(message):
+                return
+
+            try:
+                result = await self._call(send, message)
+            except RetryAfter as e:
+                # Flood control applies to the whole bot, so every worker backs off
+                delay = _seconds(e.retry_after)
+                loop = asyncio.get_running_loop()
+                self._paused_until = max(self._paused_until, loop.time() + delay)
+                logger.warning(f"Flood limit hit, pausing dispatch for {delay:.0f}s")
+                error = e
+            except BadRequest as e:
+                # BadRequest subclasses NetworkError but is never transient
+                await self._fail(message, e)
+                return
+            except NetworkError as e:
+                error = e
+            except TelegramError as e:
+                await self._fail(message, e)
+                return
+            else:
+                self.stats.sent += 1
+                logger.debug(f"Sent {message.description}")
+                if message.on_sent:
+                    try:
+                        await message.on_sent(result)
+                    except Exception as e:
+                        # Sent all the same; it must not be reported as failed
+                        logger.error(f"Error recording {message.description} as sent: {e}")
+                return
+
+            attempt += 1
+            if attempt > self.max_retries:
+                await self._fail(message, error)
+                return
+
+            self.stats.retries += 1
+            BOT_API_RETRIES.inc(method=message.method)
+            if not isinstance(error, RetryAfter):
+                backoff = DISPATCH_BACKOFF_BASE * 2 ** (attempt - 1)
+                await asyncio.sleep(backoff + random.uniform(0, backoff))
+
+    async def _report_unexpected(self, message: OutboundMessage, error: Exception) -> None:
+        # Whoever waits on the message, e.g. an upload of its photo, is released
+        if message.on_failed:
+            try:
+                await message.on_failed(error)
+            except Exception as e:
+                logger.error(f"Error reporting the failure of {message.description}: {e}")
+
+    async def _still_wanted(self, message: OutboundMessage) -> bool:
+        try:
+            wanted = await message.before_send()
+        except Exception as e:
+            logger.error(f"Error checking {message.description} before sending, dropping it: {e}")
+            return False
+        if not wanted:
+            logger.info(f"Dropped {message.description}, it is no longer wanted")
+        return wanted
+
+    async def _call(self, send, message: OutboundMessage):
+        started = time.perf_counter()
+        try:
+            result = await send(chat_id=message.chat_id, **message.kwargs)
+        except TelegramError as e:
+            BOT_API_ERRORS.inc(method=message.method, error=type(e).__name__)
+            raise
+        else:
+            BOT_API_SENT.inc(method=message.method)
+            return result
+        finally:
+            BOT_API_LATENCY.observe(time.perf_counter() - started, lane=LANE_BULK, method=message.method)
+
+    async def _fail(self, message: OutboundMessage, error: Exception) -> None:
+        self.stats.failed += 1
+        logger.error(f"Error sending {message.description}: {error}")
+        if message.on_failed:
+            await message.on_failed(error)
+
+def chain_callbacks(*callbacks):
+    """Combine several on_sent/on_failed callbacks into one, skipping None."""
+    callbacks = [callback for callback in callbacks if callback]
+    if len(callbacks) < 2:
+        return callbacks[0] if callbacks else None
+
+    async def chained(arg):
+        for callback in callbacks:
+            await callback(arg)
+    return chained
+
+def _seconds(value) -> float:
+    # RetryAfter.retry_after is an int in PTB 20 and a timedelta in later releases
+    return value.total_seconds() if hasattr(value, 'total_seconds') else float(value)
+
+_lanes = None
+
+def get_lanes() -> Lanes:
+    """Return the lanes shared by the dispatcher and the Application's Bot."""
+    global _lanes
+    if _lanes is None:
+        _lanes = Lanes()
+    return _lanes
+
+def bulk_bot(token: str, base_url: str) -> Bot:
+    """
+    A Bot for the dispatcher with its own connection pool, so bulk sends
+    never hold the connections that replies to users need.
+    """
+    return Bot(token, base_url=base_url, request=HTTPXRequest(connection_pool_size=DISPATCH_WORKERS + 2))
+
+_dispatcher = None
+
+async def init_dispatcher(bot: Bot) -> Dispatcher:
+    """Start the shared dispatcher. Called once at startup."""
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = Dispatcher(bot)
+        await _dispatcher.start()
+    return _dispatcher
+
+async def close_dispatcher() -> None:
+    """Deliver what is still queued, for up to DISPATCH_DRAIN_TIMEOUT, and stop the shared dispatcher."""
+    global _dispatcher
+    if _dispatcher is None:
+        return
+
+    try:
+        await asyncio.wait_for(_dispatcher.drain(), DISPATCH_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(
+            f"Dispatcher stopped with {_dispatcher.backlog} messages queued, "
+            f"the outbox sends them again once their lease runs out"
+        )
+    await _dispatcher.stop()
+    _dispatcher = None
+
+def get_dispatcher() -> Dispatcher:
+    """Return the shared dispatcher started by init_dispatcher()."""
+    if _dispatcher is None:
+        raise RuntimeError("Dispatcher is not initialized, call init_dispatcher() first")
+    return _dispatcher
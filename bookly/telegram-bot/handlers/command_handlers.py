@@ -1,48 +1,77 @@
 # telegram-bot/handlers/command_handlers.py
+import logging
 import os
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
 from telegram.ext import ContextTypes
 from dotenv import load_dotenv
 
+from library_cache import library_reply
+from media_cache import forget_upload, photo_for, remember_photo
+from metrics import timed_handler
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 MINI_APP_URL = os.getenv("MINI_APP_URL")
 
+PROMO_PHOTO_URL = "https://storage.yandexcloud.net/bookly-bucket/bookly_promo.png"
+PROMO_PHOTO_KEY = "promo:start"
+
+# Keyboards are built once and shared by every reply; the handlers refuse
+# to run without MINI_APP_URL
+START_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📖 Открыть библиотеку", web_app=WebAppInfo(url=MINI_APP_URL))]
+]) if MINI_APP_URL else None
+MY_BOOKS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📚 Открыть мои книги", web_app=WebAppInfo(url=f"{MINI_APP_URL}/my-books"))]
+]) if MINI_APP_URL else None
+
+@timed_handler('start')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends a welcome message with a button to open the Mini App."""
     if not MINI_APP_URL:
         await update.message.reply_text("Error: Mini App URL is not configured.")
         return
 
-    keyboard = [
-        [InlineKeyboardButton("📖 Открыть библиотеку", web_app=WebAppInfo(url=MINI_APP_URL))]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_photo(
-        photo="https://storage.yandexcloud.net/bookly-bucket/bookly_promo.png",
-        caption=(
-            "📚 Добро пожаловать в Bookly!\n\n"
-            "Читайте книги прямо в Telegram без установки "
-            "дополнительных приложений.\n\n"
-            "Нажмите кнопку ниже, чтобы начать."
-        ),
-        reply_markup=reply_markup
-    )
+    try:
+        message = await update.message.reply_photo(
+            photo=await photo_for(PROMO_PHOTO_KEY, PROMO_PHOTO_URL),
+            caption=(
+                "📚 Добро пожаловать в Bookly!\n\n"
+                "Читайте книги прямо в Telegram без установки "
+                "дополнительных приложений.\n\n"
+                "Нажмите кнопку ниже, чтобы начать."
+            ),
+            reply_markup=START_KEYBOARD
+        )
+    except Exception as e:
+        await forget_upload(PROMO_PHOTO_KEY, e)
+        raise
 
+    await remember_photo(PROMO_PHOTO_KEY, PROMO_PHOTO_URL, message)
+
+@timed_handler('library')
 async def library(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Sends a button to open the Mini App directly to the 'My Books' page."""
+    """Lists the books the user is reading, or sends a button to the 'My Books' page."""
     if not MINI_APP_URL:
         await update.message.reply_text("Error: Mini App URL is not configured.")
         return
-        
-    my_books_url = f"{MINI_APP_URL}/my-books"
-    keyboard = [
-        [InlineKeyboardButton("📚 Открыть мои книги", web_app=WebAppInfo(url=my_books_url))]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Перейти в вашу личную библиотеку:", reply_markup=reply_markup)
 
+    try:
+        cached = await library_reply(str(update.effective_chat.id))
+    except Exception as e:
+        logger.error(f"Error loading reading list of chat {update.effective_chat.id}: {e}")
+        cached = None
+
+    if cached:
+        text, keyboard = cached
+        await update.message.reply_text(text, reply_markup=keyboard)
+        return
+
+    await update.message.reply_text("Перейти в вашу личную библиотеку:", reply_markup=MY_BOOKS_KEYBOARD)
+
+@timed_handler('help')
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends a help message."""
     help_text = (
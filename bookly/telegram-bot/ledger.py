@@ -0,0 +1,134 @@
+import logging
+import os
+from datetime import timedelta
+from typing import Iterable, List, Set, Tuple
+
+from db import get_pool
+from metrics import job_run
+
+logger = logging.getLogger(__name__)
+
+# Notification kinds recorded in the ledger
+KIND_INACTIVE = 'inactive'
+KIND_UNFINISHED = 'unfinished'
+KIND_NEW_BOOK = 'new_book'
+
+# Entries older than this are deleted by cleanup_ledger()
+LEDGER_TTL = timedelta(days=int(os.getenv('LEDGER_TTL_DAYS', '60')))
+
+# A claim that was never marked sent (e.g. the process died) can be taken
+# over by another run after this long
+CLAIM_TIMEOUT = timedelta(minutes=int(os.getenv('LEDGER_CLAIM_TIMEOUT_MINUTES', '30')))
+
+# SQL condition for recipient queries: true when (telegram_id, subject, period)
+# was already sent or is being sent by someone else. Takes %(kind)s and
+# %(claim_timeout)s; the caller aliases its telegram_id, subject and period.
+ALREADY_CLAIMED = """
+    EXISTS (
+        SELECT 1 FROM "NotificationLedger" l
+        WHERE l."telegramId" = {telegram_id}
+        AND l."kind" = %(kind)s
+        AND l."subject" = {subject}
+        AND l."period" = {period}
+        AND (l."status" IN ('queued', 'sent') OR l."claimedAt" > LOCALTIMESTAMP - %(claim_timeout)s)
+    )
+"""
+
+LedgerKey = Tuple[str, str, str]
+
+def already_claimed(telegram_id: str, subject: str = "''", period: str = "''") -> str:
+    """Build the ALREADY_CLAIMED condition for the given SQL expressions."""
+    return ALREADY_CLAIMED.format(telegram_id=telegram_id, subject=subject, period=period)
+
+class LedgerBatch:
+    """
+    Claims a batch of (telegram_id, subject, period) keys of one kind before
+    they are queued for a digest, then records which of them were delivered.
+    Keys claimed by another run or replica are left out of the claim result.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self._sent: List[LedgerKey] = []
+        self._failed: List[LedgerKey] = []
+
+    async def claim(self, keys: Iterable[LedgerKey]) -> Set[LedgerKey]:
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return set()
+
+        telegram_ids, subjects, periods = (list(column) for column in zip(*keys))
+        async with get_pool().connection() as conn:
+            cur = await conn.execute("""
+                INSERT INTO "NotificationLedger" ("telegramId", "kind", "subject", "period", "status", "claimedAt")
+                SELECT k.telegram_id, %s, k.subject, k.period, 'claimed', LOCALTIMESTAMP
+                FROM unnest(%s::text[], %s::text[], %s::text[]) AS k(telegram_id, subject, period)
+                ON CONFLICT ("telegramId", "kind", "subject", "period") DO UPDATE
+                SET "claimedAt" = EXCLUDED."claimedAt"
+                WHERE "NotificationLedger"."status" = 'claimed'
+                AND "NotificationLedger"."claimedAt" < LOCALTIMESTAMP - %s
+                RETURNING "telegramId", "subject", "period"
+            """, (self.kind, telegram_ids, subjects, periods, CLAIM_TIMEOUT))
+            claimed = {tuple(row) for row in await cur.fetchall()}
+
+        if len(claimed) < len(keys):
+            logger.info(f"Skipping {len(keys) - len(claimed)} {self.kind} notifications claimed elsewhere")
+        return claimed
+
+    def record_sent(self, key: LedgerKey) -> None:
+        self._sent.append(key)
+
+    def record_failed(self, key: LedgerKey) -> None:
+        self._failed.append(key)
+
+    async def mark_queued(self, conn, keys: List[LedgerKey]) -> None:
+        """
+        Mark claimed keys as waiting in a digest, as part of the caller's
+        transaction. Queued keys are not subject to CLAIM_TIMEOUT.
+        """
+        if not keys:
+            return
+
+        await conn.execute("""
+            UPDATE "NotificationLedger" l
+            SET "status" = 'queued'
+            FROM unnest(%s::text[], %s::text[], %s::text[]) AS k(telegram_id, subject, period)
+            WHERE l."telegramId" = k.telegram_id AND l."kind" = %s
+            AND l."subject" = k.subject AND l."period" = k.period
+            AND l."status" = 'claimed'
+        """, (*(list(column) for column in zip(*keys)), self.kind))
+
+    async def flush(self) -> None:
+        """Mark delivered keys as sent and release the claims of failed ones."""
+        sent, self._sent = self._sent, []
+        failed, self._failed = self._failed, []
+        if not sent and not failed:
+            return
+
+        async with get_pool().connection() as conn:
+            if sent:
+                await conn.execute("""
+                    UPDATE "NotificationLedger" l
+                    SET "status" = 'sent', "sentAt" = LOCALTIMESTAMP
+                    FROM unnest(%s::text[], %s::text[], %s::text[]) AS k(telegram_id, subject, period)
+                    WHERE l."telegramId" = k.telegram_id AND l."kind" = %s
+                    AND l."subject" = k.subject AND l."period" = k.period
+                """, (*(list(column) for column in zip(*sent)), self.kind))
+            if failed:
+                await conn.execute("""
+                    DELETE FROM "NotificationLedger" l
+                    USING unnest(%s::text[], %s::text[], %s::text[]) AS k(telegram_id, subject, period)
+                    WHERE l."telegramId" = k.telegram_id AND l."kind" = %s
+                    AND l."subject" = k.subject AND l."period" = k.period
+                    AND l."status" <> 'sent'
+                """, (*(list(column) for column in zip(*failed)), self.kind))
+
+async def cleanup_ledger() -> int:
+    """Delete ledger entries older than LEDGER_TTL."""
+    async with job_run('ledger_cleanup'), get_pool().connection() as conn:
+        cur = await conn.execute(
+            'DELETE FROM "NotificationLedger" WHERE "claimedAt" < LOCALTIMESTAMP - %s',
+            (LEDGER_TTL,)
+        )
+    logger.info(f"Removed {cur.rowcount} expired notification ledger entries")
+    return cur.rowcount
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from db import connect, get_pool
+from metrics import LIBRARY_CACHE
+from migrations import FEATURE_READING_PROGRESS_EVENTS, migrate
+from schema import READING_PROGRESS_CHANNEL
+from templates import (
+    CONTINUE_READING_HEADER, CONTINUE_READING_LINE, inline_keyboard, reader_row, web_app_row
+)
+
+logger = logging.getLogger(__name__)
+
+# Users whose /library reply is kept, and for how long at most
+LIBRARY_CACHE_SIZE = int(os.getenv('LIBRARY_CACHE_SIZE', '50000'))
+LIBRARY_CACHE_TTL = float(os.getenv('LIBRARY_CACHE_TTL_SECONDS', '60'))
+
+# Drop cached replies as soon as reading progress changes; without it they
+# are refreshed after LIBRARY_CACHE_TTL
+READING_PROGRESS_EVENTS_ENABLED = os.getenv('READING_PROGRESS_EVENTS', 'false').lower() == 'true'
+
+# Books listed under "continue reading"
+CONTINUE_READING_LIMIT = 5
+
+RECONNECT_DELAY = 5
+
+# Rendered reply: text and serialized reply_markup, None for users with nothing to continue
+LibraryReply = Optional[Tuple[str, str]]
+
+async def load_library_reply(telegram_id: str) -> LibraryReply:
+    """Render the continue-reading list of `telegram_id` from the database."""
+    async with get_pool().connection() as conn:
+        cur = await conn.execute("""
+            SELECT b.title, b.id, rp.progress
+            FROM "ReadingProgress" rp
+            JOIN "User" u ON u.id = rp."userId"
+            JOIN "Book" b ON rp."bookId" = b.id
+            WHERE u.telegram_id = %s
+            AND rp.progress > 0
+            AND rp.progress < 100
+            ORDER BY rp."lastReadAt" DESC
+            LIMIT %s
+        """, (telegram_id, CONTINUE_READING_LIMIT))
+        books = await cur.fetchall()
+
+    if not books:
+        return None
+
+    lines = [CONTINUE_READING_LINE.format(title=title, progress=float(progress)) for title, _, progress in books]
+    rows = [reader_row(title, book_id) for title, book_id, _ in books]
+    rows.append(web_app_row('📚 Мои книги', '/my-books'))
+    return '\n'.join([CONTINUE_READING_HEADER, '', *lines]), inline_keyboard(rows)
+
+class LibraryCache:
+    """
+    LRU of rendered /library replies by telegram id, each kept for at most
+    `ttl` seconds. Concurrent misses for one user share a single query.
+    """
+
+    def __init__(self, size: int = LIBRARY_CACHE_SIZE, ttl: float = LIBRARY_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}
+        # Users invalidated while their reply was being loaded
+        self._stale: Set[str] = set()
+
+    async def get(self, telegram_id: str) -> LibraryReply:
+        entry = self._entries.get(telegram_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(telegram_id)
+            LIBRARY_CACHE.inc(result='hit')
+            return entry[1]
+
+        future = self._loading.get(telegram_id)
+        if future is not None:
+            LIBRARY_CACHE.inc(result='hit')
+            return await asyncio.shield(future)
+
+        LIBRARY_CACHE.inc(result='miss')
+        future = self._loading[telegram_id] = asyncio.get_running_loop().create_future()
+        self._stale.discard(telegram_id)
+        try:
+            reply = await load_library_reply(telegram_id)
+        except Exception as e:
+            future.set_exception(e)
+            # Waiters re-raise it; this keeps an unawaited future from being logged
+            future.exception()
+            raise
+        else:
+            future.set_result(reply)
+            if telegram_id not in self._stale:
+                self._store(telegram_id, reply)
+            return reply
+        finally:
+            del self._loading[telegram_id]
+            self._stale.discard(telegram_id)
+
+    def _store(self, telegram_id: str, reply: LibraryReply) -> None:
+        self._entries[telegram_id] = (time.monotonic() + self.ttl, reply)
+        self._entries.move_to_end(telegram_id)
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, telegram_ids: Iterable[str]) -> None:
+        for telegram_id in telegram_ids:
+            if self._entries.pop(telegram_id, None) is not None:
+                LIBRARY_CACHE.inc(result='invalidated')
+            if telegram_id in self._loading:
+                self._stale.add(telegram_id)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._stale.update(self._loading)
+
+class ReadingProgressListener:
+    """
+    Invalidates cached /library replies of users whose reading progress
+    changed. Every replica listens, since each holds a cache of its own.
+    """
+
+    def __init__(self, cache: LibraryCache):
+        self.cache = cache
+        self._task = None
+
+    async def start(self) -> None:
+        await migrate(features=[FEATURE_READING_PROGRESS_EVENTS])
+        self._task = asyncio.create_task(self._listen(), name='reading-progress-listener')
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with await connect(autocommit=True) as conn:
+                    await conn.execute(f"LISTEN {READING_PROGRESS_CHANNEL}")
+                    logger.info(f"Listening for reading progress on {READING_PROGRESS_CHANNEL}")
+
+                    # Changes made while nobody was listening were missed
+                    self.cache.clear()
+
+                    async for notify in conn.notifies():
+                        self.cache.invalidate(notify.payload.split(','))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Reading progress listener lost its connection: {e}")
+                # Serve nothing stale while disconnected
+                self.cache.clear()
+                await asyncio.sleep(RECONNECT_DELAY)
+
+_cache = LibraryCache()
+_listener: Optional[ReadingProgressListener] = None
+
+async def library_reply(telegram_id: str) -> LibraryReply:
+    """The cached continue-reading reply of `telegram_id`, None if they have nothing to continue."""
+    return await _cache.get(telegram_id)
+
+async def start_library_cache_listener() -> Optional[ReadingProgressListener]:
+    """Start invalidating the /library cache if READING_PROGRESS_EVENTS is enabled. Called once at startup."""
+    global _listener
+    if READING_PROGRESS_EVENTS_ENABLED and _listener is None:
+        _listener = ReadingProgressListener(_cache)
+        await _listener.start()
+    return _listener
+
+async def stop_library_cache_listener() -> None:
+    global _listener
+    if _listener is None:
+        return
+
+    await _listener.stop()
+    _listener = None
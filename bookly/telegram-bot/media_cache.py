@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+
+from telegram import Message
+
+from db import get_pool
+
+logger = logging.getLogger(__name__)
+
+# How long a send waits for the first upload of the same photo to finish.
+# An upload still unresolved by then is taken for lost and dropped, so the
+# sends after it upload again instead of waiting as well.
+UPLOAD_WAIT_TIMEOUT = 30
+
+# key -> (source URL, Telegram file_id)
+_file_ids: Dict[str, Tuple[str, str]] = {}
+
+# key -> future resolved with the file_id of an upload that is in flight
+_uploads: Dict[str, asyncio.Future] = {}
+
+def cover_key(book_id: str) -> str:
+    return f"cover:{book_id}"
+
+async def load_media_cache() -> None:
+    """Load every cached file_id into memory. Called once at startup."""
+    async with get_pool().connection() as conn:
+        cur = await conn.execute('SELECT "key", "sourceUrl", "fileId" FROM "TelegramMediaCache"')
+        for key, source_url, file_id in await cur.fetchall():
+            _file_ids[key] = (source_url, file_id)
+    logger.info(f"Loaded {len(_file_ids)} cached media file ids")
+
+def cached_file_id(key: str, source_url: str) -> Optional[str]:
+    """Return the cached file_id for `key`, unless its source URL has changed."""
+    cached = _file_ids.get(key)
+    if cached and cached[0] == source_url:
+        return cached[1]
+    return None
+
+async def photo_for(key: str, source_url: str) -> str:
+    """
+    Return what to pass as `photo`: the cached file_id if there is one,
+    otherwise the URL. Only one upload per key is let through at a time;
+    concurrent sends wait for it and reuse its file_id.
+    """
+    file_id = cached_file_id(key, source_url)
+    if file_id:
+        return file_id
+
+    upload = _uploads.get(key)
+    if upload is None:
+        _uploads[key] = asyncio.get_running_loop().create_future()
+        return source_url
+
+    try:
+        file_id = await asyncio.wait_for(asyncio.shield(upload), UPLOAD_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        if _uploads.get(key) is upload:
+            logger.warning(f"Upload of {key} did not finish within {UPLOAD_WAIT_TIMEOUT}s, dropping it")
+            _finish_upload(key, None)
+        file_id = None
+    return file_id or source_url
+
+async def remember_photo(key: str, source_url: str, message: Message) -> None:
+    """Record the file_id Telegram assigned to a photo sent from `source_url`."""
+    file_id = message.photo[-1].file_id if message and message.photo else None
+    _finish_upload(key, file_id)
+    if not file_id or cached_file_id(key, source_url) == file_id:
+        return
+
+    _file_ids[key] = (source_url, file_id)
+    try:
+        async with get_pool().connection() as conn:
+            await conn.execute("""
+                INSERT INTO "TelegramMediaCache" ("key", "sourceUrl", "fileId", "updatedAt")
+                VALUES (%s, %s, %s, LOCALTIMESTAMP)
+                ON CONFLICT ("key") DO UPDATE
+                SET "sourceUrl" = EXCLUDED."sourceUrl",
+                    "fileId" = EXCLUDED."fileId",
+                    "updatedAt" = EXCLUDED."updatedAt"
+            """, (key, source_url, file_id))
+    except Exception as e:
+        # The in-memory entry still saves uploads until the next restart
+        logger.error(f"Error saving media file id for {key}: {e}")
+
+async def forget_upload(key: str, error: Optional[Exception] = None) -> None:
+    """Let the next send upload the photo after a failed attempt."""
+    if error is not None:
+        logger.info(f"Upload of {key} failed, the next send uploads it again: {error}")
+    _finish_upload(key, None)
+
+def _finish_upload(key: str, file_id: Optional[str]) -> None:
+    upload = _uploads.pop(key, None)
+    if upload and not upload.done():
+        upload.set_result(file_id)
@@ -0,0 +1,286 @@
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache, wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Optional, Tuple
+
+from profiling import maybe_profile
+
+logger = logging.getLogger(__name__)
+
+# Side listener for /metrics in polling mode; disabled when unset
+METRICS_PORT = os.getenv('METRICS_PORT')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+JOB_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800)
+
+LabelValues = Tuple[str, ...]
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> LabelValues:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, values: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labels, values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        escaped = (f'{name}="{_escape(value)}"' for name, value in pairs)
+        return '{' + ','.join(escaped) + '}'
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{self._format_labels(key)} {value}"
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> ([count per bucket..., +Inf], sum)
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(state[0]), state[1]) for key, state in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f"{self.name}_bucket{self._format_labels(key, ('le', le))} {cumulative}"
+            yield f"{self.name}_sum{self._format_labels(key)} {total}"
+            yield f"{self.name}_count{self._format_labels(key)} {cumulative}"
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+_registry = []
+
+def _register(metric):
+    _registry.append(metric)
+    return metric
+
+# Jobs
+JOB_DURATION = _register(Histogram(
+    'bookly_job_duration_seconds', "Wall time of scheduled job runs.", ['job'], JOB_BUCKETS
+))
+JOB_ERRORS = _register(Counter('bookly_job_errors_total', "Job runs that raised.", ['job']))
+JOB_ROWS = _register(Counter(
+    'bookly_job_rows_total', "Rows read by jobs, by the stage that read them.", ['job', 'stage']
+))
+NOTIFICATIONS_QUEUED = _register(Counter(
+    'bookly_notifications_queued_total', "Notifications added to pending digests.", ['kind']
+))
+OUTBOX_RESULTS = _register(Counter(
+    'bookly_outbox_results_total', "Outbox deliveries by outcome: sent, retry, dead or superseded.", ['status', 'reason']
+))
+UNREACHABLE_CHATS = _register(Counter(
+    'bookly_unreachable_chats_total', "Chats added to or cleared from the unreachable registry.", ['event']
+))
+NEW_BOOK_EVENTS = _register(Counter(
+    'bookly_new_book_events_total', "Book ids received from the new-book LISTEN channel."
+))
+
+# Database
+DB_STATEMENT_DURATION = _register(Histogram(
+    'bookly_db_statement_duration_seconds', "Time spent executing SQL statements.", ['statement']
+))
+DB_ROUND_TRIPS = _register(Counter(
+    'bookly_db_round_trips_total', "Statements and server-side cursor fetches sent to Postgres.", ['statement']
+))
+
+# Bot API
+BOT_API_LATENCY = _register(Histogram(
+    'bookly_bot_api_latency_seconds', "Latency of outbound Bot API calls, by lane.", ['lane', 'method']
+))
+BOT_API_SENT = _register(Counter('bookly_bot_api_sent_total', "Bot API calls that succeeded.", ['method']))
+BOT_API_ERRORS = _register(Counter(
+    'bookly_bot_api_errors_total', "Bot API calls that raised, by error type.", ['method', 'error']
+))
+BOT_API_RETRIES = _register(Counter('bookly_bot_api_retries_total', "Bot API calls retried.", ['method']))
+DISPATCH_QUEUE_DEPTH = _register(Gauge(
+    'bookly_dispatch_queue_depth', "Messages waiting in the dispatcher queue."
+))
+BULK_LANE_RATE = _register(Gauge(
+    'bookly_bulk_lane_rate', "Messages per second currently allowed to bulk sends."
+))
+
+# Handlers
+HANDLER_DURATION = _register(Histogram(
+    'bookly_handler_duration_seconds', "Time to handle a command.", ['command']
+))
+HANDLER_ERRORS = _register(Counter('bookly_handler_errors_total', "Command handlers that raised.", ['command']))
+LIBRARY_CACHE = _register(Counter(
+    'bookly_library_cache_total', "/library lookups in the reading cache: hit, miss or invalidated.", ['result']
+))
+CATALOG_INDEX_BOOKS = _register(Gauge('bookly_catalog_index_books', "Books in the inline search index."))
+STARTUP_PHASE_DURATION = _register(Gauge(
+    'bookly_startup_phase_seconds', "Time spent in each step of the webhook's cold start.", ['phase']
+))
+WEBHOOK_UPDATES = _register(Counter(
+    'bookly_webhook_updates_total', "Webhook updates by admission result: accepted, duplicate or shed.", ['result']
+))
+WEBHOOK_REPLIES = _register(Counter(
+    'bookly_webhook_replies_total',
+    "Webhook handler replies: sent as API calls, returned inline in the response or coalesced away.",
+    ['mode']
+))
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+_WRITE = re.compile(r'\b(INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+"(\w+)"', re.I)
+_READ = re.compile(r'\bFROM\s+"(\w+)"', re.I)
+
+@lru_cache(maxsize=1024)
+def statement_label(query: str) -> str:
+    """
+    Short, low-cardinality name for a statement, e.g. 'INSERT "NotificationLedger"'.
+    Writes are named after the table they change, reads after the first
+    table they select from.
+    """
+    write = _WRITE.search(query)
+    if write:
+        return f'{write.group(1).split()[0].upper()} "{write.group(2)}"'
+
+    read = _READ.search(query)
+    if read:
+        return f'SELECT "{read.group(1)}"'
+
+    words = query.split(None, 1)
+    return words[0].upper() if words else 'EMPTY'
+
+@asynccontextmanager
+async def job_run(job: str):
+    """
+    Time one run of `job` and count its failures. Runs listed in
+    PROFILE_JOBS are additionally sampled by the profiler.
+    """
+    started = time.perf_counter()
+    try:
+        with maybe_profile(job):
+            yield
+    except Exception:
+        JOB_ERRORS.inc(job=job)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        JOB_DURATION.observe(elapsed, job=job)
+        logger.info(f"Job {job} finished in {elapsed:.1f}s")
+
+def timed_handler(command: str):
+    """Decorator recording the latency and failures of a command handler."""
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(command=command)
+                raise
+            finally:
+                HANDLER_DURATION.observe(time.perf_counter() - started, command=command)
+        return wrapper
+    return decorator
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+_server = None
+
+def start_metrics_server(port: Optional[str] = METRICS_PORT) -> None:
+    """Serve /metrics on a side listener, for polling mode where there is no Flask app."""
+    global _server
+    if not port or _server is not None:
+        return
+
+    _server = ThreadingHTTPServer(('0.0.0.0', int(port)), _MetricsHandler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f"Serving metrics on :{port}/metrics")
+
+def stop_metrics_server() -> None:
+    global _server
+    if _server is None:
+        return
+    _server.shutdown()
+    _server.server_close()
+    _server = None
@@ -0,0 +1,353 @@
+import logging
+from typing import Iterable, List, NamedTuple, Optional, Union
+
+from db import connect
+
+logger = logging.getLogger(__name__)
+
+# Serializes migrations across replicas starting together
+MIGRATION_LOCK_KEY = "hashtext('bot_migrations')"
+
+class Index(NamedTuple):
+    """An index built without blocking writes to a table the backend owns."""
+    name: str
+    table: str
+    columns: str
+    include: str = ''
+    where: str = ''
+
+    def sql(self) -> str:
+        statement = f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{self.name}" ON "{self.table}" ({self.columns})'
+        if self.include:
+            statement += f' INCLUDE ({self.include})'
+        if self.where:
+            statement += f' WHERE {self.where}'
+        return statement
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    statements: List[Union[str, Index]]
+    feature: Optional[str] = None
+
+# Optional features whose migrations are only applied by the code that uses them
+FEATURE_NEW_BOOK_EVENTS = 'new_book_events'
+FEATURE_READING_PROGRESS_EVENTS = 'reading_progress_events'
+
+# Applied in order, once per database. Released migrations are never edited;
+# a change to the schema or to an index is a new migration. Migrations of a
+# feature are applied once it is enabled, possibly after later ones.
+MIGRATIONS = [
+    # What ensure_schema() used to create with IF NOT EXISTS, so existing
+    # databases only record it. Frozen: never derive it from other code.
+    Migration(1, 'bot tables', [
+        """
+        CREATE TABLE IF NOT EXISTS "TelegramMediaCache" (
+            "key" TEXT PRIMARY KEY,
+            "sourceUrl" TEXT NOT NULL,
+            "fileId" TEXT NOT NULL,
+            "updatedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS "BotCheckpoint" (
+            "name" TEXT PRIMARY KEY,
+            "position" TIMESTAMP(3) NOT NULL,
+            "lastId" TEXT NOT NULL DEFAULT '',
+            "updatedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS "UserGenreAffinity" (
+            "userId" TEXT NOT NULL,
+            "genreId" TEXT NOT NULL,
+            "score" DOUBLE PRECISION NOT NULL DEFAULT 0,
+            "updatedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY ("userId", "genreId")
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS "UserGenreAffinity_userId_score_idx"
+        ON "UserGenreAffinity" ("userId", "score" DESC)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS "UserGenreAffinity_genreId_idx"
+        ON "UserGenreAffinity" ("genreId")
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS "NotificationLedger" (
+            "telegramId" TEXT NOT NULL,
+            "kind" TEXT NOT NULL,
+            "subject" TEXT NOT NULL DEFAULT '',
+            "period" TEXT NOT NULL DEFAULT '',
+            "status" TEXT NOT NULL DEFAULT 'claimed',
+            "claimedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            "sentAt" TIMESTAMP(3),
+            PRIMARY KEY ("telegramId", "kind", "subject", "period")
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS "NotificationLedger_claimedAt_idx"
+        ON "NotificationLedger" ("claimedAt")
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS "NotificationDigestItem" (
+            "telegramId" TEXT NOT NULL,
+            "kind" TEXT NOT NULL,
+            "subject" TEXT NOT NULL DEFAULT '',
+            "period" TEXT NOT NULL DEFAULT '',
+            "payload" JSONB NOT NULL,
+            "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY ("telegramId", "kind", "subject", "period")
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS "NotificationDigestState" (
+            "telegramId" TEXT PRIMARY KEY,
+            "lastSentAt" TIMESTAMP(3) NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS "NotificationOutbox" (
+            "id" BIGSERIAL PRIMARY KEY,
+            "telegramId" TEXT NOT NULL,
+            "items" JSONB NOT NULL,
+            "status" TEXT NOT NULL DEFAULT 'pending',
+            "attempts" INTEGER NOT NULL DEFAULT 0,
+            "lastError" TEXT,
+            "deadReason" TEXT,
+            "availableAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            "sentAt" TIMESTAMP(3)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS "NotificationOutbox_ready_idx"
+        ON "NotificationOutbox" ("availableAt", "id")
+        WHERE "status" IN ('pending', 'sending')
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS "UnreachableChat" (
+            "telegramId" TEXT PRIMARY KEY,
+            "reason" TEXT NOT NULL,
+            "lastError" TEXT,
+            "failures" INTEGER NOT NULL DEFAULT 1,
+            "firstFailedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            "lastFailedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            "recheckAt" TIMESTAMP(3) NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS "UserDeliverySlot" (
+            "telegramId" TEXT PRIMARY KEY,
+            "minuteOfDay" INTEGER NOT NULL,
+            "updatedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    # Keyset scans of the notification jobs and the affinity refresh. Partial
+    # indexes repeat the jobs' literal filters, or the planner cannot use them.
+    Migration(2, 'notification job indexes', [
+        # check_inactive_users gets its index in a migration of its own once
+        # the backend's schema has "User"."lastActiveAt"; only the benchmark
+        # seed adds the column so far
+        # check_unfinished_books: stalled books only, ORDER BY "lastReadAt", id
+        Index(
+            'ReadingProgress_bot_unfinished_idx', 'ReadingProgress', '"lastReadAt", id',
+            include='"userId", "bookId", progress', where='progress > 10 AND progress < 100'
+        ),
+        # refresh_affinity: events in a ("since", "until"] window
+        Index('ReadingProgress_bot_lastReadAt_idx', 'ReadingProgress', '"lastReadAt"', include='"userId", "bookId"'),
+        Index('Favorite_bot_createdAt_idx', 'Favorite', '"createdAt"', include='"userId", "bookId"'),
+        Index('Purchase_bot_createdAt_idx', 'Purchase', '"createdAt"', include='"userId", "bookId"'),
+        # check_new_books and the per-genre counts: "createdAt" ranges and keyset
+        Index('Book_bot_createdAt_id_idx', 'Book', '"createdAt", id'),
+        # Genre -> books without visiting the join table's heap
+        Index('_BookToGenre_bot_B_A_idx', '_BookToGenre', '"B"', include='"A"'),
+        # Recipients with the reminders or new-book notifications turned on
+        Index(
+            'NotificationSettings_bot_reminders_idx', 'NotificationSettings', '"userId"',
+            include='frequency', where='"telegramEnabled" = true AND "unfinishedReminder" = true'
+        ),
+        Index(
+            'NotificationSettings_bot_new_books_idx', 'NotificationSettings', '"userId"',
+            where='"telegramEnabled" = true AND "newBooksInGenre" = true'
+        ),
+    ]),
+    # Update ids seen by webhook replicas, for deduplicating re-deliveries
+    Migration(3, 'processed updates', [
+        """
+        CREATE TABLE IF NOT EXISTS "ProcessedUpdate" (
+            "updateId" BIGINT PRIMARY KEY,
+            "receivedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS "ProcessedUpdate_receivedAt_idx"
+        ON "ProcessedUpdate" ("receivedAt")
+        """,
+    ]),
+    # Statement-level triggers on the backend's tables, so a bulk import of
+    # many rows raises a handful of events instead of one per row. Channels
+    # and ids per event match NEW_BOOK_CHANNEL and READING_PROGRESS_CHANNEL
+    # in schema.py; payloads are limited to 8000 bytes.
+    Migration(4, 'new book triggers', [
+        """
+        CREATE OR REPLACE FUNCTION bookly_notify_new_books() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM pg_notify('bookly_new_books', string_agg(id, ','))
+            FROM (SELECT id, (row_number() OVER ()) / 150 AS chunk FROM new_rows) ids
+            GROUP BY chunk;
+            RETURN NULL;
+        END
+        $$
+        """,
+        """
+        CREATE OR REPLACE FUNCTION bookly_notify_new_book_genres() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM pg_notify('bookly_new_books', string_agg(id, ','))
+            FROM (
+                SELECT id, (row_number() OVER ()) / 150 AS chunk
+                FROM (SELECT DISTINCT "A" AS id FROM new_rows) books
+            ) ids
+            GROUP BY chunk;
+            RETURN NULL;
+        END
+        $$
+        """,
+        'DROP TRIGGER IF EXISTS "Book_bookly_new_books" ON "Book"',
+        """
+        CREATE TRIGGER "Book_bookly_new_books"
+        AFTER INSERT ON "Book"
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bookly_notify_new_books()
+        """,
+        'DROP TRIGGER IF EXISTS "_BookToGenre_bookly_new_books" ON "_BookToGenre"',
+        """
+        CREATE TRIGGER "_BookToGenre_bookly_new_books"
+        AFTER INSERT ON "_BookToGenre"
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bookly_notify_new_book_genres()
+        """,
+    ], feature=FEATURE_NEW_BOOK_EVENTS),
+    # Transition tables need one trigger per event
+    Migration(5, 'reading progress triggers', [
+        """
+        CREATE OR REPLACE FUNCTION bookly_notify_reading_progress() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM pg_notify('bookly_reading_progress', string_agg(telegram_id, ','))
+            FROM (
+                SELECT telegram_id, (row_number() OVER ()) / 300 AS chunk
+                FROM (
+                    SELECT DISTINCT u.telegram_id
+                    FROM changed_rows r
+                    JOIN "User" u ON u.id = r."userId"
+                    WHERE u.telegram_id IS NOT NULL
+                ) users
+            ) ids
+            GROUP BY chunk;
+            RETURN NULL;
+        END
+        $$
+        """,
+        'DROP TRIGGER IF EXISTS "ReadingProgress_bookly_insert" ON "ReadingProgress"',
+        """
+        CREATE TRIGGER "ReadingProgress_bookly_insert"
+        AFTER INSERT ON "ReadingProgress"
+        REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bookly_notify_reading_progress()
+        """,
+        'DROP TRIGGER IF EXISTS "ReadingProgress_bookly_update" ON "ReadingProgress"',
+        """
+        CREATE TRIGGER "ReadingProgress_bookly_update"
+        AFTER UPDATE ON "ReadingProgress"
+        REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bookly_notify_reading_progress()
+        """,
+        'DROP TRIGGER IF EXISTS "ReadingProgress_bookly_delete" ON "ReadingProgress"',
+        """
+        CREATE TRIGGER "ReadingProgress_bookly_delete"
+        AFTER DELETE ON "ReadingProgress"
+        REFERENCING OLD TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bookly_notify_reading_progress()
+        """,
+    ], feature=FEATURE_READING_PROGRESS_EVENTS),
+    # refresh_affinity recomputes the users with new events from all their
+    # events; "Favorite" and "ReadingProgress" have ("userId", "bookId") keys
+    Migration(6, 'affinity user indexes', [
+        Index('Purchase_bot_userId_idx', 'Purchase', '"userId"', include='"bookId", "createdAt"'),
+    ]),
+]
+
+async def _applied_versions(conn) -> set:
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS "BotSchemaMigration" (
+            "version" INTEGER PRIMARY KEY,
+            "name" TEXT NOT NULL,
+            "appliedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur = await conn.execute('SELECT "version" FROM "BotSchemaMigration"')
+    return {row[0] for row in await cur.fetchall()}
+
+async def _create_index(conn, index: Index) -> None:
+    # A concurrent build that failed leaves an invalid index behind, which
+    # IF NOT EXISTS would then take for a finished one
+    cur = await conn.execute("""
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND NOT i.indisvalid
+    """, (index.name,))
+    if await cur.fetchone():
+        await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"')
+    await conn.execute(index.sql())
+
+async def _run(conn, migration: Migration) -> None:
+    for statement in migration.statements:
+        if isinstance(statement, Index):
+            await _create_index(conn, statement)
+        else:
+            await conn.execute(statement)
+    await conn.execute(
+        'INSERT INTO "BotSchemaMigration" ("version", "name") VALUES (%s, %s)',
+        (migration.version, migration.name)
+    )
+
+async def _apply(conn, migration: Migration) -> None:
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block, so
+    # migrations with indexes run statement by statement; every one of
+    # them can safely run again if the migration is interrupted
+    if any(isinstance(statement, Index) for statement in migration.statements):
+        await _run(conn, migration)
+        return
+
+    async with conn.transaction():
+        await _run(conn, migration)
+
+async def migrate(features: Iterable[str] = ()) -> List[int]:
+    """
+    Apply the migrations this database is missing, including those of the
+    given optional features. Returns their versions.
+    """
+    features = set(features)
+    applied = []
+    # Outside the pool: CREATE INDEX CONCURRENTLY needs autocommit
+    async with await connect(autocommit=True) as conn:
+        await conn.execute(f"SELECT pg_advisory_lock({MIGRATION_LOCK_KEY})")
+        try:
+            done = await _applied_versions(conn)
+            for migration in MIGRATIONS:
+                if migration.version in done:
+                    continue
+                if migration.feature is not None and migration.feature not in features:
+                    continue
+                logger.info(f"Applying migration {migration.version}: {migration.name}")
+                await _apply(conn, migration)
+                applied.append(migration.version)
+        finally:
+            await conn.execute(f"SELECT pg_advisory_unlock({MIGRATION_LOCK_KEY})")
+
+    logger.info(f"Bot schema is up to date ({len(applied)} migrations applied)")
+    return applied
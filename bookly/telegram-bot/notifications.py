@@ -1,14 +1,22 @@
 import logging
-from telegram import Update, WebAppInfo
-from telegram.ext import ContextTypes
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
-import asyncio
-from datetime import datetime, timedelta
-import psycopg2
+from telegram.ext import Application
+from datetime import timedelta
 import os
+from typing import Awaitable, Callable
 from dotenv import load_dotenv
 
+from db import db_now, get_pool
+from metrics import JOB_ROWS, job_run
+from pipeline import fetch_chunks, pipeline
+from affinity import refresh_affinity
+from checkpoints import JOB_SETTLE_MARGIN, Checkpoint, get_checkpoint, save_checkpoint
+from digest import DigestItem, queue_items
+from reachability import unreachable
+from sharding import Shard, run_sharded
+from ledger import (
+    CLAIM_TIMEOUT, KIND_INACTIVE, KIND_NEW_BOOK, KIND_UNFINISHED, LedgerBatch, already_claimed
+)
+
 # Load environment variables
 load_dotenv()
 
@@ -19,281 +27,297 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Database connection
-def get_db_connection():
-    return psycopg2.connect(
-        host=os.getenv('DB_HOST', 'localhost'),
-        database=os.getenv('DB_NAME', 'bookly'),
-        user=os.getenv('DB_USER', 'postgres'),
-        password=os.getenv('DB_PASSWORD', 'postgres')
-    )
-
-async def send_inactive_reminder(application, user_id: int, genre: str, new_books_count: int):
-    """Send inactive user reminder."""
-    try:
-        message = (
-            f"📚 Привет! Мы скучали по тебе.\n\n"
-            f"В библиотеке появилось {new_books_count} новых книг в жанре {genre}.\n\n"
-            f"Продолжи читать любимые книги или открой что-то новое!"
-        )
-        
-        keyboard = {
-            'inline_keyboard': [
-                [
-                    {
-                        'text': '📖 Открыть библиотеку',
-                        'web_app': {
-                            'url': os.getenv('MINI_APP_URL', 'https://your-mini-app-url.com')
-                        }
-                    }
-                ]
-            ]
-        }
-        
-        await application.bot.send_message(
-            chat_id=user_id,
-            text=message,
-            reply_markup=keyboard
-        )
-        
-        logger.info(f"Inactive reminder sent to user {user_id}")
-    except Exception as e:
-        logger.error(f"Error sending inactive reminder to user {user_id}: {e}")
-
-async def send_unfinished_reminder(application, user_id: int, book_title: str, book_id: str, progress: float):
-    """Send unfinished book reminder."""
+# Rows fetched per round trip by server-side cursors
+NEW_BOOK_TARGETS_CHUNK_SIZE = int(os.getenv('NEW_BOOK_TARGETS_CHUNK_SIZE', '2000'))
+
+# Rows per keyset page; the job checkpoint advances after every page
+JOB_PAGE_SIZE = int(os.getenv('JOB_PAGE_SIZE', '1000'))
+
+# How far back a job looks on its very first run, before it has a checkpoint
+JOB_INITIAL_LOOKBACK = timedelta(days=1)
+
+async def keyset_pages(conn, job: str, query: str, params: dict, checkpoint: Checkpoint):
+    """
+    Yield pages of rows ordered after `checkpoint`. `query` must select
+    the keyset (timestamp, id) as its last two columns and use the
+    %(after_ts)s, %(after_id)s and %(limit)s placeholders.
+    """
+    while True:
+        cur = await conn.execute(query, {
+            **params,
+            'after_ts': checkpoint.position,
+            'after_id': checkpoint.last_id,
+            'limit': JOB_PAGE_SIZE
+        })
+        rows = await cur.fetchall()
+        # Don't sit idle in a transaction while the page is processed
+        await conn.commit()
+        if not rows:
+            return
+
+        JOB_ROWS.inc(len(rows), job=job.split(':')[0], stage='scan')
+        yield rows
+
+        checkpoint = Checkpoint(rows[-1][-2], rows[-1][-1])
+        if len(rows) < JOB_PAGE_SIZE:
+            return
+
+async def scan_job(conn, job: str, query: str, params: dict, default_start: Checkpoint,
+                   process_page: Callable[[list], Awaitable[None]]) -> None:
+    """
+    Stream the rows of a job from its checkpoint through `process_page`,
+    one page at a time (see keyset_pages). The next page is read while the
+    previous one is processed, and the checkpoint is moved past a page only
+    once it has been processed, so a crashed run resumes at the first page
+    it had not finished.
+    """
+    checkpoint = await get_checkpoint(conn, job) or default_start
+    await conn.commit()
+
+    async def process(rows):
+        await process_page(rows)
+        async with get_pool().connection() as checkpoint_conn:
+            await save_checkpoint(checkpoint_conn, job, Checkpoint(rows[-1][-2], rows[-1][-1]))
+
+    await pipeline(keyset_pages(conn, job, query, params, checkpoint), process)
+
+async def check_inactive_users(application: Application):
+    """Check for users who became inactive since the last run and queue reminders."""
     try:
-        message = (
-            f"📖 Вы остановились на {progress:.0f}% книги «{book_title}».\n\n"
-            f"Продолжить чтение?"
-        )
-        
-        keyboard = {
-            'inline_keyboard': [
-                [
-                    {
-                        'text': '➡️ Продолжить чтение',
-                        'web_app': {
-                            'url': f"{os.getenv('MINI_APP_URL', 'https://your-mini-app-url.com')}/reader/{book_id}"
-                        }
-                    }
-                ]
-            ]
-        }
-        
-        await application.bot.send_message(
-            chat_id=user_id,
-            text=message,
-            reply_markup=keyboard
-        )
-        
-        logger.info(f"Unfinished reminder sent to user {user_id} for book {book_id}")
+        async with job_run('inactive_users'):
+            await refresh_affinity()
+            await run_sharded('inactive_users', check_inactive_users_shard)
     except Exception as e:
-        logger.error(f"Error sending unfinished reminder to user {user_id}: {e}")
+        logger.error(f"Error checking inactive users: {e}")
 
-async def send_new_book_notification(application, user_id: int, book: dict, genre: str):
-    """Send new book notification."""
-    try:
-        caption = (
-            f"🆕 Новая книга в жанре {genre}!\n\n"
-            f"📕 {book['title']}\n"
-            f"✍️ {book['author']}\n"
-            f"💰 {'Бесплатно' if book['price'] == 0 else f'{book['price']}₽'}"
-        )
-        
-        keyboard = {
-            'inline_keyboard': [
-                [
-                    {
-                        'text': '📚 Посмотреть книгу',
-                        'web_app': {
-                            'url': f"{os.getenv('MINI_APP_URL', 'https://your-mini-app-url.com')}?startapp=book_{book['id']}"
-                        }
-                    }
-                ]
-            ]
-        }
-        
-        await application.bot.send_photo(
-            chat_id=user_id,
-            photo=book['coverUrl'],
-            caption=caption,
-            reply_markup=keyboard
-        )
-        
-        logger.info(f"New book notification sent to user {user_id} for book {book['id']}")
-    except Exception as e:
-        logger.error(f"Error sending new book notification to user {user_id}: {e}")
+async def check_inactive_users_shard(conn, shard: Shard):
+    # Users become due once they haven't been active for 3 days
+    now = await db_now(conn)
+    three_days_ago = now - timedelta(days=3)
 
-async def check_inactive_users(context: ContextTypes.DEFAULT_TYPE):
-    """Check for inactive users and send reminders."""
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+    # Count new books per genre once for the whole run
+    cur = await conn.execute("""
+        SELECT g.name, COUNT(*)
+        FROM "Book" b
+        JOIN "_BookToGenre" btg ON b.id = btg."A"
+        JOIN "Genre" g ON btg."B" = g.id
+        WHERE b."createdAt" > %s
+        GROUP BY g.name
+    """, (three_days_ago,))
 
-        # Get users who haven't been active in the last 3 days
-        three_days_ago = datetime.now() - timedelta(days=3)
+    new_books_by_genre = dict(await cur.fetchall())
 
-        cur.execute("""
-            SELECT DISTINCT u.telegram_id, ns.frequency
-            FROM "User" u
-            JOIN "NotificationSettings" ns ON u.id = ns."userId"
-            WHERE ns."telegramEnabled" = true
-            AND ns."unfinishedReminder" = true
-            AND u."lastActiveAt" < %s
-        """, (three_days_ago,))
+    # One reminder per inactivity spell, keyed by the lastActiveAt it started at
+    ledger = LedgerBatch(KIND_INACTIVE)
 
-        inactive_users = cur.fetchall()
+    async def queue_reminders(inactive_users):
+        claimed = await ledger.claim((row[0], '', row[3]) for row in inactive_users)
+        items = []
 
         for user_data in inactive_users:
-            user_id = user_data[0]
-
-            # Determine preferred genre based on user's favorites
-            cur.execute("""
-                SELECT g.name, COUNT(f.id) as count
-                FROM "Favorite" f
-                JOIN "Book" b ON f."bookId" = b.id
-                JOIN "Genre" g ON b.id = g.id
-                WHERE f."userId" = (SELECT id FROM "User" WHERE telegram_id = %s)
-                GROUP BY g.name
-                ORDER BY count DESC
-                LIMIT 1
-            """, (user_id,))
-
-            result = cur.fetchone()
-            preferred_genre = result[0] if result else "Детектив"
-
-            # Count new books in the preferred genre
-            cur.execute("""
-                SELECT COUNT(*)
-                FROM "Book" b
-                JOIN "_BookToGenre" btg ON b.id = btg."A"
-                JOIN "Genre" g ON btg."B" = g.id
-                WHERE g.name = %s AND b."createdAt" > %s
-            """, (preferred_genre, three_days_ago))
-
-            new_books_count = cur.fetchone()[0] or 5  # Default to 5 if query fails
-
-            await send_inactive_reminder(context.application, int(user_id), preferred_genre, new_books_count)
-
-        cur.close()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Error checking inactive users: {e}")
-
-async def check_unfinished_books(context: ContextTypes.DEFAULT_TYPE):
-    """Check for unfinished books and send reminders."""
+            user_id, frequency, genre, period = user_data[:4]
+            if (user_id, '', period) not in claimed:
+                continue
+
+            preferred_genre = genre or "Детектив"
+            new_books_count = new_books_by_genre.get(preferred_genre) or 5  # Default to 5 if there are none
+
+            items.append(DigestItem(KIND_INACTIVE, user_id, '', period, {
+                'genre': preferred_genre,
+                'new_books_count': new_books_count
+            }))
+
+        await queue_items(items, ledger)
+
+    # Preferred genre is the user's top entry in the affinity store
+    await scan_job(conn, shard.checkpoint_name('inactive_users'), f"""
+        SELECT u.telegram_id, ns.frequency, g.name, u."lastActiveAt"::text, u."lastActiveAt", u.id
+        FROM "User" u
+        JOIN "NotificationSettings" ns ON u.id = ns."userId"
+        LEFT JOIN LATERAL (
+            SELECT a."genreId"
+            FROM "UserGenreAffinity" a
+            WHERE a."userId" = u.id AND a."score" > 0
+            ORDER BY a."score" DESC
+            LIMIT 1
+        ) top ON true
+        LEFT JOIN "Genre" g ON g.id = top."genreId"
+        WHERE ns."telegramEnabled" = true
+        AND ns."unfinishedReminder" = true
+        AND u."lastActiveAt" < %(cutoff)s
+        AND (u."lastActiveAt", u.id) > (%(after_ts)s, %(after_id)s)
+        AND {Shard.condition('u.telegram_id')}
+        AND NOT {already_claimed('u.telegram_id', period='u."lastActiveAt"::text')}
+        AND NOT {unreachable('u.telegram_id')}
+        ORDER BY u."lastActiveAt", u.id
+        LIMIT %(limit)s
+    """, {
+        'cutoff': three_days_ago,
+        'kind': KIND_INACTIVE,
+        'claim_timeout': CLAIM_TIMEOUT,
+        **shard.params
+    }, Checkpoint(three_days_ago - JOB_INITIAL_LOOKBACK), queue_reminders)
+
+async def check_unfinished_books(application: Application):
+    """Check for books whose reading stalled since the last run and queue reminders."""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Get users with books they started reading but haven't finished
-        seven_days_ago = datetime.now() - timedelta(days=7)
-
-        cur.execute("""
-            SELECT u.telegram_id, b.title, b.id, rp.progress
-            FROM "User" u
-            JOIN "ReadingProgress" rp ON u.id = rp."userId"
-            JOIN "Book" b ON rp."bookId" = b.id
-            JOIN "NotificationSettings" ns ON u.id = ns."userId"
-            WHERE ns."telegramEnabled" = true
-            AND ns."unfinishedReminder" = true
-            AND rp.progress > 10
-            AND rp.progress < 100
-            AND rp."lastReadAt" < %s
-        """, (seven_days_ago,))
-
-        unfinished_books = cur.fetchall()
-
-        for book_data in unfinished_books:
-            user_id, title, book_id, progress = book_data
-            await send_unfinished_reminder(context.application, int(user_id), title, book_id, progress)
-
-        cur.close()
-        conn.close()
+        async with job_run('unfinished_books'):
+            await run_sharded('unfinished_books', check_unfinished_books_shard)
     except Exception as e:
         logger.error(f"Error checking unfinished books: {e}")
 
-async def check_new_books(context: ContextTypes.DEFAULT_TYPE):
-    """Check for new books in user's favorite genres and send notifications."""
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+async def check_unfinished_books_shard(conn, shard: Shard):
+    # Books become due once they haven't been opened for 7 days
+    now = await db_now(conn)
+    seven_days_ago = now - timedelta(days=7)
 
-        # Get books added in the last day
-        yesterday = datetime.now() - timedelta(days=1)
+    # One reminder per book and reading pause, keyed by its lastReadAt
+    ledger = LedgerBatch(KIND_UNFINISHED)
 
-        cur.execute("""
-            SELECT id, title, author, "coverUrl", price, "createdAt"
-            FROM "Book"
-            WHERE "createdAt" > %s
-        """, (yesterday,))
-
-        new_books = cur.fetchall()
-
-        for book_data in new_books:
-            book_id, title, author, cover_url, price, created_at = book_data
-
-            # Get genres for the new book
-            cur.execute("""
-                SELECT g.name
-                FROM "Genre" g
-                JOIN "_BookToGenre" btg ON g.id = btg."B"
-                WHERE btg."A" = %s
-            """, (book_id,))
-
-            genres = [row[0] for row in cur.fetchall()]
-
-            # For each genre of the new book, find users interested in that genre
-            for genre in genres:
-                # Get users who have books of this genre as favorite
-                cur.execute("""
-                    SELECT DISTINCT u.telegram_id
-                    FROM "User" u
-                    JOIN "Favorite" f ON u.id = f."userId"
-                    JOIN "Book" b ON f."bookId" = b.id
-                    JOIN "_BookToGenre" btg ON b.id = btg."A"
-                    JOIN "Genre" g ON btg."B" = g.id
-                    JOIN "NotificationSettings" ns ON u.id = ns."userId"
-                    WHERE ns."telegramEnabled" = true
-                    AND ns."newBooksInGenre" = true
-                    AND g.name = %s
-                """, (genre,))
-
-                users_to_notify = cur.fetchall()
-
-                book_info = {
-                    'id': book_id,
-                    'title': title,
-                    'author': author,
-                    'coverUrl': cover_url,
-                    'price': price
-                }
-
-                for user_data in users_to_notify:
-                    user_id = user_data[0]
-                    await send_new_book_notification(context.application, int(user_id), book_info, genre)
-
-        cur.close()
-        conn.close()
+    async def queue_reminders(unfinished_books):
+        claimed = await ledger.claim((row[0], row[2], row[4]) for row in unfinished_books)
+        items = []
+
+        for book_data in unfinished_books:
+            user_id, title, book_id, progress, period = book_data[:5]
+            if (user_id, book_id, period) not in claimed:
+                continue
+
+            items.append(DigestItem(KIND_UNFINISHED, user_id, book_id, period, {
+                'title': title,
+                'book_id': book_id,
+                'progress': float(progress)
+            }))
+
+        await queue_items(items, ledger)
+
+    await scan_job(conn, shard.checkpoint_name('unfinished_books'), f"""
+        SELECT u.telegram_id, b.title, b.id, rp.progress, rp."lastReadAt"::text, rp."lastReadAt", rp.id
+        FROM "ReadingProgress" rp
+        JOIN "User" u ON u.id = rp."userId"
+        JOIN "Book" b ON rp."bookId" = b.id
+        JOIN "NotificationSettings" ns ON u.id = ns."userId"
+        WHERE ns."telegramEnabled" = true
+        AND ns."unfinishedReminder" = true
+        AND rp.progress > 10
+        AND rp.progress < 100
+        AND rp."lastReadAt" < %(cutoff)s
+        AND (rp."lastReadAt", rp.id) > (%(after_ts)s, %(after_id)s)
+        AND {Shard.condition('u.telegram_id')}
+        AND NOT {already_claimed('u.telegram_id', 'b.id', 'rp."lastReadAt"::text')}
+        AND NOT {unreachable('u.telegram_id')}
+        ORDER BY rp."lastReadAt", rp.id
+        LIMIT %(limit)s
+    """, {
+        'cutoff': seven_days_ago,
+        'kind': KIND_UNFINISHED,
+        'claim_timeout': CLAIM_TIMEOUT,
+        **shard.params
+    }, Checkpoint(seven_days_ago - JOB_INITIAL_LOOKBACK), queue_reminders)
+
+async def check_new_books(application: Application):
+    """Check for books added since the last run in user's favorite genres and queue notifications."""
+    try:
+        async with job_run('new_books'):
+            await refresh_affinity()
+            await run_sharded('new_books', check_new_books_shard)
     except Exception as e:
         logger.error(f"Error checking new books: {e}")
 
-def setup_scheduler():
-    """Set up the notification scheduler."""
-    scheduler = AsyncIOScheduler()
-    
-    # Schedule checks:
-    # - Inactive users check daily at 10 AM
-    scheduler.add_job(check_inactive_users, CronTrigger(hour=10, minute=0))
-    
-    # - Unfinished books check daily at 8 PM
-    scheduler.add_job(check_unfinished_books, CronTrigger(hour=20, minute=0))
-    
-    # - New books check every 6 hours
-    scheduler.add_job(check_new_books, CronTrigger(hour='*/6', minute=0))
-    
-    scheduler.start()
-    logger.info("Scheduler started")
-    
-    return scheduler
\ No newline at end of file
+async def check_new_books_shard(conn, shard: Shard):
+    # Leave a margin so rows from transactions still in flight aren't skipped
+    now = await db_now(conn)
+    settled = now - JOB_SETTLE_MARGIN
+
+    async def queue_targets(new_books):
+        # The scan keeps committing on `conn`, which would close the targets cursor
+        async with get_pool().connection() as targets_conn:
+            book_ids = [row[1] for row in new_books]
+            await queue_new_book_targets(targets_conn, book_ids, shard)
+
+    # Every shard walks the same books with its own checkpoint
+    await scan_job(conn, shard.checkpoint_name('new_books'), """
+        SELECT "createdAt", id
+        FROM "Book"
+        WHERE "createdAt" <= %(settled)s
+        AND ("createdAt", id) > (%(after_ts)s, %(after_id)s)
+        ORDER BY "createdAt", id
+        LIMIT %(limit)s
+    """, {'settled': settled}, Checkpoint(now - timedelta(days=1)), queue_targets)
+
+async def queue_new_book_targets(conn, book_ids: list, shard: Shard):
+    """Queue notifications about `book_ids` for the users of `shard`."""
+    # Resolve every (user, book) target in one query.
+    # A user who likes several genres of the same book gets a single row,
+    # captioned with the genre they have the highest affinity for.
+    cur = conn.cursor(name='new_book_targets')
+    await cur.execute(f"""
+        WITH new_books AS (
+            SELECT id, title, author, "coverUrl", price
+            FROM "Book"
+            WHERE id = ANY(%(book_ids)s)
+        ),
+        new_book_genres AS (
+            SELECT btg."A" AS book_id, btg."B" AS genre_id
+            FROM "_BookToGenre" btg
+            JOIN new_books nb ON nb.id = btg."A"
+        ),
+        liked_genres AS (
+            SELECT a."userId" AS user_id, a."genreId" AS genre_id, a."score"
+            FROM "UserGenreAffinity" a
+            WHERE a."genreId" IN (SELECT genre_id FROM new_book_genres)
+            AND a."score" > 0
+        )
+        SELECT DISTINCT ON (u.telegram_id, nb.id)
+            u.telegram_id, nb.id, nb.title, nb.author, nb."coverUrl", nb.price, g.name
+        FROM new_book_genres nbg
+        JOIN new_books nb ON nb.id = nbg.book_id
+        JOIN "Genre" g ON g.id = nbg.genre_id
+        JOIN liked_genres lg ON lg.genre_id = nbg.genre_id
+        JOIN "User" u ON u.id = lg.user_id
+        JOIN "NotificationSettings" ns ON u.id = ns."userId"
+        WHERE ns."telegramEnabled" = true
+        AND ns."newBooksInGenre" = true
+        AND u.telegram_id IS NOT NULL
+        AND {Shard.condition('u.telegram_id')}
+        AND NOT {already_claimed('u.telegram_id', 'nb.id')}
+        AND NOT {unreachable('u.telegram_id')}
+        ORDER BY u.telegram_id, nb.id, lg."score" DESC, g.name
+    """, {
+        'book_ids': book_ids,
+        'kind': KIND_NEW_BOOK,
+        'claim_timeout': CLAIM_TIMEOUT,
+        **shard.params
+    })
+
+    # Each book is announced to a user once
+    ledger = LedgerBatch(KIND_NEW_BOOK)
+
+    async def queue_chunk(targets):
+        JOB_ROWS.inc(len(targets), job='new_books', stage='targets')
+        claimed = await ledger.claim((row[0], row[1], '') for row in targets)
+        items = []
+
+        for target in targets:
+            user_id, book_id, title, author, cover_url, price, genre = target
+            if (user_id, book_id, '') not in claimed:
+                continue
+
+            book_info = {
+                'id': book_id,
+                'title': title,
+                'author': author,
+                'coverUrl': cover_url,
+                'price': price
+            }
+
+            items.append(DigestItem(KIND_NEW_BOOK, user_id, book_id, '', {
+                'book': book_info,
+                'genre': genre
+            }))
+
+        await queue_items(items, ledger)
+
+    # The next chunk streams in from the cursor while this one is claimed and queued
+    await pipeline(fetch_chunks(cur, NEW_BOOK_TARGETS_CHUNK_SIZE), queue_chunk)
+    await cur.close()
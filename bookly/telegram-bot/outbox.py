@@ -0,0 +1,296 @@
+import asyncio
+import logging
+import os
+from datetime import timedelta
+from typing import List, Optional
+
+from telegram.error import BadRequest, NetworkError, TelegramError
+
+from db import get_pool
+from digest import DigestItem, render_message
+from dispatcher import chain_callbacks, get_dispatcher
+from ledger import KIND_INACTIVE, KIND_NEW_BOOK, KIND_UNFINISHED, LedgerBatch
+from metrics import OUTBOX_RESULTS, UNREACHABLE_CHATS, job_run
+from reachability import ReachabilityBatch, unreachable_reason
+
+logger = logging.getLogger(__name__)
+
+# Messages claimed per round. No more are claimed while the dispatcher has
+# that many queued, so a claimed message starts sending well within its lease.
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '200'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL_SECONDS', '2'))
+
+# A claimed message not resolved within the lease, e.g. because its sender
+# died, is picked up again by another sender
+OUTBOX_LEASE = timedelta(minutes=int(os.getenv('OUTBOX_LEASE_MINUTES', '10')))
+
+# Transient failures are retried with exponential backoff, then dead-lettered
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_RETRY_BASE = 60
+OUTBOX_RETRY_MAX = 60 * 60
+
+# Delivered and dead-lettered messages are kept this long for inspection
+OUTBOX_SENT_RETENTION = timedelta(days=7)
+OUTBOX_DEAD_RETENTION = timedelta(days=30)
+
+# Reasons a message is dead-lettered
+DEAD_UNREACHABLE = 'unreachable'
+DEAD_REJECTED = 'rejected'
+DEAD_EXHAUSTED = 'exhausted'
+
+def dead_reason(error: Exception) -> Optional[str]:
+    """Why `error` can never succeed on retry, or None if it is transient."""
+    if unreachable_reason(error):
+        # Blocked by the user, account deleted or chat gone
+        return DEAD_UNREACHABLE
+    if isinstance(error, BadRequest):
+        return DEAD_REJECTED
+    if isinstance(error, NetworkError):
+        return None
+    if isinstance(error, TelegramError):
+        return DEAD_REJECTED
+    return None
+
+def retry_delay(attempts: int) -> float:
+    return min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+
+class OutboxResults:
+    """
+    Collects delivery outcomes and writes them back to the outbox, the
+    ledger and the unreachable chat registry in bulk.
+    """
+
+    def __init__(self):
+        self.ledgers = {kind: LedgerBatch(kind) for kind in (KIND_INACTIVE, KIND_UNFINISHED, KIND_NEW_BOOK)}
+        self.chats = ReachabilityBatch()
+        # (id, status, lastError, deadReason, retry delay in seconds)
+        self._rows = []
+
+    def callbacks(self, row_id: int, attempts: int, items: List[DigestItem], recheck: bool = False):
+        async def on_sent(message):
+            self.record_sent(row_id, items)
+            if recheck:
+                # The chat was registered as unreachable and has come back
+                self.chats.record_reachable(items[0].telegram_id)
+
+        async def on_failed(error):
+            self.record_failed(row_id, attempts, items, error)
+
+        return on_sent, on_failed
+
+    def record_sent(self, row_id: int, items: List[DigestItem]) -> None:
+        OUTBOX_RESULTS.inc(status='sent', reason='')
+        self._rows.append((row_id, 'sent', None, None, 0))
+        for item in items:
+            self.ledgers[item.kind].record_sent(item.key)
+
+    def record_failed(self, row_id: int, attempts: int, items: List[DigestItem],
+                      error: Optional[Exception], reason: Optional[str] = None) -> None:
+        reason = reason or dead_reason(error)
+        error_text = str(error) if error else None
+        if reason is None and attempts >= OUTBOX_MAX_ATTEMPTS:
+            reason = DEAD_EXHAUSTED
+
+        if reason is None:
+            OUTBOX_RESULTS.inc(status='retry', reason='')
+            self._rows.append((row_id, 'pending', error_text, None, retry_delay(attempts)))
+            return
+
+        OUTBOX_RESULTS.inc(status='dead', reason=reason)
+        self._rows.append((row_id, 'dead', error_text, reason, 0))
+        chat_reason = unreachable_reason(error)
+        if chat_reason:
+            self.chats.record_unreachable(items[0].telegram_id, chat_reason, error)
+        # Released, so the same notification may be produced again later
+        for item in items:
+            self.ledgers[item.kind].record_failed(item.key)
+
+    async def flush(self) -> None:
+        rows, self._rows = self._rows, []
+        if rows:
+            async with get_pool().connection() as conn:
+                await conn.execute("""
+                    UPDATE "NotificationOutbox" o
+                    SET "status" = r.status,
+                        "lastError" = COALESCE(r.error, o."lastError"),
+                        "deadReason" = r.reason,
+                        "sentAt" = CASE WHEN r.status = 'sent' THEN LOCALTIMESTAMP END,
+                        "availableAt" = LOCALTIMESTAMP + r.delay * interval '1 second'
+                    FROM unnest(%s::bigint[], %s::text[], %s::text[], %s::text[], %s::float8[])
+                        AS r(id, status, error, reason, delay)
+                    WHERE o.id = r.id
+                """, [list(column) for column in zip(*rows)])
+
+        for ledger in self.ledgers.values():
+            await ledger.flush()
+        await self.chats.flush()
+
+def lease_check(row_id: int, attempts: int):
+    """
+    before_send callback of an outbox message: renews the lease if this
+    claim still holds it. A message that sat in the dispatcher queue past
+    its lease may have been claimed and sent by another sender meanwhile.
+    """
+    async def still_leased() -> bool:
+        async with get_pool().connection() as conn:
+            cur = await conn.execute("""
+                UPDATE "NotificationOutbox"
+                SET "availableAt" = LOCALTIMESTAMP + %s
+                WHERE id = %s AND "status" = 'sending' AND "attempts" = %s
+            """, (OUTBOX_LEASE, row_id, attempts))
+        if cur.rowcount == 1:
+            return True
+        OUTBOX_RESULTS.inc(status='superseded', reason='')
+        return False
+
+    return still_leased
+
+async def _claim(conn, limit: int) -> list:
+    """
+    Lease up to `limit` ready messages. Rows leased by other senders are
+    skipped. Each row comes with whether its chat is in the unreachable
+    registry and whether it is still suppressed there.
+    """
+    async with conn.transaction():
+        cur = await conn.execute("""
+            WITH ready AS (
+                SELECT o.id, uc."recheckAt"
+                FROM "NotificationOutbox" o
+                LEFT JOIN "UnreachableChat" uc ON uc."telegramId" = o."telegramId"
+                WHERE o."status" IN ('pending', 'sending')
+                AND o."availableAt" <= LOCALTIMESTAMP
+                AND o."attempts" < %(max_attempts)s
+                ORDER BY o."availableAt", o.id
+                LIMIT %(limit)s
+                FOR UPDATE OF o SKIP LOCKED
+            )
+            UPDATE "NotificationOutbox" o
+            SET "status" = 'sending',
+                "attempts" = o."attempts" + 1,
+                "availableAt" = LOCALTIMESTAMP + %(lease)s
+            FROM ready
+            WHERE o.id = ready.id
+            RETURNING o.id, o."telegramId", o."items", o."attempts",
+                      ready."recheckAt" IS NOT NULL,
+                      COALESCE(ready."recheckAt" > LOCALTIMESTAMP, false)
+        """, {'max_attempts': OUTBOX_MAX_ATTEMPTS, 'limit': limit, 'lease': OUTBOX_LEASE})
+        return await cur.fetchall()
+
+async def send_outbox_batch(results: OutboxResults) -> int:
+    """Claim one batch of ready messages and hand it to the dispatcher. Returns the batch size."""
+    dispatcher = get_dispatcher()
+    while dispatcher.backlog >= OUTBOX_BATCH_SIZE:
+        await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+    async with get_pool().connection() as conn:
+        rows = await _claim(conn, OUTBOX_BATCH_SIZE)
+
+    for row_id, telegram_id, raw_items, attempts, known, suppressed in rows:
+        items = [
+            DigestItem(item['kind'], telegram_id, item['subject'], item['period'], item['payload'])
+            for item in raw_items
+        ]
+        if suppressed:
+            # Queued before the chat was found unreachable; not worth an API call
+            UNREACHABLE_CHATS.inc(event='suppressed')
+            results.record_failed(row_id, attempts, items, None, reason=DEAD_UNREACHABLE)
+            continue
+
+        try:
+            message = await render_message(telegram_id, items)
+        except Exception as e:
+            logger.error(f"Error rendering outbox message {row_id}: {e}")
+            results.record_failed(row_id, attempts, items, e, reason=DEAD_REJECTED)
+            continue
+
+        on_sent, on_failed = results.callbacks(row_id, attempts, items, recheck=known)
+        message.on_sent = chain_callbacks(message.on_sent, on_sent)
+        message.on_failed = chain_callbacks(message.on_failed, on_failed)
+        message.before_send = lease_check(row_id, attempts)
+        await dispatcher.submit(message)
+
+    # Outcomes of messages still in flight are written with a later batch
+    await results.flush()
+    return len(rows)
+
+async def send_outbox() -> int:
+    """Send every ready message and wait for the deliveries. Returns the number of messages."""
+    results = OutboxResults()
+    total = 0
+    async with job_run('outbox'):
+        while claimed := await send_outbox_batch(results):
+            total += claimed
+        await get_dispatcher().drain()
+        await results.flush()
+    return total
+
+async def cleanup_outbox() -> int:
+    """Dead-letter messages that kept losing their lease and drop old delivered and dead ones."""
+    async with job_run('outbox_cleanup'), get_pool().connection() as conn:
+        await conn.execute("""
+            UPDATE "NotificationOutbox"
+            SET "status" = 'dead', "deadReason" = %s
+            WHERE "status" IN ('pending', 'sending')
+            AND "attempts" >= %s
+            AND "availableAt" <= LOCALTIMESTAMP
+        """, (DEAD_EXHAUSTED, OUTBOX_MAX_ATTEMPTS))
+        cur = await conn.execute("""
+            DELETE FROM "NotificationOutbox"
+            WHERE ("status" = 'sent' AND "sentAt" < LOCALTIMESTAMP - %s)
+            OR ("status" = 'dead' AND "availableAt" < LOCALTIMESTAMP - %s)
+        """, (OUTBOX_SENT_RETENTION, OUTBOX_DEAD_RETENTION))
+    logger.info(f"Removed {cur.rowcount} old outbox messages")
+    return cur.rowcount
+
+class OutboxSender:
+    """Drains the outbox continuously. Any number of senders can run side by side."""
+
+    def __init__(self, poll_interval: float = OUTBOX_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._results = OutboxResults()
+        self._task = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name='outbox-sender')
+        logger.info("Outbox sender started")
+
+    async def stop(self) -> None:
+        """Stop claiming, wait for what was handed to the dispatcher and record it."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        await get_dispatcher().drain()
+        await self._results.flush()
+        logger.info("Outbox sender stopped")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                claimed = await send_outbox_batch(self._results)
+            except Exception as e:
+                logger.error(f"Error sending outbox messages: {e}")
+                claimed = 0
+
+            if not claimed:
+                await asyncio.sleep(self.poll_interval)
+
+_sender = None
+
+async def start_outbox_sender() -> OutboxSender:
+    """Start the shared outbox sender. Called once at startup, after the dispatcher."""
+    global _sender
+    if _sender is None:
+        _sender = OutboxSender()
+        await _sender.start()
+    return _sender
+
+async def stop_outbox_sender() -> None:
+    """Stop the shared outbox sender. Called on shutdown, before the dispatcher."""
+    global _sender
+    if _sender is None:
+        return
+
+    await _sender.stop()
+    _sender = None
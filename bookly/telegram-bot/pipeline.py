@@ -0,0 +1,57 @@
+import asyncio
+import os
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+# Chunks read ahead of the stage that processes them. Memory held by a
+# pipeline is bounded by (PIPELINE_QUEUE_SIZE + 2) chunks however large
+# the result set is.
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '2'))
+
+T = TypeVar('T')
+
+_DONE = object()
+
+async def pipeline(source: AsyncIterator[T], stage: Callable[[T], Awaitable[None]],
+                   maxsize: int = PIPELINE_QUEUE_SIZE) -> int:
+    """
+    Feed the chunks of `source` to `stage` through a bounded queue, so the
+    next chunk is read while the previous one is processed. Chunks are
+    processed one at a time and in order; the reader waits whenever the
+    queue is full. An error on either side stops both and is re-raised.
+    Returns the number of chunks processed.
+    """
+    queue = asyncio.Queue(maxsize=maxsize)
+
+    async def read():
+        try:
+            async for chunk in source:
+                await queue.put(chunk)
+        except Exception as e:
+            await queue.put(_Failed(e))
+        else:
+            await queue.put(_DONE)
+
+    reader = asyncio.create_task(read())
+    processed = 0
+    try:
+        while (chunk := await queue.get()) is not _DONE:
+            if isinstance(chunk, _Failed):
+                raise chunk.error
+            await stage(chunk)
+            processed += 1
+    finally:
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+        if hasattr(source, 'aclose'):
+            await source.aclose()
+
+    return processed
+
+class _Failed:
+    def __init__(self, error: Exception):
+        self.error = error
+
+async def fetch_chunks(cur, size: int) -> AsyncIterator[list]:
+    """Yield the rows of `cur`, a server-side cursor usually, `size` at a time."""
+    while rows := await cur.fetchmany(size):
+        yield rows
@@ -0,0 +1,94 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Jobs whose next run is sampled, comma-separated (e.g. "new_books,digest").
+# Each listed job is profiled once per process; PROFILE_JOBS=* profiles every run.
+PROFILE_JOBS = {job.strip() for job in os.getenv('PROFILE_JOBS', '').split(',') if job.strip()}
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL_MS', '5')) / 1000
+PROFILE_DIR = Path(os.getenv('PROFILE_DIR', 'profiles'))
+
+# Stack depth kept per sample
+MAX_STACK_DEPTH = 64
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread at a fixed interval from a background
+    thread. The result is written in the collapsed-stack format read by
+    flamegraph.pl and speedscope. Overhead is a few microseconds per sample
+    and nothing at all while no profiler is running.
+    """
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+_profiled = set()
+
+def _should_profile(job: str) -> bool:
+    if '*' in PROFILE_JOBS:
+        return True
+    return job in PROFILE_JOBS and job not in _profiled
+
+@contextmanager
+def maybe_profile(job: str):
+    """Sample the calling thread for the duration of the block if `job` is selected."""
+    if not _should_profile(job):
+        yield
+        return
+
+    _profiled.add(job)
+    profiler = SamplingProfiler(threading.get_ident())
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        path = PROFILE_DIR / f"{job}-{time.strftime('%Y%m%d-%H%M%S')}.collapsed"
+        profiler.write(path)
+        logger.info(f"Profile of job {job} written to {path} ({profiler.samples} samples)")
+
+def profile_next_run(job: str) -> None:
+    """Select `job` for profiling on its next run, e.g. from a debugging shell."""
+    PROFILE_JOBS.add(job)
+    _profiled.discard(job)
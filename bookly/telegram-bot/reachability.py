@@ -0,0 +1,120 @@
+import logging
+import os
+from datetime import timedelta
+from typing import Dict, Optional, Tuple
+
+from telegram.error import BadRequest, Forbidden
+
+from db import get_pool
+from metrics import UNREACHABLE_CHATS, job_run
+
+logger = logging.getLogger(__name__)
+
+# Why a chat cannot receive messages
+REASON_BLOCKED = 'blocked'
+REASON_DEACTIVATED = 'deactivated'
+REASON_NOT_FOUND = 'not_found'
+
+# A chat is left alone this long after its first failure. Every failed
+# re-check doubles the wait, up to UNREACHABLE_RECHECK_MAX.
+UNREACHABLE_RECHECK_AFTER = timedelta(days=int(os.getenv('UNREACHABLE_RECHECK_DAYS', '7')))
+UNREACHABLE_RECHECK_MAX = timedelta(days=int(os.getenv('UNREACHABLE_RECHECK_MAX_DAYS', '90')))
+
+# Entries whose re-check has been due this long without another failure
+# are deleted by cleanup_unreachable()
+UNREACHABLE_TTL = timedelta(days=int(os.getenv('UNREACHABLE_TTL_DAYS', '180')))
+
+def unreachable_reason(error: Exception) -> Optional[str]:
+    """Why `error` means the chat cannot be messaged at all, or None if it does not."""
+    description = str(error).lower()
+    if isinstance(error, Forbidden):
+        return REASON_DEACTIVATED if 'deactivated' in description else REASON_BLOCKED
+    if isinstance(error, BadRequest) and 'chat not found' in description:
+        return REASON_NOT_FOUND
+    return None
+
+def unreachable(telegram_id: str) -> str:
+    """SQL condition for recipient queries: true while the chat is known to be unreachable."""
+    return f"""EXISTS (
+        SELECT 1 FROM "UnreachableChat" uc
+        WHERE uc."telegramId" = {telegram_id}
+        AND uc."recheckAt" > LOCALTIMESTAMP
+    )"""
+
+class ReachabilityBatch:
+    """
+    Collects chats found unreachable, and chats that turned out reachable
+    again on a re-check, and writes them to the registry in bulk.
+    """
+
+    def __init__(self):
+        self._unreachable: Dict[str, Tuple[str, str]] = {}
+        self._reachable = set()
+
+    def record_unreachable(self, telegram_id: str, reason: str, error: Exception) -> None:
+        self._reachable.discard(telegram_id)
+        self._unreachable[telegram_id] = (reason, str(error))
+
+    def record_reachable(self, telegram_id: str) -> None:
+        self._unreachable.pop(telegram_id, None)
+        self._reachable.add(telegram_id)
+
+    async def flush(self) -> None:
+        unreachable, self._unreachable = self._unreachable, {}
+        reachable, self._reachable = self._reachable, set()
+        if not unreachable and not reachable:
+            return
+
+        async with get_pool().connection() as conn:
+            if unreachable:
+                reasons, errors = zip(*unreachable.values())
+                await conn.execute("""
+                    INSERT INTO "UnreachableChat" (
+                        "telegramId", "reason", "lastError", "failures",
+                        "firstFailedAt", "lastFailedAt", "recheckAt"
+                    )
+                    SELECT c.telegram_id, c.reason, c.error, 1,
+                           LOCALTIMESTAMP, LOCALTIMESTAMP, LOCALTIMESTAMP + %(after)s
+                    FROM unnest(%(ids)s::text[], %(reasons)s::text[], %(errors)s::text[])
+                        AS c(telegram_id, reason, error)
+                    ON CONFLICT ("telegramId") DO UPDATE
+                    SET "reason" = EXCLUDED."reason",
+                        "lastError" = EXCLUDED."lastError",
+                        "failures" = "UnreachableChat"."failures" + 1,
+                        "lastFailedAt" = EXCLUDED."lastFailedAt",
+                        "recheckAt" = LOCALTIMESTAMP + LEAST(
+                            %(after)s * power(2, "UnreachableChat"."failures"), %(max)s
+                        )
+                """, {
+                    'ids': list(unreachable),
+                    'reasons': list(reasons),
+                    'errors': list(errors),
+                    'after': UNREACHABLE_RECHECK_AFTER,
+                    'max': UNREACHABLE_RECHECK_MAX
+                })
+                UNREACHABLE_CHATS.inc(len(unreachable), event='registered')
+
+            if reachable:
+                cur = await conn.execute(
+                    'DELETE FROM "UnreachableChat" WHERE "telegramId" = ANY(%s::text[])',
+                    (list(reachable),)
+                )
+                UNREACHABLE_CHATS.inc(cur.rowcount, event='cleared')
+
+async def mark_reachable(telegram_id: str) -> None:
+    """Forget a chat's failures, e.g. because the user just wrote to the bot."""
+    async with get_pool().connection() as conn:
+        cur = await conn.execute('DELETE FROM "UnreachableChat" WHERE "telegramId" = %s', (telegram_id,))
+    if cur.rowcount:
+        UNREACHABLE_CHATS.inc(event='cleared')
+        logger.info(f"Chat {telegram_id} is reachable again")
+
+async def cleanup_unreachable() -> int:
+    """Delete entries whose re-check has been due for UNREACHABLE_TTL."""
+    async with job_run('unreachable_cleanup'), get_pool().connection() as conn:
+        cur = await conn.execute(
+            'DELETE FROM "UnreachableChat" WHERE "recheckAt" < LOCALTIMESTAMP - %s',
+            (UNREACHABLE_TTL,)
+        )
+    logger.info(f"Removed {cur.rowcount} stale unreachable chat entries")
+    return cur.rowcount
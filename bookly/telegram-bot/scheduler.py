@@ -1,6 +1,12 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from notifications import check_inactive_users, check_unfinished_books, check_new_books
+from affinity import refresh_affinity, rebuild_affinity
+from ledger import cleanup_ledger
+from digest import DIGEST_FLUSH_INTERVAL_MINUTES, flush_digests
+from delivery import refresh_delivery_slots
+from outbox import cleanup_outbox
+from reachability import cleanup_unreachable
 from telegram.ext import Application
 
 def setup_scheduler(application: Application):
@@ -17,6 +23,23 @@ def setup_scheduler(application: Application):
     # - New books check every 6 hours
     scheduler.add_job(check_new_books, CronTrigger(hour='*/6', minute=0), args=(application,))
     
+    # - Genre affinity: incremental refresh every 30 minutes,
+    #   full rebuild weekly to drop removed favorites
+    scheduler.add_job(refresh_affinity, CronTrigger(minute='15,45'))
+    scheduler.add_job(rebuild_affinity, CronTrigger(day_of_week='sun', hour=4, minute=30))
+    
+    # - Pending notifications are moved to the outbox as per-user digests,
+    #   each user's inside the window after their usual active hour;
+    #   the outbox sender started in post_init delivers them
+    scheduler.add_job(flush_digests, CronTrigger(minute=f'*/{DIGEST_FLUSH_INTERVAL_MINUTES}'))
+    scheduler.add_job(refresh_delivery_slots, CronTrigger(hour=4, minute=0))
+    
+    # - Expired ledger entries, old outbox messages and stale unreachable
+    #   chat entries are removed nightly
+    scheduler.add_job(cleanup_ledger, CronTrigger(hour=3, minute=0))
+    scheduler.add_job(cleanup_outbox, CronTrigger(hour=3, minute=10))
+    scheduler.add_job(cleanup_unreachable, CronTrigger(hour=3, minute=20))
+    
     # Start the scheduler
     scheduler.start()
     print("Scheduler started")
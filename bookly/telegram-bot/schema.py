@@ -0,0 +1,9 @@
+# Names shared by the database triggers, created in migrations.py, and the
+# code listening to them
+
+# Channel the new-book triggers notify with comma-separated ids of new books
+NEW_BOOK_CHANNEL = 'bookly_new_books'
+
+# Channel the reading progress triggers notify with comma-separated telegram
+# ids of users whose reading progress changed
+READING_PROGRESS_CHANNEL = 'bookly_reading_progress'
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from psycopg import AsyncConnection
+
+from checkpoints import Checkpoint, get_checkpoint, save_checkpoint
+from db import get_pool
+from metrics import JOB_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Every job's users are split into this many hash shards by telegram_id.
+# Checkpoints are kept per shard, so after a change every new shard starts
+# from the oldest checkpoint of the previous shards: rows the others had
+# already passed are scanned again, and the ledger skips what was sent.
+JOB_SHARDS = int(os.getenv('JOB_SHARDS', '8'))
+
+# Shards one bot process works on at the same time. A shard holds its scan
+# connection plus one for the page in progress (two for new_books), so keep
+# this well under DB_POOL_MAX_SIZE / 3.
+JOB_SHARD_CONCURRENCY = int(os.getenv('JOB_SHARD_CONCURRENCY', '2'))
+
+# Shards held by another replica are retried until it lets go of them
+SHARD_RETRY_DELAY = 5
+SHARD_RUN_TIMEOUT = 15 * 60
+
+@dataclass(frozen=True)
+class Shard:
+    index: int
+    count: int
+
+    @property
+    def name(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    def checkpoint_name(self, job: str) -> str:
+        return f"{job}:{self.name}"
+
+    @property
+    def params(self) -> dict:
+        return {'shard_index': self.index, 'shard_count': self.count}
+
+    @staticmethod
+    def condition(column: str) -> str:
+        """SQL condition selecting rows of this shard; takes the `params` placeholders."""
+        return f"mod(abs(hashtext({column})), %(shard_count)s) = %(shard_index)s"
+
+async def run_sharded(job: str, process: Callable[[AsyncConnection, Shard], Awaitable[None]]) -> None:
+    """
+    Run `process` for every shard of `job` that no other replica is working
+    on, holding a Postgres advisory lock per shard. `process` gets the
+    connection holding the lock, to scan the shard with. Shards that are locked
+    elsewhere are retried once released; because the jobs resume from their
+    checkpoints, this picks up the shards of a replica that died and is
+    close to a no-op for shards another replica already finished.
+    """
+    await _carry_over_checkpoints(job)
+
+    semaphore = asyncio.Semaphore(JOB_SHARD_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHARD_RUN_TIMEOUT
+    pending = list(range(JOB_SHARDS))
+
+    while pending:
+        done = await asyncio.gather(*(
+            _try_shard(job, Shard(index, JOB_SHARDS), process, semaphore)
+            for index in pending
+        ))
+        pending = [index for index, finished in zip(pending, done) if not finished]
+
+        if pending:
+            if loop.time() > deadline:
+                logger.warning(f"Job {job}: shards {pending} still locked by other replicas, giving up")
+                return
+            await asyncio.sleep(SHARD_RETRY_DELAY)
+
+async def _carry_over_checkpoints(job: str) -> None:
+    """
+    Start the shards of `job` that have no checkpoint yet from the oldest
+    checkpoint left by a different JOB_SHARDS, then drop those.
+    """
+    shards = [Shard(index, JOB_SHARDS) for index in range(JOB_SHARDS)]
+    async with get_pool().connection() as conn:
+        async with conn.transaction():
+            # Replicas starting the same job together carry over once
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"{job}:checkpoints",))
+            cur = await conn.execute("""
+                SELECT "position", "lastId" FROM "BotCheckpoint"
+                WHERE starts_with("name", %s) AND split_part("name", '/', 2) <> %s
+                ORDER BY "position", "lastId"
+                LIMIT 1
+            """, (f"{job}:", str(JOB_SHARDS)))
+            oldest = await cur.fetchone()
+            if oldest is None:
+                return
+
+            for shard in shards:
+                name = shard.checkpoint_name(job)
+                if await get_checkpoint(conn, name) is None:
+                    await save_checkpoint(conn, name, Checkpoint(*oldest))
+            await conn.execute("""
+                DELETE FROM "BotCheckpoint"
+                WHERE starts_with("name", %s) AND split_part("name", '/', 2) <> %s
+            """, (f"{job}:", str(JOB_SHARDS)))
+    logger.info(f"Job {job}: checkpoints carried over to {JOB_SHARDS} shards from {oldest[0]}")
+
+async def _try_shard(job: str, shard: Shard, process, semaphore: asyncio.Semaphore) -> bool:
+    async with semaphore:
+        # Session-level lock: released on unlock or when the connection dies,
+        # so it outlives the commits `process` makes on the same connection
+        async with get_pool().connection() as conn:
+            cur = await conn.execute(
+                "SELECT pg_try_advisory_lock(hashtext(%s), %s)",
+                (job, shard.index)
+            )
+            locked = (await cur.fetchone())[0]
+            await conn.commit()
+            if not locked:
+                return False
+
+            try:
+                await process(conn, shard)
+            except Exception as e:
+                # The shard's checkpoint did not move, so the next run retries it
+                JOB_ERRORS.inc(job=job)
+                logger.error(f"Error running job {job} on shard {shard.name}: {e}")
+            finally:
+                # `process` may have left a failed transaction behind
+                await conn.rollback()
+                await conn.execute(
+                    "SELECT pg_advisory_unlock(hashtext(%s), %s)",
+                    (job, shard.index)
+                )
+                await conn.commit()
+
+    return True
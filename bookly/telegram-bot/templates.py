@@ -0,0 +1,105 @@
+import json
+import os
+from functools import lru_cache
+from typing import Iterable
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Read once at startup rather than for every message
+MINI_APP_URL = os.getenv('MINI_APP_URL', 'https://your-mini-app-url.com')
+
+# Rendered fragments kept per template, e.g. one keyboard per book
+TEMPLATE_CACHE_SIZE = int(os.getenv('TEMPLATE_CACHE_SIZE', '4096'))
+
+INACTIVE_TEXT = (
+    "📚 Привет! Мы скучали по тебе.\n\n"
+    "В библиотеке появилось {count} новых книг в жанре {genre}.\n\n"
+    "Продолжи читать любимые книги или открой что-то новое!"
+)
+UNFINISHED_TEXT = (
+    "📖 Вы остановились на {progress:.0f}% книги «{title}».\n\n"
+    "Продолжить чтение?"
+)
+NEW_BOOK_CAPTION = (
+    "🆕 Новая книга в жанре {genre}!\n\n"
+    "📕 {title}\n"
+    "✍️ {author}\n"
+    "💰 {price}"
+)
+BOOK_CARD = (
+    "📕 {title}\n"
+    "✍️ {author}\n"
+    "💰 {price}"
+)
+
+SUMMARY_HEADER = "📬 Что нового в Bookly:"
+SUMMARY_INACTIVE_LINE = "📚 В библиотеке появилось {count} новых книг в жанре {genre}."
+SUMMARY_UNFINISHED_LINE = "📖 «{title}» — прочитано {progress:.0f}%."
+SUMMARY_NEW_BOOK_LINE = "🆕 «{title}», {author} — новинка в жанре {genre}."
+SUMMARY_MORE_LINE = "…и ещё {count} — всё в библиотеке."
+
+CONTINUE_READING_HEADER = "📚 Продолжить чтение:"
+CONTINUE_READING_LINE = SUMMARY_UNFINISHED_LINE
+
+def mini_app_url(path: str = '') -> str:
+    return f"{MINI_APP_URL}{path}"
+
+def web_app_button(text: str, url: str) -> dict:
+    return {'text': text, 'web_app': {'url': url}}
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+# Keyboards are passed to the Bot API as JSON strings, which python-telegram-bot
+# sends as they are instead of serializing the markup again for every message.
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def web_app_row(text: str, path: str = '') -> str:
+    """One serialized keyboard row holding a single Mini App button."""
+    return _dumps([web_app_button(text, mini_app_url(path))])
+
+def inline_keyboard(rows: Iterable[str]) -> str:
+    """Serialized reply_markup made of rows from web_app_row()."""
+    return '{"inline_keyboard":[' + ','.join(rows) + ']}'
+
+@lru_cache(maxsize=1)
+def library_keyboard() -> str:
+    return inline_keyboard([web_app_row('📖 Открыть библиотеку')])
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def reader_keyboard(book_id: str) -> str:
+    return inline_keyboard([web_app_row('➡️ Продолжить чтение', f"/reader/{book_id}")])
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def book_keyboard(book_id: str) -> str:
+    return inline_keyboard([web_app_row('📚 Посмотреть книгу', f"?startapp=book_{book_id}")])
+
+def reader_row(title: str, book_id: str) -> str:
+    return web_app_row(f"➡️ {title}", f"/reader/{book_id}")
+
+# Texts only vary in a few fields shared by many recipients, so whole
+# rendered texts are cached by those fields.
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def inactive_text(genre: str, count: int) -> str:
+    return INACTIVE_TEXT.format(genre=genre, count=count)
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def unfinished_text(title: str, progress: float) -> str:
+    return UNFINISHED_TEXT.format(title=title, progress=progress)
+
+def price_text(price) -> str:
+    return 'Бесплатно' if price == 0 else f"{price}₽"
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _book_caption(title: str, author: str, price, genre: str) -> str:
+    return NEW_BOOK_CAPTION.format(genre=genre, title=title, author=author, price=price_text(price))
+
+def book_caption(book: dict, genre: str) -> str:
+    return _book_caption(book['title'], book['author'], book['price'], genre)
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def book_card(title: str, author: str, price) -> str:
+    return BOOK_CARD.format(title=title, author=author, price=price_text(price))
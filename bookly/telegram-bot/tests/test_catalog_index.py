@@ -0,0 +1,61 @@
+import sys
+import unittest
+from decimal import Decimal
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from catalog_index import CatalogBook, CatalogIndex
+
+def book(book_id: str, title: str, author: str = 'Автор', genres=('Роман',)) -> CatalogBook:
+    return CatalogBook(book_id, title, author, '', Decimal('100'), tuple(genres))
+
+def ids(books) -> list:
+    return [found.id for found in books]
+
+class CatalogIndexSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.index = CatalogIndex()
+        for catalog_book in (
+            book('1', 'Мастер и Маргарита', 'Михаил Булгаков'),
+            book('2', 'Собачье сердце', 'Михаил Булгаков', ('Сатира',)),
+            book('3', 'Ёлка и свадьба', 'Фёдор Достоевский'),
+            book('4', 'Мастерская', 'Иван Мастеров', ('Фэнтези',)),
+        ):
+            self.index.add(catalog_book)
+
+    def test_matches_word_prefixes_in_every_field(self):
+        self.assertEqual(ids(self.index.search('марг', 10)), ['1'])
+        self.assertEqual(sorted(ids(self.index.search('булгак', 10))), ['1', '2'])
+        self.assertEqual(ids(self.index.search('сатир', 10)), ['2'])
+
+    def test_every_query_word_must_match(self):
+        self.assertEqual(ids(self.index.search('булгаков сердце', 10)), ['2'])
+        self.assertEqual(self.index.search('булгаков свадьба', 10), [])
+
+    def test_title_matches_rank_above_author_matches(self):
+        # Newer, so it would come first on a tie
+        self.index.add(book('5', 'Сны', 'Маргарита Петрова'))
+        self.assertEqual(ids(self.index.search('маргарита', 10)), ['1', '5'])
+
+    def test_case_and_yo_are_ignored(self):
+        self.assertEqual(ids(self.index.search('ЕЛКА', 10)), ['3'])
+        self.assertEqual(ids(self.index.search('федор', 10)), ['3'])
+
+    def test_close_spellings_match(self):
+        self.assertEqual(ids(self.index.search('маргарито', 10)), ['1'])
+        self.assertEqual(ids(self.index.search('достаевский', 10)), ['3'])
+
+    def test_empty_query_pages_newest_books_first(self):
+        self.assertEqual(ids(self.index.search('', 2)), ['4', '3'])
+        self.assertEqual(ids(self.index.search('', 2, offset=2)), ['2', '1'])
+
+    def test_reindexed_books_lose_their_old_words(self):
+        self.index.add(book('2', 'Роковые яйца', 'Михаил Булгаков'))
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.index.search('сердце', 10), [])
+        self.assertEqual(ids(self.index.search('яйца', 10)), ['2'])
+        self.assertEqual(ids(self.index.search('', 1)), ['2'])
+
+if __name__ == '__main__':
+    unittest.main()
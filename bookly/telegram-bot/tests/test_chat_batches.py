@@ -0,0 +1,85 @@
+import asyncio
+import sys
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'api'))
+
+from chat_batches import ChatBatcher, reply
+
+def update(update_id: int, chat_id: int, text: str = None):
+    return SimpleNamespace(update_id=update_id, effective_chat=SimpleNamespace(id=chat_id), text=text)
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        self.sent.append((chat_id, text))
+
+class ChatBatcherTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.bot = FakeBot()
+        self.handled = []
+        self.batcher = ChatBatcher(self.process, self.bot, workers=4, max_pending=10, batch_size=10)
+
+    async def process(self, update):
+        # Yield, so updates of other chats could overtake this one
+        await asyncio.sleep(0)
+        self.handled.append(update.update_id)
+        if update.text:
+            await reply(update, 'send_message', text=update.text)
+
+    async def test_updates_of_a_chat_are_handled_in_arrival_order(self):
+        for update_id in range(1, 6):
+            self.batcher.submit(update(update_id, chat_id=1, text=str(update_id)))
+        self.batcher.submit(update(6, chat_id=2, text='other chat'))
+        await self.batcher.join()
+
+        self.assertEqual([update_id for update_id in self.handled if update_id != 6], [1, 2, 3, 4, 5])
+        self.assertEqual([text for chat_id, text in self.bot.sent if chat_id == 1], ['1', '2', '3', '4', '5'])
+        self.assertEqual(self.batcher.pending, 0)
+
+    async def test_identical_consecutive_replies_are_sent_once(self):
+        for update_id in range(3):
+            self.batcher.submit(update(update_id, chat_id=1, text='same'))
+        self.batcher.submit(update(3, chat_id=1, text='different'))
+        await self.batcher.join()
+        self.assertEqual(self.bot.sent, [(1, 'same'), (1, 'different')])
+
+    async def test_last_reply_is_returned_to_its_request(self):
+        self.batcher.submit(update(1, chat_id=1, text='first'))
+        future = self.batcher.submit(update(2, chat_id=1, text='last'), want_reply=True)
+        self.assertEqual(await future, ('send_message', {'chat_id': 1, 'text': 'last'}))
+        await self.batcher.join()
+        # Only the replies before it were sent
+        self.assertEqual(self.bot.sent, [(1, 'first')])
+
+    async def test_request_is_released_when_its_reply_is_not_last(self):
+        future = self.batcher.submit(update(1, chat_id=1, text='first'), want_reply=True)
+        self.batcher.submit(update(2, chat_id=1, text='last'))
+        self.assertIsNone(await future)
+        await self.batcher.join()
+        self.assertEqual(self.bot.sent, [(1, 'first'), (1, 'last')])
+
+    async def test_update_without_replies_resolves_to_none(self):
+        future = self.batcher.submit(update(1, chat_id=1), want_reply=True)
+        self.assertIsNone(await future)
+
+    async def test_reply_of_a_request_that_gave_up_is_sent(self):
+        future = self.batcher.submit(update(1, chat_id=1, text='late'), want_reply=True)
+        future.cancel()
+        await self.batcher.join()
+        self.assertEqual(self.bot.sent, [(1, 'late')])
+
+    async def test_full_once_max_pending_updates_wait(self):
+        for update_id in range(10):
+            self.batcher.submit(update(update_id, chat_id=update_id))
+        self.assertTrue(self.batcher.full)
+        await self.batcher.join()
+        self.assertFalse(self.batcher.full)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import asyncio
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import digest
+from digest import (
+    MEDIA_GROUP_SIZE, MESSAGE_MAX_LENGTH, SUMMARY_MAX_LINES, DigestItem, plan_digest,
+    render_message, render_summary
+)
+from ledger import KIND_INACTIVE, KIND_NEW_BOOK, KIND_UNFINISHED
+
+def new_book(index: int, title: str = None) -> DigestItem:
+    book = {
+        'id': f'book-{index}', 'title': title or f'Книга {index}', 'author': 'Автор',
+        'coverUrl': f'https://covers/{index}.jpg', 'price': 100
+    }
+    return DigestItem(KIND_NEW_BOOK, '42', book['id'], '', {'book': book, 'genre': 'Фэнтези'})
+
+def unfinished(index: int) -> DigestItem:
+    return DigestItem(KIND_UNFINISHED, '42', f'book-{index}', 'p', {
+        'title': f'Книга {index}', 'book_id': f'book-{index}', 'progress': 40
+    })
+
+def inactive() -> DigestItem:
+    return DigestItem(KIND_INACTIVE, '42', '', 'p', {'genre': 'Фэнтези', 'new_books_count': 3})
+
+class PlanDigestTest(unittest.TestCase):
+    def test_single_item_is_its_own_message(self):
+        item = unfinished(1)
+        self.assertEqual(plan_digest([item]), [[item]])
+
+    def test_one_new_book_is_folded_into_the_summary(self):
+        items = [new_book(1), unfinished(2), inactive()]
+        self.assertEqual(plan_digest(items), [items])
+
+    def test_new_books_become_a_media_group_and_the_rest_a_summary(self):
+        books = [new_book(i) for i in range(3)]
+        others = [unfinished(9), inactive()]
+        self.assertEqual(plan_digest(books + others), [books, others])
+
+    def test_covers_are_capped_at_one_media_group(self):
+        books = [new_book(i) for i in range(MEDIA_GROUP_SIZE + 5)]
+        covers, rest = plan_digest(books + [inactive()])
+        self.assertEqual(covers, books[:MEDIA_GROUP_SIZE])
+        self.assertEqual(len(rest), 6)
+
+class RenderSummaryTest(unittest.TestCase):
+    def test_lists_every_item_with_reading_buttons(self):
+        items = [unfinished(i) for i in range(5)] + [inactive(), new_book(7)]
+        message = render_summary(42, items)
+        text = message.kwargs['text']
+        self.assertIn('«Книга 0»', text)
+        self.assertIn('«Книга 7»', text)
+        self.assertNotIn('и ещё', text)
+        # MAX_READING_BUTTONS reader rows and the library button
+        self.assertEqual(message.kwargs['reply_markup'].count('"web_app"'), digest.MAX_READING_BUTTONS + 1)
+
+    def test_long_digests_list_the_first_lines_and_count_the_rest(self):
+        items = [new_book(i) for i in range(SUMMARY_MAX_LINES + 30)] + [inactive()]
+        text = render_summary(42, items).kwargs['text']
+        self.assertIn(f'«Книга {SUMMARY_MAX_LINES - 1}»', text)
+        self.assertNotIn(f'«Книга {SUMMARY_MAX_LINES}»', text)
+        self.assertIn('и ещё 31', text)
+
+    def test_text_stays_within_the_message_limit(self):
+        items = [new_book(i, title='Очень длинное название ' * 12) for i in range(SUMMARY_MAX_LINES)]
+        text = render_summary(42, items).kwargs['text']
+        self.assertLessEqual(len(text), MESSAGE_MAX_LENGTH)
+        self.assertIn('и ещё', text)
+
+class RenderMessageTest(unittest.TestCase):
+    def test_more_new_books_than_a_media_group_are_summarized(self):
+        items = [new_book(i) for i in range(MEDIA_GROUP_SIZE + 1)]
+        message = asyncio.run(render_message('42', items))
+        self.assertEqual(message.method, 'send_message')
+
+if __name__ == '__main__':
+    unittest.main()
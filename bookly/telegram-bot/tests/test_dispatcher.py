@@ -0,0 +1,156 @@
+import asyncio
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import dispatcher
+from dispatcher import (
+    LANE_BULK, LANE_INTERACTIVE, Dispatcher, Lanes, OutboundMessage, TokenBucket, close_dispatcher,
+    get_lanes, init_dispatcher
+)
+
+class TokenBucketTest(unittest.IsolatedAsyncioTestCase):
+    async def timed(self, bucket: TokenBucket, calls: int) -> float:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await asyncio.gather(*(bucket.acquire() for _ in range(calls)))
+        return loop.time() - started
+
+    async def test_full_bucket_lets_a_burst_through(self):
+        bucket = TokenBucket(rate=10, capacity=5)
+        self.assertLess(await self.timed(bucket, 5), 0.05)
+
+    async def test_calls_past_the_capacity_wait_for_the_rate(self):
+        bucket = TokenBucket(rate=50, capacity=1)
+        # The first token is there; the other five come at 50 per second
+        self.assertGreaterEqual(await self.timed(bucket, 6), 0.09)
+
+    async def test_refill_stops_at_the_capacity(self):
+        bucket = TokenBucket(rate=100, capacity=2)
+        await asyncio.sleep(0.1)
+        # Two tokens saved up, not ten; the third one is a wait of 10ms
+        self.assertGreaterEqual(await self.timed(bucket, 4), 0.015)
+
+    async def test_set_rate_caps_saved_tokens_at_the_new_capacity(self):
+        bucket = TokenBucket(rate=20, capacity=20)
+        bucket.set_rate(2)
+        self.assertEqual(bucket.capacity, 2)
+        self.assertGreaterEqual(await self.timed(bucket, 3), 0.45)
+
+class LanesTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        dispatcher._lanes = None
+
+    async def test_each_lane_acquires(self):
+        lanes = Lanes()
+        await asyncio.wait_for(lanes.acquire(LANE_INTERACTIVE), 1)
+        await asyncio.wait_for(lanes.acquire(LANE_BULK), 1)
+        lanes.observe(LANE_INTERACTIVE, 0.1)
+        self.assertGreater(lanes.interactive_latency, 0)
+
+    async def test_dispatcher_shares_the_global_lanes(self):
+        sender = Dispatcher(bot=None)
+        self.assertIs(sender.lanes, get_lanes())
+        await asyncio.wait_for(sender.lanes.acquire(LANE_BULK), 1)
+        await asyncio.wait_for(get_lanes().acquire(LANE_INTERACTIVE), 1)
+
+    async def test_interactive_calls_go_before_waiting_bulk_sends(self):
+        lanes = Lanes(global_rate=5, bulk_rate=5)
+        # Empty both buckets, so the next calls have to wait
+        for _ in range(5):
+            await lanes.acquire(LANE_BULK)
+
+        order = []
+
+        async def call(lane):
+            await lanes.acquire(lane)
+            order.append(lane)
+
+        bulk = asyncio.create_task(call(LANE_BULK))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(call(LANE_INTERACTIVE))
+        await asyncio.wait_for(asyncio.gather(bulk, interactive), 2)
+        self.assertEqual(order, [LANE_INTERACTIVE, LANE_BULK])
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, **kwargs):
+        self.sent.append((chat_id, kwargs))
+        return 'message'
+
+class DispatcherTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        dispatcher._lanes = None
+        self.bot = FakeBot()
+        self.dispatcher = Dispatcher(self.bot, workers=1)
+        await self.dispatcher.start()
+
+    async def asyncTearDown(self):
+        await self.dispatcher.stop()
+
+    async def test_sends_and_reports(self):
+        sent = []
+
+        async def on_sent(message):
+            sent.append(message)
+
+        await self.dispatcher.submit(OutboundMessage('send_message', 1, {'text': 'hi'}, on_sent=on_sent))
+        await asyncio.wait_for(self.dispatcher.drain(), 2)
+        self.assertEqual(self.bot.sent, [(1, {'text': 'hi'})])
+        self.assertEqual(sent, ['message'])
+
+    async def test_messages_no_longer_wanted_are_dropped_without_callbacks(self):
+        calls = []
+
+        async def record(arg):
+            calls.append(arg)
+
+        async def not_wanted():
+            return False
+
+        async def broken():
+            raise RuntimeError('database is down')
+
+        for before_send in (not_wanted, broken):
+            await self.dispatcher.submit(OutboundMessage(
+                'send_message', 1, {'text': 'hi'}, on_sent=record, on_failed=record, before_send=before_send
+            ))
+        await asyncio.wait_for(self.dispatcher.drain(), 2)
+        self.assertEqual(self.bot.sent, [])
+        self.assertEqual(calls, [])
+
+    async def test_unexpected_errors_are_reported_as_failures(self):
+        failures = []
+
+        async def on_failed(error):
+            failures.append(error)
+
+        await self.dispatcher.submit(OutboundMessage('no_such_method', 1, on_failed=on_failed))
+        await asyncio.wait_for(self.dispatcher.drain(), 2)
+        self.assertEqual(len(failures), 1)
+        self.assertIsInstance(failures[0], AttributeError)
+
+class StuckBot:
+    async def send_message(self, chat_id, **kwargs):
+        await asyncio.Event().wait()
+
+class CloseDispatcherTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        dispatcher._lanes = None
+
+    async def test_gives_up_on_messages_it_cannot_deliver_in_time(self):
+        sender = await init_dispatcher(StuckBot())
+        for _ in range(3):
+            await sender.submit(OutboundMessage('send_message', 1, {'text': 'hi'}))
+
+        with mock.patch.object(dispatcher, 'DISPATCH_DRAIN_TIMEOUT', 0.1):
+            await asyncio.wait_for(close_dispatcher(), 2)
+        self.assertIsNone(dispatcher._dispatcher)
+
+if __name__ == '__main__':
+    unittest.main()
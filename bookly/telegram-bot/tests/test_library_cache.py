@@ -0,0 +1,93 @@
+import asyncio
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import library_cache
+from library_cache import LibraryCache
+
+class FakeLoader:
+    """Stands in for load_library_reply; each load returns the next version."""
+
+    def __init__(self):
+        self.loads = 0
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def __call__(self, telegram_id):
+        self.loads += 1
+        version = self.loads
+        await self.release.wait()
+        return f'{telegram_id}:v{version}', '{}'
+
+class LibraryCacheTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.loader = FakeLoader()
+        patcher = mock.patch.object(library_cache, 'load_library_reply', self.loader)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = LibraryCache(size=2, ttl=60)
+
+    async def test_replies_are_cached(self):
+        first = await self.cache.get('1')
+        self.assertEqual(await self.cache.get('1'), first)
+        self.assertEqual(self.loader.loads, 1)
+
+    async def test_replies_expire_after_the_ttl(self):
+        self.cache.ttl = 0
+        await self.cache.get('1')
+        self.assertEqual(await self.cache.get('1'), ('1:v2', '{}'))
+
+    async def test_least_recently_used_replies_are_evicted(self):
+        for telegram_id in ('1', '2', '1', '3'):
+            await self.cache.get(telegram_id)
+        await self.cache.get('1')
+        self.assertEqual(self.loader.loads, 3)
+        await self.cache.get('2')
+        self.assertEqual(self.loader.loads, 4)
+
+    async def test_concurrent_misses_share_one_load(self):
+        self.loader.release.clear()
+        waiting = [asyncio.create_task(self.cache.get('1')) for _ in range(3)]
+        await asyncio.sleep(0)
+        self.loader.release.set()
+        self.assertEqual(await asyncio.gather(*waiting), [('1:v1', '{}')] * 3)
+        self.assertEqual(self.loader.loads, 1)
+
+    async def test_invalidated_replies_are_loaded_again(self):
+        await self.cache.get('1')
+        self.cache.invalidate(['1', '2'])
+        self.assertEqual(await self.cache.get('1'), ('1:v2', '{}'))
+
+    async def test_reply_invalidated_while_loading_is_not_kept(self):
+        self.loader.release.clear()
+        loading = asyncio.create_task(self.cache.get('1'))
+        await asyncio.sleep(0)
+        self.cache.invalidate(['1'])
+        self.loader.release.set()
+        # The caller that asked first still gets the reply it waited for
+        self.assertEqual(await loading, ('1:v1', '{}'))
+        self.assertEqual(await self.cache.get('1'), ('1:v2', '{}'))
+
+    async def test_clear_also_drops_replies_being_loaded(self):
+        await self.cache.get('1')
+        self.loader.release.clear()
+        loading = asyncio.create_task(self.cache.get('2'))
+        await asyncio.sleep(0)
+        self.cache.clear()
+        self.loader.release.set()
+        await loading
+        self.assertEqual(await self.cache.get('1'), ('1:v3', '{}'))
+        self.assertEqual(await self.cache.get('2'), ('2:v4', '{}'))
+
+    async def test_failed_loads_are_not_cached(self):
+        with mock.patch.object(library_cache, 'load_library_reply', side_effect=RuntimeError('down')):
+            with self.assertRaises(RuntimeError):
+                await self.cache.get('1')
+        self.assertEqual(await self.cache.get('1'), ('1:v1', '{}'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import asyncio
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import media_cache
+from media_cache import forget_upload, photo_for
+
+URL = 'https://covers/1.jpg'
+
+class PhotoForTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        media_cache._file_ids.clear()
+        media_cache._uploads.clear()
+
+    async def test_cached_file_id_is_reused(self):
+        media_cache._file_ids['cover:1'] = (URL, 'file-1')
+        self.assertEqual(await photo_for('cover:1', URL), 'file-1')
+        # A changed cover is uploaded again
+        self.assertEqual(await photo_for('cover:1', 'https://covers/new.jpg'), 'https://covers/new.jpg')
+
+    async def test_concurrent_sends_wait_for_the_first_upload(self):
+        self.assertEqual(await photo_for('cover:1', URL), URL)
+        waiting = asyncio.create_task(photo_for('cover:1', URL))
+        await asyncio.sleep(0)
+        media_cache._finish_upload('cover:1', 'file-1')
+        self.assertEqual(await waiting, 'file-1')
+
+    async def test_failed_upload_lets_the_next_send_upload(self):
+        self.assertEqual(await photo_for('cover:1', URL), URL)
+        await forget_upload('cover:1', RuntimeError('rejected'))
+        self.assertEqual(await photo_for('cover:1', URL), URL)
+        self.assertIn('cover:1', media_cache._uploads)
+
+    async def test_lost_upload_is_dropped_after_the_wait(self):
+        self.assertEqual(await photo_for('cover:1', URL), URL)
+        with mock.patch.object(media_cache, 'UPLOAD_WAIT_TIMEOUT', 0.01):
+            self.assertEqual(await photo_for('cover:1', URL), URL)
+        self.assertNotIn('cover:1', media_cache._uploads)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import asyncio
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pipeline import fetch_chunks, pipeline
+
+class Source:
+    """Async iterator over `chunks` recording how far it was read and whether it was closed."""
+
+    def __init__(self, chunks, error: Exception = None):
+        self.chunks = list(chunks)
+        self.error = error
+        self.read = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.read == len(self.chunks):
+            if self.error:
+                raise self.error
+            raise StopAsyncIteration
+        self.read += 1
+        return self.chunks[self.read - 1]
+
+    async def aclose(self):
+        self.closed = True
+
+class PipelineTest(unittest.IsolatedAsyncioTestCase):
+    async def test_chunks_are_processed_in_order(self):
+        processed = []
+
+        async def stage(chunk):
+            await asyncio.sleep(0)
+            processed.append(chunk)
+
+        source = Source(range(10))
+        self.assertEqual(await pipeline(source, stage), 10)
+        self.assertEqual(processed, list(range(10)))
+        self.assertTrue(source.closed)
+
+    async def test_reader_stays_a_bounded_distance_ahead(self):
+        source = Source(range(100))
+        ahead = []
+
+        async def stage(chunk):
+            # Let the reader fill the queue before measuring
+            for _ in range(5):
+                await asyncio.sleep(0)
+            ahead.append(source.read - chunk)
+
+        await pipeline(source, stage, maxsize=2)
+        # The queue, the chunk being put and the one being processed
+        self.assertLessEqual(max(ahead), 4)
+
+    async def test_source_errors_are_raised_after_the_chunks_before_them(self):
+        processed = []
+
+        async def stage(chunk):
+            processed.append(chunk)
+
+        source = Source([1, 2], error=RuntimeError('cursor closed'))
+        with self.assertRaisesRegex(RuntimeError, 'cursor closed'):
+            await pipeline(source, stage)
+        self.assertEqual(processed, [1, 2])
+        self.assertTrue(source.closed)
+
+    async def test_stage_errors_stop_the_reader(self):
+        async def stage(chunk):
+            raise ValueError('bad chunk')
+
+        source = Source(range(100))
+        with self.assertRaises(ValueError):
+            await pipeline(source, stage, maxsize=1)
+        self.assertLess(source.read, 100)
+        self.assertTrue(source.closed)
+
+class FetchChunksTest(unittest.IsolatedAsyncioTestCase):
+    async def test_yields_rows_until_the_cursor_is_exhausted(self):
+        class Cursor:
+            rows = list(range(5))
+
+            async def fetchmany(self, size):
+                rows, self.rows = self.rows[:size], self.rows[size:]
+                return rows
+
+        self.assertEqual([chunk async for chunk in fetch_chunks(Cursor(), 2)], [[0, 1], [2, 3], [4]])
+
+if __name__ == '__main__':
+    unittest.main()
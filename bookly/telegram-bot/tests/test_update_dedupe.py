@@ -0,0 +1,36 @@
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'api'))
+
+from update_dedupe import SeenUpdates
+
+class SeenUpdatesTest(unittest.TestCase):
+    def test_repeated_updates_are_rejected(self):
+        seen = SeenUpdates(size=10)
+        self.assertTrue(seen.add(1))
+        self.assertTrue(seen.add(2))
+        self.assertFalse(seen.add(1))
+        self.assertFalse(seen.add(2))
+
+    def test_oldest_ids_are_forgotten_past_the_size(self):
+        seen = SeenUpdates(size=2)
+        for update_id in (1, 2, 3):
+            seen.add(update_id)
+        self.assertTrue(seen.add(1))
+        self.assertFalse(seen.add(3))
+
+    def test_redelivered_ids_stay_remembered(self):
+        seen = SeenUpdates(size=2)
+        seen.add(1)
+        seen.add(2)
+        # Seeing 1 again makes 2 the oldest
+        self.assertFalse(seen.add(1))
+        seen.add(3)
+        self.assertFalse(seen.add(1))
+        self.assertTrue(seen.add(2))
+
+if __name__ == '__main__':
+    unittest.main()